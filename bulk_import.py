@@ -0,0 +1,110 @@
+"""
+bulk_import.py
+--------------
+Offline bulk loader that injects messages straight into user mailboxes, bypassing SMTP.
+Messages are stamped with a Received: header exactly like the SMTP server does and
+appended through the same storage path, batching many messages per lock acquisition.
+The input is JSON lines, one message per line:
+   {"to": ["bert@swmgmail.com"], "data": "From: ...\\nTo: ...\\nSubject: ...\\n<body>"}
+When "to" is missing the recipient is taken from the To: header.
+Usage: python bulk_import.py [--config FILE] [--mail-root DIR] [--batch-size N] [--skip-invalid] [--compression zlib|lzma] [<input.jsonl> ...]
+Reads standard input when no input files are given.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import config
+from mailserver_smtp import get_timestamp, get_valid_usernames, stamp_message, write_messages
+from mailstore import COMPRESSORS
+
+
+class BulkImporter:
+    """Groups stamped messages per mailbox and flushes them in batches."""
+
+    def __init__(self, batch_size=1000, skip_invalid=False, compression=None):
+        self.batch_size = batch_size
+        self.skip_invalid = skip_invalid
+        self.compression = compression
+        self.valid_usernames = set(get_valid_usernames())
+        self.pending = {}
+        self.imported = 0
+        self.skipped = 0
+        self.timestamp = get_timestamp()
+
+    def add(self, record):
+        """Stamps one input record and queues it for each of its recipients."""
+        if "lines" in record:
+            data_lines = record["lines"]
+        else:
+            data_lines = record["data"].splitlines()
+        recipients = record.get("to")
+        if recipients is None:
+            recipients = [line[4:].strip() for line in data_lines[1:2] if line.startswith("To: ")]
+        elif isinstance(recipients, str):
+            recipients = [recipients]
+
+        usernames = []
+        for rec in recipients:
+            username, _, domain = rec.partition("@")
+            if domain != config.domain or username not in self.valid_usernames:
+                if not self.skip_invalid:
+                    raise ValueError(f"Unknown recipient: {rec}")
+                self.skipped += 1
+                continue
+            usernames.append(username)
+
+        message = stamp_message(data_lines, record.get("received", self.timestamp))
+        for username in usernames:
+            batch = self.pending.setdefault(username, [])
+            batch.append(message)
+            if len(batch) >= self.batch_size:
+                self.flush(username)
+
+    def flush(self, username=None):
+        """Writes out the queued messages of one user, or of every user."""
+        usernames = [username] if username is not None else list(self.pending)
+        for name in usernames:
+            batch = self.pending.pop(name, [])
+            if batch:
+                write_messages(batch, name, self.compression)
+                self.imported += len(batch)
+
+
+def read_records(files):
+    for f in files:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import messages into swmgmail mailboxes.")
+    parser.add_argument("inputs", nargs="*", help="JSON lines files (default: standard input)")
+    config.add_mail_arguments(parser)
+    parser.add_argument("--batch-size", type=int, default=1000, help="messages per mailbox per lock acquisition")
+    parser.add_argument("--skip-invalid", action="store_true", help="skip unknown recipients instead of aborting")
+    parser.add_argument("--compression", choices=sorted(COMPRESSORS), help="compress the imported mail with this codec")
+    args = config.parse_args(parser, "bulk_import")
+    config.apply_mail_options(args)
+
+    files = [open(path, "r", encoding="utf-8") for path in args.inputs] or [sys.stdin]
+    importer = BulkImporter(args.batch_size, args.skip_invalid, args.compression)
+    start = time.perf_counter()
+    try:
+        for record in read_records(files):
+            importer.add(record)
+    finally:
+        importer.flush()
+        for f in files:
+            if f is not sys.stdin:
+                f.close()
+    elapsed = time.perf_counter() - start
+    rate = importer.imported / elapsed if elapsed > 0 else 0
+    print(f"Imported {importer.imported} messages ({importer.skipped} skipped) in {elapsed:.2f}s ({rate:.0f} msg/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+config.py
+---------
+Runtime settings shared by the servers, the client and the tools.
+Every command line option can also be set in a settings file, TOML (*.toml) or INI (anything
+else), named with --config, the SWMGMAIL_CONFIG environment variable, or ./swmgmail.toml if it
+exists. Each program reads its own section ([smtp], [pop3], [imap], [client], [maintenance], [bulk_import],
+[export], [proxy], [replication]) plus the shared [mail] section; option names use underscores:
+
+   [mail]
+   mail_root = "/var/mail/swmgmail"
+
+   [smtp]
+   port = 25
+   workers = 4
+   backlog = 512
+
+Environment variables SWMGMAIL_<SECTION>_<NAME> (e.g. SWMGMAIL_SMTP_WORKERS=8) override the file,
+options given on the command line override both.
+"""
+
+import os
+
+import mailstore
+import storage
+
+CONFIG_ENV = "SWMGMAIL_CONFIG"
+DEFAULT_CONFIG_FILE = "swmgmail.toml"
+ENV_PREFIX = "SWMGMAIL_"
+SHARED_SECTION = "mail"
+DEFAULT_DOMAIN = "swmgmail.com"
+DEFAULT_USERINFO = "userinfo.txt"
+
+# Set from the [mail] settings at startup
+domain = DEFAULT_DOMAIN
+
+
+def load_config(path=None):
+    """Returns {section: {name: value}} read from a TOML or INI file, {} when there is none."""
+    if path is None:
+        path = os.environ.get(CONFIG_ENV)
+    if path is None:
+        if not os.path.exists(DEFAULT_CONFIG_FILE):
+            return {}
+        path = DEFAULT_CONFIG_FILE
+    # The parsers are only imported when there is a file to read, which keeps the client's startup short
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    import configparser
+    parser = configparser.ConfigParser(interpolation=None)
+    with open(path, "r") as f:
+        parser.read_file(f)
+    return {section: dict(parser[section]) for section in parser.sections()}
+
+
+def section_settings(config, section):
+    """Returns the settings of one section with the environment overrides applied."""
+    settings = dict(config.get(section, {}))
+    prefix = f"{ENV_PREFIX}{section.upper()}_"
+    for name, value in os.environ.items():
+        if name.startswith(prefix):
+            settings[name[len(prefix):].lower()] = value
+    return settings
+
+
+def parse_args(parser, section, shared=(SHARED_SECTION,), argv=None):
+    """Parses the command line, taking defaults from the settings file and environment.
+
+    Unknown names in the program's own section are an error; the shared sections only
+    contribute the settings this program has options for.
+    """
+    parser.add_argument("--config", help=f"settings file (default ${CONFIG_ENV} or ./{DEFAULT_CONFIG_FILE})")
+    known, _ = parser.parse_known_args(argv)
+    config = load_config(known.config)
+    actions = {}
+    for action in parser._actions:
+        if action.dest not in ("help", "config"):
+            # Settings are named after the option (--sender-rate: sender_rate) or its dest
+            actions[action.dest] = action
+            actions.update((option[2:].replace("-", "_"), action) for option in action.option_strings
+                           if option.startswith("--"))
+    defaults = {}
+    for name in list(shared) + [section]:
+        for key, value in section_settings(config, name).items():
+            action = actions.get(key.replace("-", "_"))
+            if action is None:
+                if name == section:
+                    parser.error(f"unknown setting {key!r} in [{section}]")
+                continue
+            if action.nargs == 0 and isinstance(value, str):
+                value = value.strip().lower() in ("1", "true", "yes", "on")  # store_true flags
+            defaults[action.dest] = value
+    # String defaults go through each option's type conversion, so INI and environment values work too
+    parser.set_defaults(**defaults)
+    return parser.parse_args(argv)
+
+
+def add_mail_arguments(parser):
+    parser.add_argument("--mail-root", default=mailstore.DEFAULT_MAIL_ROOT, help="directory the mailboxes are kept under")
+    parser.add_argument("--userinfo", default=DEFAULT_USERINFO, help="file with the user names and passwords")
+    parser.add_argument("--store", choices=storage.STORES, default="file",
+                        help="keep users and mail in files (userinfo and mailboxes) or in an SQLite database")
+    parser.add_argument("--database", help=f"SQLite database of --store sqlite (default <mail root>/{storage.DATABASE_NAME})")
+    parser.add_argument("--domain", default=DEFAULT_DOMAIN, help="mail domain served")
+    parser.add_argument("--chunk-size", type=int, default=mailstore.CHUNK_SIZE,
+                        help="bytes of compressed mail inflated at a time")
+    parser.add_argument("--replication-log", help="directory to log deliveries and removals in for standby servers")
+
+
+def apply_mail_options(args):
+    global domain
+    domain = args.domain
+    mailstore.set_mail_root(args.mail_root)
+    mailstore.CHUNK_SIZE = args.chunk_size
+    database = args.database or os.path.join(args.mail_root, storage.DATABASE_NAME)
+    store = storage.open_store(args.store, args.userinfo, database)
+    if args.replication_log:
+        import replication  # only needed on a replicated primary
+        store = replication.ReplicatedStore(store, replication.ChangeLog(args.replication_log))
+    storage.set_store(store)
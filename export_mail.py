@@ -0,0 +1,223 @@
+"""
+export_mail.py
+--------------
+Streams mail out of the store for compliance and analytics jobs, as mbox (mboxrd quoting) or as
+JSON lines with the parsed headers, one object per message:
+   {"user": "bert", "number": 1, "received": "2025-03-18T14:02:00", "size": 123,
+    "headers": {"from": "...", "to": "...", "subject": "..."}, "body": "..."}
+export_messages() is the underlying generator and works on either store (--store). A mailbox is
+read EXPORT_WINDOW bytes of mail per lock, so memory stays bounded and deliveries are not held up
+while the output is written. The export follows the messages' IMAP UIDs (assigning them if need
+be), so mail delivered meanwhile is exported as well and mail removed meanwhile (DELE, expiry)
+does not make it skip or repeat messages.
+Without --output everything goes to standard output, one user after the other. With --output DIR
+every user gets <DIR>/<username>.mbox (or .jsonl), written by --workers processes in parallel and
+renamed into place when complete; a user whose mailbox was renumbered underneath is exported again.
+Usage: python export_mail.py [--config FILE] [--mail-root DIR] [--format mbox|jsonl] [--user NAME ...]
+                             [--since YYYY-MM-DD] [--before YYYY-MM-DD] [--sender TEXT]
+                             [--output DIR [--workers N]]
+"""
+
+import argparse
+import bisect
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import config
+import storage
+from imap_server import split_message
+from mailstore import parse_received
+from storage import matches, parse_headers
+
+EXPORT_WINDOW = 64 * 1024 * 1024  # bytes of mail read per mailbox lock (opening one reads its whole index)
+EXPORT_ATTEMPTS = 3  # tries per user with --output before a changing mailbox is given up on
+FORMATS = ("mbox", "jsonl")
+FROM_LINE = re.compile(rb"^(>*From )", re.MULTILINE)
+
+
+class MailboxChanged(Exception):
+    """The mailbox's messages got new UIDs (UIDVALIDITY changed) in the middle of an export."""
+
+
+def export_messages(username, since=None, before=None, sender=None):
+    """Yields (number, received, headers, content) for each of the user's messages received in
+    [since, before) whose From: contains sender (any case), in mailbox order.
+
+    content is the message as it was sent (CRLF lines, dot-stuffing undone, a blank line after
+    the header), headers its (lowercased name, value) header lines and received a datetime or None.
+    The export keeps its place by UID, so mail removed or delivered between two windows does
+    not throw it off; MailboxChanged is raised if the mailbox is renumbered meanwhile.
+    """
+    if not storage.store.usage(username)[0]:
+        return
+    uidvalidity = storage.store.uids(username)[0]  # numbers the messages if IMAP never has
+    last_uid = 0
+    while True:
+        batch = []
+        size = 0
+        with storage.store.open_mailbox(username) as mailbox:
+            uids = mailbox.uids()
+            if uids is None:
+                raise MailboxChanged(f"{username}: mailbox renumbered during the export")
+            number = bisect.bisect_right(uids, last_uid)
+            while number < len(mailbox) and size < EXPORT_WINDOW:
+                number += 1
+                head = bytes(mailbox.message_head(number))
+                received = parse_received(head)
+                if (since is not None or before is not None) and (
+                        received is None or (since and received < since) or (before and received >= before)):
+                    continue
+                if sender is not None and not matches(parse_headers(head.decode("utf-8", "replace")), "from", sender):
+                    continue
+                header, text = split_message(bytes(mailbox.message(number)))
+                batch.append((number, received, parse_headers(header.decode("utf-8", "replace")), header + text))
+                size += len(header) + len(text)
+            finished = number == len(mailbox)
+            if number:
+                last_uid = uids[number - 1]
+        if storage.store.uids(username)[0] != uidvalidity:
+            raise MailboxChanged(f"{username}: mailbox renumbered during the export")
+        yield from batch
+        if finished:
+            return
+
+
+def format_mbox(username, number, received, headers, content):
+    """Returns a message as an mbox entry: From_ line, LF line endings, >From quoting, blank line."""
+    sender = next((value for name, value in headers if name == "from"), "")
+    sender = sender.strip().strip("<>").split(" ")[-1].strip("<>") or "MAILER-DAEMON"
+    date = time.asctime(received.timetuple()) if received is not None else time.asctime(time.gmtime(0))
+    body = content.replace(b"\r\n", b"\n")
+    if b"From " in body:
+        body = FROM_LINE.sub(rb">\1", body)
+    return f"From {sender} {date}\n".encode("utf-8") + body + b"\n"
+
+
+def format_jsonl(username, number, received, headers, content):
+    header_end = 2 if content.startswith(b"\r\n") else content.index(b"\r\n\r\n") + 4
+    record = {"user": username, "number": number,
+              "received": received.isoformat() if received is not None else None,
+              "size": len(content), "headers": first_values(headers),
+              "body": content[header_end:].decode("utf-8", "replace")}
+    return json.dumps(record).encode("utf-8") + b"\n"
+
+
+def first_values(headers):
+    values = {}
+    for name, value in headers:
+        values.setdefault(name, value)
+    return values
+
+
+FORMATTERS = {"mbox": format_mbox, "jsonl": format_jsonl}
+
+
+def write_user(out, username, fmt, since=None, before=None, sender=None):
+    """Writes one user's messages to a binary file, returns (messages, bytes) written."""
+    formatter = FORMATTERS[fmt]
+    count = written = 0
+    for message in export_messages(username, since, before, sender):
+        data = formatter(username, *message)
+        out.write(data)
+        count += 1
+        written += len(data)
+    return count, written
+
+
+def export_user_file(username, directory, fmt, since=None, before=None, sender=None):
+    """Exports a user to <directory>/<username>.<fmt>, trying again if the mailbox changes.
+
+    Returns (username, messages, bytes, path).
+    """
+    path = os.path.join(directory, f"{username}.{fmt}")
+    partial = path + ".part"
+    for attempt in range(1, EXPORT_ATTEMPTS + 1):
+        try:
+            with open(partial, "wb") as out:
+                count, written = write_user(out, username, fmt, since, before, sender)
+        except MailboxChanged:
+            if attempt == EXPORT_ATTEMPTS:
+                os.remove(partial)
+                raise
+            continue
+        os.replace(partial, path)
+        return username, count, written, path
+
+
+def export_to_directory(usernames, directory, fmt, workers, since=None, before=None, sender=None):
+    """Exports every user to a file of its own with `workers` processes, returns True if all succeeded."""
+    os.makedirs(directory, exist_ok=True)
+    ok = True
+    total = total_bytes = 0
+    started = time.monotonic()
+    # Forked, so the workers inherit the store and mail root set up from the options
+    context = multiprocessing.get_context("fork")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(export_user_file, username, directory, fmt, since, before, sender)
+                   for username in usernames]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                username, count, written, path = future.result()
+            except (MailboxChanged, OSError) as e:
+                print(f"Export failed: {e}")
+                ok = False
+                continue
+            print(f"{username}: {count} messages -> {path}")
+            total += count
+            total_bytes += written
+    elapsed = time.monotonic() - started
+    print(f"Exported {total} messages ({total_bytes} bytes) of {len(usernames)} users in {elapsed:.1f}s.")
+    return ok
+
+
+def export_to_stream(usernames, out, fmt, since=None, before=None, sender=None):
+    """Exports the users one after the other to a binary stream, returns True if all succeeded."""
+    ok = True
+    for username in usernames:
+        try:
+            write_user(out, username, fmt, since, before, sender)
+        except MailboxChanged as e:
+            print(f"Export incomplete: {e}", file=sys.stderr)
+            ok = False
+    out.flush()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export swmgmail mailboxes to mbox or JSON lines.")
+    parser.add_argument("--format", choices=FORMATS, default="mbox")
+    parser.add_argument("--user", action="append", dest="users", help="user to export (repeatable, default all)")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, help="only mail received at or after this time")
+    parser.add_argument("--before", type=datetime.datetime.fromisoformat, help="only mail received before this time")
+    parser.add_argument("--sender", help="only mail whose From: contains this text")
+    parser.add_argument("--output", help="directory to write one file per user to (default: standard output)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="users exported in parallel with --output")
+    config.add_mail_arguments(parser)
+    args = config.parse_args(parser, "export")
+    config.apply_mail_options(args)
+
+    usernames = args.users or sorted(storage.store.usernames())
+    unknown = [username for username in usernames if not storage.store.has_user(username)]
+    if unknown:
+        parser.error(f"unknown users: {', '.join(unknown)}")
+    if args.output:
+        ok = export_to_directory(usernames, args.output, args.format, max(1, args.workers),
+                                 args.since, args.before, args.sender)
+    else:
+        try:
+            ok = export_to_stream(usernames, sys.stdout.buffer, args.format, args.since, args.before, args.sender)
+        except BrokenPipeError:
+            # Whoever reads the output (e.g. head) has stopped, so stop quietly
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            ok = False
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
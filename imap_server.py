@@ -0,0 +1,919 @@
+"""
+imap_server.py
+--------------
+An IMAP4rev1 (RFC 3501) subset server on the same user and mail store as the SMTP and POP3 servers.
+Every user has one mailbox, INBOX. Messages keep their UID and flags from session to session, so
+a client can sync incrementally (UID SEARCH UID <n>:*, UID FETCH <set> FLAGS) and fetch only
+the parts it shows (BODY.PEEK[HEADER.FIELDS (...)], BODY[TEXT], partial fetches <start.length>).
+Supported commands:
+   any state        CAPABILITY, NOOP, LOGOUT
+   not logged in    LOGIN, STARTTLS (with a certificate configured)
+   logged in        SELECT, EXAMINE, LIST, LSUB, STATUS
+   INBOX selected   CHECK, CLOSE, EXPUNGE, SEARCH, FETCH, STORE, UID FETCH/SEARCH/STORE, IDLE (RFC 2177)
+FETCH knows UID, FLAGS, INTERNALDATE, RFC822.SIZE, RFC822(.HEADER/.TEXT), BODY, BODYSTRUCTURE and
+BODY[.PEEK][<section>]<partial> with the sections HEADER, HEADER.FIELDS(.NOT), TEXT and 1; every
+message is a single text/plain part. Stored messages have no blank line between their headers
+and body (the Received: line stamped on delivery is the last header), so one is inserted, and the
+dot-stuffing of the stored wire form is undone, whenever a message is handed out.
+Usage: python imap_server.py [<IMAP_port>] [--workers N] [--config FILE]
+"""
+
+import argparse
+import contextlib
+import datetime
+import functools
+import re
+import select
+import sqlite3
+import threading
+import time
+from enum import Enum, auto
+
+import config
+import notify
+import storage
+from mailstore import TERMINATOR, parse_received
+from profiling import CommandTimer, add_profiling_arguments, apply_profiling_options, install_profiler_signal, timed
+from ratelimit import add_rate_limit_arguments, rate_limit_options
+from sessions import (DEFAULT_COMMAND_TIMEOUT, DEFAULT_DRAIN_TIMEOUT, DEFAULT_MAX_SESSIONS, DEFAULT_RECV_SIZE,
+                      POLL_INTERVAL, ReplyBuffer, SessionRegistry, add_session_arguments, reject, session_options,
+                      wait_for_input)
+from storage import parse_headers
+from tls import add_tls_arguments, is_tls, tls_options
+from workers import add_worker_arguments, create_listener, handle_sigterm, run_workers
+
+IMAP_PORT = 1430
+IMAP_IDLE_TIMEOUT = 1800 # RFC 3501: the autologout timer is at least 30 minutes
+MAX_LITERAL = 64 * 1024 # no APPEND, so literals only carry names, passwords and search strings
+FETCH_BATCH = 50 # messages read per mailbox lock, the lock is released before they are sent
+HEAD_LIMIT = 8192 # bytes read for header-only fetches, longer headers are read in full
+SYSTEM_FLAGS = ("\\Answered", "\\Flagged", "\\Deleted", "\\Seen", "\\Draft")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+LITERAL = re.compile(rb"\{(\d+)(\+?)\}$")
+SECTION_ITEM = re.compile(r"(BODY(?:\.PEEK)?)\[([^\]]*)\](?:<(\d+)\.(\d+)>)?$")
+HEADER_FIELDS = re.compile(r"HEADER\.FIELDS(\.NOT)? \((.*)\)$")
+
+
+class IMAPState(Enum):
+    NOT_AUTHENTICATED = auto()
+    AUTHENTICATED = auto()
+    SELECTED = auto()
+    LOGOUT = auto()
+
+
+class BadCommand(Exception):
+    """A command that cannot be carried out as given, answered with BAD."""
+
+
+class SessionEnd(Exception):
+    """Ends a session after its BYE has been sent."""
+
+
+def parse_arguments(text, literals=()):
+    """Splits a command line into atoms and strings, parenthesized lists become Python lists.
+
+    Literals have been read beforehand, each is marked by a NUL character in text.
+    Brackets keep fetch items such as BODY[HEADER.FIELDS (FROM)] in one atom.
+    """
+    literals = iter(literals)
+    stack = [[]]
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == " ":
+            i += 1
+        elif c == "(":
+            stack.append([])
+            i += 1
+        elif c == ")":
+            if len(stack) == 1:
+                raise BadCommand("unbalanced parentheses")
+            done = stack.pop()
+            stack[-1].append(done)
+            i += 1
+        elif c == '"':
+            value = []
+            i += 1
+            while i < len(text) and text[i] != '"':
+                if text[i] == "\\":
+                    i += 1
+                value.append(text[i:i + 1])
+                i += 1
+            if i >= len(text):
+                raise BadCommand("unterminated string")
+            stack[-1].append("".join(value))
+            i += 1
+        elif c == "\0":
+            stack[-1].append(next(literals))
+            i += 1
+        else:
+            start = i
+            depth = 0
+            while i < len(text) and (depth or text[i] not in ' ()"\0'):
+                if text[i] == "[":
+                    depth += 1
+                elif text[i] == "]":
+                    depth -= 1
+                i += 1
+            stack[-1].append(text[start:i])
+    if len(stack) != 1:
+        raise BadCommand("unbalanced parentheses")
+    return stack[0]
+
+
+def parse_sequence_set(text, largest):
+    """Returns the (low, high) ranges of a sequence set such as 1:4,7,9:*, * standing for largest."""
+    if not isinstance(text, str):
+        raise BadCommand("sequence set expected")
+    ranges = []
+    for part in text.split(","):
+        low, _, high = part.partition(":")
+        low = _set_number(low, largest)
+        high = _set_number(high, largest) if high else low
+        ranges.append((min(low, high), max(low, high)))
+    return ranges
+
+
+def _set_number(text, largest):
+    if text == "*":
+        return largest
+    if not text.isdigit() or int(text) == 0:
+        raise BadCommand(f"invalid sequence set number {text!r}")
+    return int(text)
+
+
+def in_ranges(number, ranges):
+    return any(low <= number <= high for low, high in ranges)
+
+
+def is_sequence_set(text):
+    return isinstance(text, str) and re.fullmatch(r"[0-9*:,]+", text) is not None
+
+
+def parse_date(text):
+    """Parses an IMAP search date such as 1-Feb-2024."""
+    try:
+        day, month, year = str(text).split("-")
+        return datetime.datetime(int(year), MONTHS.index(month.capitalize()) + 1, int(day))
+    except ValueError:
+        raise BadCommand(f"invalid date {text!r}") from None
+
+
+def format_internaldate(received):
+    if received is None:
+        return '"01-Jan-1970 00:00:00 +0000"'
+    received = received.astimezone()  # stamped in the server's local time
+    return f'"{received.day:02d}-{MONTHS[received.month - 1]}-{received.year} {received:%H:%M:%S %z}"'
+
+
+def format_flags(flags):
+    return "(" + " ".join(sorted(flags)) + ")"
+
+
+def literal(data):
+    return f"{{{len(data)}}}\r\n".encode("ascii") + data
+
+
+def split_message(data, complete=True):
+    """Returns (header, text) of a stored message the way IMAP hands them out.
+
+    The dot-stuffing is undone and the header ends with a blank line. With complete=False data
+    is only the start of the message and text is None; if the header does not end within data,
+    None is returned.
+    """
+    data = bytes(data)
+    if complete:
+        if data.endswith(TERMINATOR):
+            data = data[:-len(TERMINATOR)]
+    else:
+        end = data.rfind(b"\r\n")
+        if end == -1:
+            return None
+        data = data[:end + 2]
+    lines = [line[1:] if line.startswith(b".") else line for line in data.split(b"\r\n")]
+    lines.pop()  # empty, after the last line ending
+    headers = parse_headers(b"\r\n".join(lines).decode("utf-8", "replace"))
+    count = len(headers)
+    if not complete and count == len(lines) and not (headers and headers[-1][0] == "received"):
+        return None
+    header = b"".join(line + b"\r\n" for line in lines[:count]) + b"\r\n"
+    if not complete:
+        return header, None
+    body = lines[count:]
+    if body and body[0] == b"":
+        body = body[1:]  # the message had a blank line after its headers already
+    return header, b"".join(line + b"\r\n" for line in body)
+
+
+def filter_header(header, names, exclude):
+    """Keeps (or with exclude drops) the header lines named in names, names being lowercase."""
+    lines = [line for line in header.split(b"\r\n")[:-2]
+             if (line.split(b":", 1)[0].strip().decode("ascii", "replace").lower() in names) != exclude]
+    return b"".join(line + b"\r\n" for line in lines) + b"\r\n"
+
+
+def parse_fetch_items(items):
+    """Returns the fetch items as (name, section, partial, peek) tuples."""
+    if isinstance(items, str):
+        items = [items]
+    if len(items) == 1 and isinstance(items[0], str) and items[0].upper() == "FAST":
+        items = ["FLAGS", "INTERNALDATE", "RFC822.SIZE"]
+    parsed = []
+    for item in items:
+        if not isinstance(item, str):
+            raise BadCommand("fetch item expected")
+        item = " ".join(item.upper().split())
+        if item in ("UID", "FLAGS", "INTERNALDATE", "RFC822.SIZE", "RFC822", "RFC822.HEADER", "RFC822.TEXT",
+                    "BODY", "BODYSTRUCTURE"):
+            parsed.append((item, None, None, item not in ("RFC822", "RFC822.TEXT")))
+            continue
+        match = SECTION_ITEM.match(item)
+        if match is None:
+            raise BadCommand(f"unsupported fetch item {item}")
+        name, section, start, length = match.groups()
+        if section not in ("", "HEADER", "TEXT", "1") and HEADER_FIELDS.match(section) is None:
+            raise BadCommand(f"unsupported section {section}")
+        partial = (int(start), int(length)) if start is not None else None
+        parsed.append(("SECTION", section, partial, name == "BODY.PEEK"))
+    return parsed
+
+
+class IMAPSession:
+    """Handles a single IMAP session with a client."""
+
+    def __init__(self, conn, addr, idle_timeout=IMAP_IDLE_TIMEOUT, command_timeout=DEFAULT_COMMAND_TIMEOUT,
+                 recv_size=DEFAULT_RECV_SIZE, draining=None, limits=None, tls=None, require_tls=False, sessions=None):
+        self.conn = conn
+        self.addr = addr
+        self.idle_timeout = idle_timeout
+        self.command_timeout = command_timeout
+        self.recv_size = recv_size
+        self.draining = draining
+        self.limits = limits
+        self.tls = tls
+        self.require_tls = require_tls
+        self.sessions = sessions
+        self.buffer = b""
+        self.output = ReplyBuffer(conn)
+        self.state = IMAPState.NOT_AUTHENTICATED
+        self.username = None
+        self.read_only = False
+        # The selected mailbox as the client knows it
+        self.uidvalidity = None
+        self.uidnext = None
+        self.uids = []  # UID of every message, in sequence number order
+        self.flags = {}  # uid -> frozenset of flags
+        self.octets = {}  # uid -> stored size
+        self.sizes = {}  # uid -> RFC822.SIZE, computed when first asked for
+        any_state = set(IMAPState)
+        logged_in = {IMAPState.AUTHENTICATED, IMAPState.SELECTED}
+        selected = {IMAPState.SELECTED}
+        self.commands = {
+            "CAPABILITY": (self.handle_capability, any_state), "NOOP": (self.handle_noop, any_state),
+            "LOGOUT": (self.handle_logout, any_state),
+            "STARTTLS": (self.handle_starttls, {IMAPState.NOT_AUTHENTICATED}),
+            "LOGIN": (self.handle_login, {IMAPState.NOT_AUTHENTICATED}),
+            "SELECT": (self.handle_select, logged_in), "EXAMINE": (self.handle_select, logged_in),
+            "LIST": (self.handle_list, logged_in), "LSUB": (self.handle_list, logged_in),
+            "STATUS": (self.handle_status, logged_in),
+            "CHECK": (self.handle_noop, selected), "CLOSE": (self.handle_close, selected),
+            "EXPUNGE": (self.handle_expunge, selected), "SEARCH": (self.handle_search, selected),
+            "FETCH": (self.handle_fetch, selected), "STORE": (self.handle_store, selected),
+            "IDLE": (self.handle_idle, selected),
+        }
+
+    def send(self, line):
+        """Queues a response line, it is sent at the next flush."""
+        self.output.write((line + "\r\n").encode("utf-8"))
+
+    def send_bytes(self, data):
+        self.output.write(data)
+
+    def flush(self):
+        timed("io", self.output.flush)
+
+    def capabilities(self):
+        capabilities = ["IMAP4rev1", "IDLE"]
+        if self.tls is not None and not is_tls(self.conn):
+            capabilities.append("STARTTLS")
+            if self.require_tls:
+                capabilities.append("LOGINDISABLED")
+        return " ".join(capabilities)
+
+    def handle_client(self):
+        """Processes IMAP commands from the client."""
+        try:
+            self.conn.settimeout(self.command_timeout)
+            self.send(f"* OK [CAPABILITY {self.capabilities()}] {config.domain} IMAP4rev1 server ready")
+            while self.state != IMAPState.LOGOUT:
+                command = self.read_command()
+                if command is None:
+                    break
+                line, literals = command
+                with CommandTimer("imap", self.addr, line):
+                    self.handle_command(line, literals)
+        except SessionEnd:
+            pass
+        except (OSError, sqlite3.Error) as e:
+            print(f"IMAP exception with client {self.addr}: {e}")
+        finally:
+            with contextlib.suppress(OSError):
+                self.flush()  # e.g. the BYE and tagged reply to LOGOUT
+            self.conn.close()
+            if self.sessions is not None:
+                self.sessions.remove(self.conn)
+
+    def receive(self, draining=True):
+        """Reads more input into the buffer, returns False when the session has to end."""
+        # Everything received so far is answered before waiting for more
+        self.flush()
+        if not wait_for_input(self.conn, self.idle_timeout, self.draining if draining else None):
+            if self.draining is not None and self.draining.is_set():
+                self.send("* BYE IMAP server shutting down")
+            else:
+                self.send("* BYE Autologout, idle for too long")
+            return False
+        data = self.conn.recv(self.recv_size)
+        if not data:
+            return False  # Client disconnected
+        self.buffer += data
+        return True
+
+    def read_line(self, draining=True):
+        """Returns the next line without its line ending, None when the session has to end."""
+        while True:
+            end = self.buffer.find(b"\n")
+            if end != -1:
+                line = self.buffer[:end].rstrip(b"\r")
+                self.buffer = self.buffer[end + 1:]
+                return line
+            if not self.receive(draining):
+                return None
+
+    def read_command(self):
+        """Returns (line, literals) of the next command, the literals marked by NUL in line."""
+        line = self.read_line()
+        if line is None:
+            return None
+        text = []
+        literals = []
+        while True:
+            match = LITERAL.search(line)
+            if match is None:
+                text.append(line.decode("utf-8", "replace").replace("\0", ""))
+                return "".join(text), literals
+            size = int(match.group(1))
+            text.append(line[:match.start()].decode("utf-8", "replace").replace("\0", "") + "\0")
+            if size > MAX_LITERAL:
+                tag = text[0].split(" ", 1)[0]
+                if match.group(2):
+                    # The client sends it regardless, there is no getting back in step
+                    self.send("* BYE Literal too large")
+                    raise SessionEnd
+                self.send(f"{tag} BAD literal too large")
+                return self.read_command()
+            if not match.group(2):
+                self.send("+ Ready for literal data")
+            # A literal being sent is always read, even while draining
+            while len(self.buffer) < size:
+                if not self.receive(draining=False):
+                    return None
+            literals.append(self.buffer[:size].decode("utf-8", "replace"))
+            self.buffer = self.buffer[size:]
+            line = self.read_line(draining=False)
+            if line is None:
+                return None
+
+    def handle_command(self, line, literals):
+        tag, _, rest = line.partition(" ")
+        try:
+            if not tag or tag == "*" or "\0" in tag or not rest:
+                raise BadCommand("tag and command expected")
+            if self.limits is not None and not self.limits.allow_command(self.addr[0], self.username):
+                self.send(f"{tag} NO Too many commands, slow down")
+                return
+            args = parse_arguments(rest, literals)
+            name = args[0].upper() if args and isinstance(args[0], str) else ""
+            args = args[1:]
+            uid = False
+            if name == "UID":
+                if not args or not isinstance(args[0], str) or args[0].upper() not in ("FETCH", "SEARCH", "STORE"):
+                    raise BadCommand("UID FETCH, UID SEARCH or UID STORE expected")
+                uid = True
+                name = args[0].upper()
+                args = args[1:]
+            handler, states = self.commands.get(name, (None, None))
+            if handler is None:
+                raise BadCommand("unknown command")
+            if self.state not in states:
+                raise BadCommand(f"{name} not allowed now")
+            handler(tag, name, args, uid)
+        except BadCommand as e:
+            self.send(f"{tag if tag and tag != '*' else '*'} BAD {e}")
+
+    def handle_capability(self, tag, name, args, uid):
+        self.send(f"* CAPABILITY {self.capabilities()}")
+        self.send(f"{tag} OK CAPABILITY completed")
+
+    def handle_noop(self, tag, name, args, uid):
+        if self.state == IMAPState.SELECTED:
+            self.refresh()
+        self.send(f"{tag} OK {name} completed")
+
+    def handle_logout(self, tag, name, args, uid):
+        self.send("* BYE IMAP4rev1 server logging out")
+        self.send(f"{tag} OK LOGOUT completed")
+        self.state = IMAPState.LOGOUT
+
+    def handle_starttls(self, tag, name, args, uid):
+        """Upgrades the connection to TLS (RFC 3501 6.2.1), anything pipelined behind STARTTLS is dropped."""
+        if self.tls is None:
+            self.send(f"{tag} BAD STARTTLS not available")
+            return
+        if is_tls(self.conn):
+            self.send(f"{tag} BAD TLS already active")
+            return
+        self.send(f"{tag} OK Begin TLS negotiation now")
+        self.flush()
+        # The handshake is bounded by the command timeout set on the socket
+        tls_conn = self.tls.wrap_socket(self.conn, server_side=True)
+        if self.sessions is not None:
+            self.sessions.replace(self.conn, tls_conn)
+        self.conn = tls_conn
+        self.output = ReplyBuffer(tls_conn)
+        self.buffer = b""
+
+    def handle_login(self, tag, name, args, uid):
+        if len(args) != 2 or not all(isinstance(arg, str) for arg in args):
+            raise BadCommand("LOGIN <user> <password> expected")
+        if self.require_tls and not is_tls(self.conn):
+            self.send(f"{tag} NO [PRIVACYREQUIRED] Use STARTTLS first")
+            return
+        username, password = args
+        if password and password == storage.store.password(username):
+            self.username = username
+            self.state = IMAPState.AUTHENTICATED
+            self.send(f"{tag} OK LOGIN completed")
+        else:
+            self.send(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials")
+
+    def handle_select(self, tag, name, args, uid):
+        self.state = IMAPState.AUTHENTICATED
+        if len(args) != 1 or not isinstance(args[0], str):
+            raise BadCommand(f"{name} <mailbox> expected")
+        if args[0].upper() != "INBOX":
+            self.send(f"{tag} NO No such mailbox, there is only INBOX")
+            return
+        self.read_only = name == "EXAMINE"
+        self.load()
+        self.state = IMAPState.SELECTED
+        self.send(f"* FLAGS ({' '.join(SYSTEM_FLAGS)})")
+        self.send(f"* {len(self.uids)} EXISTS")
+        self.send("* 0 RECENT")
+        unseen = next((number for number, uid in enumerate(self.uids, start=1)
+                       if "\\Seen" not in self.flags[uid]), None)
+        if unseen is not None:
+            self.send(f"* OK [UNSEEN {unseen}] First unseen message")
+        permanent = "" if self.read_only else " ".join(SYSTEM_FLAGS) + " \\*"
+        self.send(f"* OK [PERMANENTFLAGS ({permanent})] Flags kept between sessions")
+        self.send(f"* OK [UIDVALIDITY {self.uidvalidity}] UIDs valid")
+        self.send(f"* OK [UIDNEXT {self.uidnext}] Predicted next UID")
+        self.send(f"{tag} OK [{'READ-ONLY' if self.read_only else 'READ-WRITE'}] {name} completed")
+
+    def handle_list(self, tag, name, args, uid):
+        if len(args) != 2 or not all(isinstance(arg, str) for arg in args):
+            raise BadCommand(f"{name} <reference> <mailbox> expected")
+        pattern = args[1]
+        if pattern == "" and name == "LIST":
+            self.send('* LIST (\\Noselect) "/" ""')
+        else:
+            regex = "".join(".*" if c in "*%" else re.escape(c) for c in pattern)
+            if re.fullmatch(regex, "INBOX", re.IGNORECASE):
+                self.send(f'* {name} (\\HasNoChildren) "/" INBOX')
+        self.send(f"{tag} OK {name} completed")
+
+    def handle_status(self, tag, name, args, uid):
+        if len(args) != 2 or not isinstance(args[0], str) or not isinstance(args[1], list):
+            raise BadCommand("STATUS <mailbox> (<items>) expected")
+        if args[0].upper() != "INBOX":
+            self.send(f"{tag} NO No such mailbox, there is only INBOX")
+            return
+        uidvalidity, uidnext, messages = storage.store.uids(self.username)
+        values = {"MESSAGES": len(messages), "RECENT": 0, "UIDNEXT": uidnext, "UIDVALIDITY": uidvalidity,
+                  "UNSEEN": sum(1 for _, _, flags in messages if "\\Seen" not in flags)}
+        items = [str(item).upper() for item in args[1]]
+        if any(item not in values for item in items):
+            raise BadCommand("unknown status item")
+        self.send(f"* STATUS INBOX ({' '.join(f'{item} {values[item]}' for item in items)})")
+        self.send(f"{tag} OK STATUS completed")
+
+    def handle_close(self, tag, name, args, uid):
+        deleted = self.deleted_uids()
+        if deleted and not self.read_only:
+            # Expunged silently, the client has left the mailbox
+            storage.store.remove_uids(self.username, deleted)
+            self.changed()
+        self.state = IMAPState.AUTHENTICATED
+        self.uids = []
+        self.send(f"{tag} OK CLOSE completed")
+
+    def handle_expunge(self, tag, name, args, uid):
+        if self.read_only:
+            self.send(f"{tag} NO Mailbox is read-only")
+            return
+        deleted = self.deleted_uids()
+        if deleted:
+            storage.store.remove_uids(self.username, deleted)
+            self.changed()
+        self.refresh()  # reports the EXPUNGEs
+        self.send(f"{tag} OK EXPUNGE completed")
+
+    def deleted_uids(self):
+        return [uid for uid in self.uids if "\\Deleted" in self.flags[uid]]
+
+    def load(self):
+        """Takes the current state of the mailbox as the client's view of it."""
+        self.uidvalidity, self.uidnext, messages = storage.store.uids(self.username)
+        self.uids = [uid for uid, _, _ in messages]
+        self.flags = {uid: flags for uid, _, flags in messages}
+        self.octets = {uid: octets for uid, octets, _ in messages}
+        self.sizes = {}
+
+    def refresh(self):
+        """Tells the client about messages removed, flags changed and mail delivered since it last looked."""
+        uidvalidity, uidnext, messages = storage.store.uids(self.username)
+        if uidvalidity != self.uidvalidity:
+            self.send("* BYE Mailbox was renumbered, please reconnect")
+            raise SessionEnd
+        current = {uid: flags for uid, _, flags in messages}
+        # From the end, so every number sent is still valid when the client applies it
+        for number in range(len(self.uids), 0, -1):
+            if self.uids[number - 1] not in current:
+                self.send(f"* {number} EXPUNGE")
+        self.uids = [uid for uid in self.uids if uid in current]
+        for number, uid in enumerate(self.uids, start=1):
+            if current[uid] != self.flags[uid]:
+                self.flags[uid] = current[uid]
+                self.send(f"* {number} FETCH (FLAGS {format_flags(current[uid])})")
+        known = set(self.uids)
+        for uid, octets, flags in messages:
+            if uid not in known:
+                self.uids.append(uid)
+                self.flags[uid] = flags
+                self.octets[uid] = octets
+        if len(self.uids) != len(known):
+            self.send(f"* {len(self.uids)} EXISTS")
+        self.flags = {uid: self.flags[uid] for uid in self.uids}
+        self.uidnext = uidnext
+
+    def changed(self):
+        """Lets the user's other sessions (IDLE) pick up a change made in this one."""
+        notify.new_mail([self.username])
+
+    def select_messages(self, sequence_set, uid):
+        """Returns the (number, uid) pairs a sequence set (a UID set with uid) names."""
+        if uid:
+            ranges = parse_sequence_set(sequence_set, self.uids[-1] if self.uids else 0)
+            return [(number, u) for number, u in enumerate(self.uids, start=1) if in_ranges(u, ranges)]
+        ranges = parse_sequence_set(sequence_set, len(self.uids))
+        return [(number, u) for number, u in enumerate(self.uids, start=1) if in_ranges(number, ranges)]
+
+    def handle_search(self, tag, name, args, uid):
+        if len(args) >= 2 and isinstance(args[0], str) and args[0].upper() == "CHARSET":
+            if not isinstance(args[1], str) or args[1].upper() not in ("UTF-8", "US-ASCII"):
+                self.send(f"{tag} NO [BADCHARSET (UTF-8 US-ASCII)] Unsupported charset")
+                return
+            args = args[2:]
+        if not args:
+            raise BadCommand("search criteria expected")
+        found = self.search(list(args))
+        if uid:
+            results = [u for u in self.uids if u in found]
+        else:
+            results = [number for number, u in enumerate(self.uids, start=1) if u in found]
+        self.send("* SEARCH" + "".join(f" {result}" for result in results))
+        self.send(f"{tag} OK {'UID ' if uid else ''}SEARCH completed")
+
+    def search(self, keys):
+        """Returns the UIDs matching all the search keys."""
+        found = set(self.uids)
+        while keys:
+            found &= self.search_key(keys)
+        return found
+
+    def search_key(self, keys):
+        """Evaluates (and removes) the first search key of keys."""
+        key = keys.pop(0)
+        if isinstance(key, list):
+            return self.search(key)
+        if key.isdigit() or is_sequence_set(key):
+            return {u for _, u in self.select_messages(key, False)}
+        key = key.upper()
+        everything = set(self.uids)
+        flag_keys = {"ANSWERED": "\\Answered", "DELETED": "\\Deleted", "DRAFT": "\\Draft", "FLAGGED": "\\Flagged",
+                     "SEEN": "\\Seen"}
+        if key in ("ALL", "OLD"):
+            return everything
+        if key in ("NEW", "RECENT"):
+            return set()  # no message is ever \Recent
+        if key in flag_keys:
+            return {u for u in self.uids if flag_keys[key] in self.flags[u]}
+        if key.startswith("UN") and key[2:] in flag_keys:
+            return {u for u in self.uids if flag_keys[key[2:]] not in self.flags[u]}
+        if key == "NOT":
+            return everything - self.search_key(self.argument(keys, key))
+        if key == "OR":
+            if len(keys) < 2:
+                raise BadCommand("OR needs two search keys")
+            return self.search_key(keys) | self.search_key(keys)
+        if key == "UID":
+            return {u for _, u in self.select_messages(self.argument(keys, key)[0], True)}
+        if key in ("KEYWORD", "UNKEYWORD"):
+            keyword = str(self.argument(keys, key)[0])
+            having = {u for u in self.uids if keyword in self.flags[u]}
+            return having if key == "KEYWORD" else everything - having
+        if key in ("FROM", "TO", "CC", "BCC", "SUBJECT"):
+            text = str(self.argument(keys, key)[0])
+            return set(storage.store.search(self.username, key.lower(), text, by_uid=True))
+        if key == "HEADER":
+            if len(keys) < 2:
+                raise BadCommand("HEADER <field> <string> expected")
+            header, text = str(keys.pop(0)).lower(), str(keys.pop(0))
+            return set(storage.store.search(self.username, header, text, by_uid=True))
+        if key in ("BEFORE", "ON", "SINCE", "SENTBEFORE", "SENTON", "SENTSINCE"):
+            # Messages carry no Date: header of their own, sent and received dates are the same
+            date = parse_date(self.argument(keys, key)[0])
+            key = key.removeprefix("SENT")
+            since = date if key in ("ON", "SINCE") else None
+            before = date if key == "BEFORE" else date + datetime.timedelta(days=1) if key == "ON" else None
+            return set(storage.store.search(self.username, since=since, before=before, by_uid=True))
+        if key in ("LARGER", "SMALLER"):
+            size = self.argument(keys, key)[0]
+            if not str(size).isdigit():
+                raise BadCommand(f"{key} <number> expected")
+            if key == "LARGER":
+                return {u for u in self.uids if self.octets[u] > int(size)}
+            return {u for u in self.uids if self.octets[u] < int(size)}
+        if key in ("BODY", "TEXT"):
+            return self.search_content(str(self.argument(keys, key)[0]).lower(), key == "TEXT")
+        raise BadCommand(f"unsupported search key {key}")
+
+    @staticmethod
+    def argument(keys, key):
+        if not keys:
+            raise BadCommand(f"{key} needs an argument")
+        return [keys.pop(0)]
+
+    def search_content(self, text, with_header):
+        """Returns the UIDs of the messages whose body (and header, with_header) contains text."""
+        found = set()
+        wanted = set(self.uids)
+        with storage.store.open_mailbox(self.username) as mailbox:
+            for number, u in enumerate(mailbox.uids() or [], start=1):
+                if u not in wanted:
+                    continue
+                header, body = split_message(mailbox.message(number))
+                content = header + body if with_header else body
+                if text in content.decode("utf-8", "replace").lower():
+                    found.add(u)
+        return found
+
+    def handle_fetch(self, tag, name, args, uid):
+        if len(args) != 2:
+            raise BadCommand("FETCH <set> <items> expected")
+        items = parse_fetch_items(args[1])
+        if uid and not any(item[0] == "UID" for item in items):
+            items.insert(0, ("UID", None, None, True))
+        needs_text = any(item[0] in ("RFC822.SIZE", "RFC822", "RFC822.TEXT", "BODY", "BODYSTRUCTURE")
+                         or (item[0] == "SECTION" and not item[1].startswith("HEADER")) for item in items)
+        needs_content = needs_text or any(item[0] in ("INTERNALDATE", "RFC822.HEADER", "SECTION") for item in items)
+        selected = self.select_messages(args[0], uid)
+        seen = {}
+        for start in range(0, len(selected), FETCH_BATCH):
+            batch = selected[start:start + FETCH_BATCH]
+            contents = {}
+            if needs_content:
+                # Read under the lock, sent after it is released
+                with storage.store.open_mailbox(self.username) as mailbox:
+                    numbers = {u: number for number, u in enumerate(mailbox.uids() or [], start=1)}
+                    for _, u in batch:
+                        if u in numbers:
+                            contents[u] = self.read_message(mailbox, numbers[u], needs_text)
+            for number, u in batch:
+                if needs_content and u not in contents:
+                    continue  # removed by another session meanwhile
+                response = self.fetch_response(number, u, items, contents.get(u), seen)
+                self.send_bytes(response)
+        if seen:
+            storage.store.set_flags(self.username, seen)
+            self.changed()
+        self.send(f"{tag} OK {'UID ' if uid else ''}FETCH completed")
+
+    @staticmethod
+    def read_message(mailbox, number, needs_text):
+        """Returns (header, text) of a message, text None when needs_text is not set."""
+        if not needs_text:
+            parts = split_message(mailbox.message_head(number, HEAD_LIMIT), complete=False)
+            if parts is not None:
+                return parts
+        return split_message(mailbox.message(number))
+
+    def fetch_response(self, number, uid, items, parts, seen):
+        fields = []
+        flags_sent = False
+        for kind, section, partial, peek in items:
+            if kind == "UID":
+                fields.append(f"UID {uid}".encode("ascii"))
+            elif kind == "FLAGS":
+                flags_sent = True
+            elif kind == "INTERNALDATE":
+                fields.append(f"INTERNALDATE {format_internaldate(parse_received(parts[0]))}".encode("ascii"))
+            elif kind == "RFC822.SIZE":
+                fields.append(f"RFC822.SIZE {self.size(uid, parts)}".encode("ascii"))
+            elif kind in ("BODY", "BODYSTRUCTURE"):
+                size, lines = len(parts[1]), parts[1].count(b"\n")
+                fields.append(f'{kind} ("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "8BIT" {size} {lines})'.encode("ascii"))
+            else:
+                if kind == "RFC822":
+                    data = parts[0] + parts[1]
+                elif kind == "RFC822.HEADER":
+                    data = parts[0]
+                elif kind == "RFC822.TEXT":
+                    data = parts[1]
+                else:
+                    data = self.section(parts, section)
+                    kind = f"BODY[{section}]"
+                    if partial is not None:
+                        kind += f"<{partial[0]}>"
+                        data = data[partial[0]:partial[0] + partial[1]]
+                fields.append(kind.encode("ascii") + b" " + literal(data))
+                if not peek and not self.read_only and "\\Seen" not in self.flags[uid]:
+                    self.flags[uid] = self.flags[uid] | {"\\Seen"}
+                    seen[uid] = self.flags[uid]
+                    flags_sent = True
+        if flags_sent:
+            fields.append(f"FLAGS {format_flags(self.flags[uid])}".encode("ascii"))
+        return f"* {number} FETCH (".encode("ascii") + b" ".join(fields) + b")\r\n"
+
+    def size(self, uid, parts):
+        if uid not in self.sizes:
+            self.sizes[uid] = len(parts[0]) + len(parts[1])
+        return self.sizes[uid]
+
+    @staticmethod
+    def section(parts, section):
+        header, text = parts
+        if section == "":
+            return header + text
+        if section == "HEADER":
+            return header
+        if section in ("TEXT", "1"):
+            return text
+        exclude, names = HEADER_FIELDS.match(section).groups()
+        return filter_header(header, {name.strip('"').lower() for name in names.split()}, exclude is not None)
+
+    def handle_store(self, tag, name, args, uid):
+        if len(args) < 3 or not isinstance(args[1], str):
+            raise BadCommand("STORE <set> <FLAGS|+FLAGS|-FLAGS>[.SILENT] <flags> expected")
+        action = args[1].upper()
+        silent = action.endswith(".SILENT")
+        action = action.removesuffix(".SILENT")
+        if action not in ("FLAGS", "+FLAGS", "-FLAGS"):
+            raise BadCommand(f"unknown STORE action {args[1]}")
+        flags = args[2] if isinstance(args[2], list) and len(args) == 3 else args[2:]
+        if not all(isinstance(flag, str) for flag in flags):
+            raise BadCommand("flags expected")
+        flags = set(self.normalise_flag(flag) for flag in flags)
+        if self.read_only:
+            self.send(f"{tag} NO Mailbox is read-only")
+            return
+        changes = {}
+        for number, u in self.select_messages(args[0], uid):
+            if action == "FLAGS":
+                new = frozenset(flags)
+            elif action == "+FLAGS":
+                new = self.flags[u] | flags
+            else:
+                new = self.flags[u] - flags
+            if new != self.flags[u]:
+                changes[u] = new
+                self.flags[u] = new
+            if not silent:
+                self.send(f"* {number} FETCH ({f'UID {u} ' if uid else ''}FLAGS {format_flags(new)})")
+        if changes:
+            storage.store.set_flags(self.username, changes)
+            self.changed()
+        self.send(f"{tag} OK {'UID ' if uid else ''}STORE completed")
+
+    @staticmethod
+    def normalise_flag(flag):
+        if flag.startswith("\\"):
+            for system_flag in SYSTEM_FLAGS:
+                if flag.lower() == system_flag.lower():
+                    return system_flag
+            raise BadCommand(f"cannot store flag {flag}")
+        if not re.fullmatch(r"[^\s(){%*\"\\\]]+", flag):
+            raise BadCommand(f"invalid keyword {flag}")
+        return flag
+
+    def handle_idle(self, tag, name, args, uid):
+        """Reports mailbox changes as they happen until the client sends DONE (RFC 2177)."""
+        # Subscribing before looking at the mailbox means no change slips in between unnoticed
+        with notify.subscribe(self.username) as subscription:
+            self.refresh()
+            self.send("+ idling")
+            poller = select.poll()
+            poller.register(self.conn, select.POLLIN)
+            poller.register(subscription, select.POLLIN)
+            deadline = time.monotonic() + self.idle_timeout if self.idle_timeout else None
+            while b"\n" not in self.buffer:
+                self.flush()
+                if self.draining is not None and self.draining.is_set():
+                    self.send("* BYE IMAP server shutting down")
+                    raise SessionEnd
+                wait = POLL_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.send("* BYE Autologout, idle for too long")
+                        raise SessionEnd
+                    wait = min(wait, remaining)
+                if is_tls(self.conn) and self.conn.pending():
+                    ready = {self.conn.fileno()}
+                else:
+                    ready = {fd for fd, _ in poller.poll(wait * 1000)}
+                if subscription.fileno() in ready:
+                    subscription.clear()
+                    self.refresh()
+                if self.conn.fileno() in ready:
+                    data = self.conn.recv(self.recv_size)
+                    if not data:
+                        raise SessionEnd  # Client disconnected
+                    self.buffer += data
+        line = self.read_line()
+        if line is not None and line.strip().upper() == b"DONE":
+            self.send(f"{tag} OK IDLE terminated")
+        else:
+            self.send(f"{tag} BAD DONE expected")
+
+
+def serve(server_socket, idle_timeout=IMAP_IDLE_TIMEOUT, command_timeout=DEFAULT_COMMAND_TIMEOUT,
+          max_sessions=DEFAULT_MAX_SESSIONS, drain_timeout=DEFAULT_DRAIN_TIMEOUT, recv_size=DEFAULT_RECV_SIZE,
+          limits=None, tls=None, require_tls=False):
+    print(f"IMAP Server running on port {server_socket.getsockname()[1]}...")
+    install_profiler_signal()
+    sessions = SessionRegistry(max_sessions)
+    try:
+        while True:
+            c, addr = server_socket.accept()
+            if limits is not None and not limits.allow_connection(addr[0]):
+                reject(c, "* BYE Too many connections from your address, try again later")
+                continue
+            if not sessions.add(c):
+                reject(c, "* BYE Too many connections, try again later")
+                continue
+            print(f"IMAP connection established with {addr}")
+            session = IMAPSession(c, addr, idle_timeout, command_timeout, recv_size, sessions.draining, limits, tls,
+                                  require_tls, sessions)
+            threading.Thread(target=session.handle_client).start()
+    except KeyboardInterrupt:
+        print("\nShutting down the IMAP server.")
+    finally:
+        server_socket.close()
+        notify.stop_listener()
+        if len(sessions):
+            print(f"Draining {len(sessions)} open sessions...")
+        leftover = sessions.drain(drain_timeout)
+        if leftover:
+            print(f"Closed {leftover} sessions that did not finish in time.")
+
+
+def main():
+    parser = argparse.ArgumentParser(usage="python imap_server.py [<IMAP_port>] [--workers N] [--config FILE]")
+    parser.add_argument("port", type=int, nargs="?", default=IMAP_PORT)
+    add_worker_arguments(parser)
+    config.add_mail_arguments(parser)
+    add_session_arguments(parser, default_idle_timeout=IMAP_IDLE_TIMEOUT)
+    add_profiling_arguments(parser)
+    add_rate_limit_arguments(parser, "user")
+    add_tls_arguments(parser)
+    parser.add_argument("--require-tls", action="store_true", help="refuse LOGIN until the client has used STARTTLS")
+    args = config.parse_args(parser, "imap")
+    config.apply_mail_options(args)
+    apply_profiling_options(args)
+    options = session_options(args)
+    options["limits"] = rate_limit_options(args)
+    options["tls"] = tls_options(args)
+    if args.require_tls and options["tls"] is None:
+        parser.error("--require-tls needs --tls-cert")
+    options["require_tls"] = args.require_tls
+    if args.workers > 1:
+        run_workers(functools.partial(serve, **options), args.port, args.workers, args.backlog)
+    else:
+        handle_sigterm()
+        serve(create_listener(args.port, args.backlog), **options)
+
+
+if __name__ == "__main__":
+    main()
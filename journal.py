@@ -0,0 +1,277 @@
+"""
+journal.py
+----------
+Write-ahead delivery journal for the SMTP server.
+Accepted messages are appended to a journal file and acknowledged only once that file has been
+fsynced. Messages arriving while an fsync is running are gathered and committed together (group
+commit), so one fsync covers many deliveries. Committed messages are then appended to the
+mailboxes by a background thread, which fsyncs the mailboxes and marks the messages as applied.
+Each server process owns its own journal file (journal-<pid>-<time>.log) and holds a lock on it.
+At startup, journals no longer locked by a live process are replayed and removed, so mail that
+was acknowledged but not yet in a mailbox when a server crashed still gets delivered.
+Replay is at-least-once: a crash between a mailbox append and its applied mark delivers that
+message twice rather than losing it. A journal whose write fails is not written to again (a torn
+record would hide the ones behind it from replay): every later delivery is refused with
+JournalError until the server is restarted.
+
+Journal records:
+   D <seq> <length> <crc32>\\n<JSON payload>\\n   message to deliver
+   A <seq> [<seq> ...]\\n                       messages that are in their mailboxes
+"""
+
+import fcntl
+import glob
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+import notify
+import storage
+
+DEFAULT_COMMIT_INTERVAL = 0.002
+MAX_JOURNAL_SIZE = 64 * 1024 * 1024
+APPLY_RETRY_DELAY = 1
+CLOSING_APPLY_ATTEMPTS = 3  # once the server is shutting down, then the journal is kept for replay
+
+
+class JournalError(Exception):
+    pass
+
+
+def encode_delivery(seq, message, usernames, compression):
+    payload = json.dumps({"message": message, "users": usernames, "compression": compression}).encode("utf-8")
+    return b"D %d %d %08x\n" % (seq, len(payload), zlib.crc32(payload)) + payload + b"\n"
+
+
+def read_journal(data):
+    """Parses journal contents, returns ({seq: delivery}, applied seqs).
+
+    Parsing stops at the first torn or corrupt record, which can only be the last one written.
+    """
+    deliveries = {}
+    applied = set()
+    pos = 0
+    while pos < len(data):
+        line_end = data.find(b"\n", pos)
+        if line_end == -1:
+            break
+        fields = data[pos:line_end].split()
+        try:
+            if fields[0] == b"A":
+                applied.update(int(seq) for seq in fields[1:])
+                pos = line_end + 1
+            elif fields[0] == b"D":
+                seq, length, crc = int(fields[1]), int(fields[2]), int(fields[3], 16)
+                payload = data[line_end + 1:line_end + 1 + length]
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    break
+                deliveries[seq] = json.loads(payload)
+                pos = line_end + 1 + length + 1
+            else:
+                break
+        except (IndexError, ValueError):
+            break
+    return deliveries, applied
+
+
+def apply_deliveries(deliveries):
+    """Stores (message, usernames, compression) deliveries, batching per mailbox.
+
+    Every touched mailbox is fsynced before this returns.
+    """
+    batches = {}
+    for message, usernames, compression in deliveries:
+        for username in usernames:
+            batches.setdefault((username, compression), []).append(message)
+    for (username, compression), messages in batches.items():
+        storage.store.deliver(username, messages, compression, fsync=True)
+    notify.new_mail({username for username, _ in batches})
+
+
+def delivery_users(delivery):
+    if "users" in delivery:
+        return delivery["users"]
+    # Journals written by older servers name mailbox files (<mail root>/<ab>/<cd>/<username>/my_mailbox.txt)
+    return [os.path.basename(os.path.dirname(path)) for path in delivery["mailboxes"]]
+
+
+def recover_journals(directory):
+    """Replays and removes the journals of processes that are no longer running.
+
+    Returns the number of messages that were delivered from them.
+    """
+    recovered = 0
+    for path in sorted(glob.glob(os.path.join(directory, "journal-*.log"))):
+        # Forked workers recover at the same time; whoever holds the lock on a journal still
+        # under its name replays it, for the others it is owned or already gone
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # owned by a running server, or being recovered
+            try:
+                if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                    continue
+            except FileNotFoundError:
+                continue  # recovered and removed while this process waited to open it
+            deliveries, applied = read_journal(f.read())
+            pending = [deliveries[seq] for seq in sorted(deliveries) if seq not in applied]
+            apply_deliveries((d["message"], delivery_users(d), d["compression"]) for d in pending)
+            os.remove(path)
+            recovered += len(pending)
+    return recovered
+
+
+class DeliveryJournal:
+    """Group-committed write-ahead journal owned by one server process."""
+
+    def __init__(self, directory, commit_interval=DEFAULT_COMMIT_INTERVAL):
+        os.makedirs(directory, exist_ok=True)
+        recovered = recover_journals(directory)
+        if recovered:
+            print(f"Recovered {recovered} messages from the delivery journal.")
+        self.commit_interval = commit_interval
+        self.path = os.path.join(directory, f"journal-{os.getpid()}-{int(time.time() * 1000)}.log")
+        # Lock the journal (telling recovery it is in use) before giving it a name recovery looks for
+        self._file = open(self.path + ".new", "ab")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        os.rename(self.path + ".new", self.path)
+
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._seq = 0
+        self._committed_seq = 0
+        self._failed_seqs = set()
+        self._unapplied = 0
+        self._closing = False
+        self._broken = False
+        self._apply_queue = queue.Queue()
+
+        self._committer = threading.Thread(target=self._commit_loop, name="journal-commit")
+        self._applier = threading.Thread(target=self._apply_loop, name="journal-apply")
+        self._committer.start()
+        self._applier.start()
+
+    def submit(self, message, usernames, compression=None):
+        """Journals a message for the given users and returns once it is on disk.
+
+        Raises JournalError if the journal could not be written.
+        """
+        with self._cond:
+            if self._closing:
+                raise JournalError("journal is closed")
+            if self._broken:
+                raise JournalError("the delivery journal failed earlier, restart the server")
+            self._seq += 1
+            seq = self._seq
+            self._pending.append((seq, message, usernames, compression))
+            self._cond.notify_all()
+            while self._committed_seq < seq:
+                self._cond.wait()
+            if seq in self._failed_seqs:
+                self._failed_seqs.discard(seq)
+                raise JournalError("could not write the delivery journal")
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            # Give concurrent deliveries a moment to join this commit
+            time.sleep(self.commit_interval)
+            with self._cond:
+                batch = self._pending
+                self._pending = []
+            try:
+                if self._broken:
+                    raise JournalError("journal failed earlier")
+                with self._write_lock:
+                    self._file.write(b"".join(encode_delivery(*item) for item in batch))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._unapplied += len(batch)
+            except Exception as e:
+                # Whatever went wrong, the waiting sessions are answered and no record goes after a torn one
+                print(f"Delivery journal write failed, refusing deliveries until a restart: {e}")
+                with self._cond:
+                    self._broken = True
+                    self._failed_seqs.update(item[0] for item in batch)
+            else:
+                for item in batch:
+                    self._apply_queue.put(item)
+            with self._cond:
+                self._committed_seq = batch[-1][0]
+                self._cond.notify_all()
+
+    def _apply_loop(self):
+        while True:
+            item = self._apply_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while True:
+                try:
+                    item = self._apply_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._apply_queue.put(None)  # stop after this batch
+                    break
+                batch.append(item)
+            try:
+                self._apply(batch)
+            except Exception as e:
+                # Not marked applied, so the journal is kept and the next start replays them
+                print(f"Applying journaled deliveries failed, left for recovery: {e}")
+
+    def _apply(self, batch):
+        closing_attempts = 0
+        while True:
+            try:
+                apply_deliveries((message, usernames, compression) for _, message, usernames, compression in batch)
+                break
+            except (OSError, sqlite3.Error) as e:
+                # The messages stay in the journal; keep trying, recovery takes over after a crash.
+                # Shutting down only waits for a few more attempts, then close() keeps the journal.
+                if self._closing:
+                    closing_attempts += 1
+                    if closing_attempts >= CLOSING_APPLY_ATTEMPTS:
+                        raise
+                print(f"Applying journaled deliveries failed, retrying: {e}")
+                time.sleep(APPLY_RETRY_DELAY)
+        with self._write_lock:
+            self._file.write(b"A " + b" ".join(b"%d" % item[0] for item in batch) + b"\n")
+            self._file.flush()
+            self._unapplied -= len(batch)
+            if self._unapplied == 0 and self._file.tell() > MAX_JOURNAL_SIZE:
+                # Everything written so far is in the mailboxes, start over
+                self._file.truncate(0)
+                self._file.seek(0)
+
+    def close(self):
+        """Commits and applies everything still in flight, then removes the journal.
+
+        A journal with messages that could not be applied is kept, for the next start to replay.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._committer.join()
+        self._apply_queue.put(None)
+        self._applier.join()
+        if self._unapplied:
+            print(f"Keeping {self.path}, {self._unapplied} journaled messages are not in their mailboxes yet.")
+        else:
+            os.remove(self.path)
+        self._file.close()
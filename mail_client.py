@@ -6,37 +6,66 @@ A client program that connects to the SMTP and POP3 servers running on the MailS
 It provides three options:
    a) Mail Sending – composes and sends an email via the SMTP server.
    b) Mail Management – connects to the POP3 server, authenticates, and lets the user manage mails.
-   c) Mail Searching – downloads emails and searches them based on keyword, time, or address.
-Usage: python mail_client.py <server_IP>
-For this example, default ports are assumed:
+   c) Mail Searching – searches the downloaded emails on keyword, date range and address at once.
+Usage: python mail_client.py [<server_IP>] [--terminal] [--smtp-port PORT] [--pop-port PORT] [--imap-port PORT]
+                             [--index-dir DIR] [--tls [--cafile FILE]] [--config FILE]
+       python mail_client.py {send,list,fetch,search,delete,sync} --user NAME [--password PASSWORD] [--server IP] ...
+The first form opens the GUI (the interactive terminal client with --terminal). The second runs
+one headless command, for scripts: results are printed as JSON lines as they come, --batch reads
+input as JSON lines (e.g. the output of search piped into delete), tkinter is never imported, and
+the exit status is 1 when the command failed.
+Unless configured otherwise ([client] section of the settings file), default ports are assumed:
    SMTP port: 2525
    POP3 port: 1100
+   IMAP port: 1430
+With --tls every connection is upgraded (STARTTLS/STLS) before anything else is sent, and the
+TLS session of the previous connection to the same server is resumed.
+After login the GUI keeps a POP3 IDLE connection open and refreshes the mailbox as soon as the
+server reports new mail, so nothing polls the server.
+Searches run against a local index of the downloaded messages (mail_index.py), which is synced
+over IMAP at login and whenever new mail arrives, so they never wait for the network.
 """
 
+import argparse
+import contextlib
+import datetime
+import json
+import os
 import socket
+import sqlite3
 import sys
-import tkinter as tk
-from tkinter import messagebox, scrolledtext
-import tkinter.font as tkFont
-import socket
+import threading
+import time
+
+import config
+from mail_index import DEFAULT_INDEX_DIR, MailIndex, format_received, index_path, parse_message
+
+SMTP_PORT = 2525
+POP3_PORT = 1100
+IMAP_PORT = 1430
+RECV_SIZE = 1024 # bytes read from the servers at a time
+TLS = None # ClientTLS when connections are upgraded to TLS (--tls)
+WATCH_RETRY = 30 # seconds before the new-mail watcher reconnects after losing its connection
+INDEX_DIR = DEFAULT_INDEX_DIR # where the local search indexes are kept (--index-dir)
+tk = messagebox = scrolledtext = tkFont = None # tkinter, imported by load_tkinter() for the GUI only
 
 class MailClient:
     
-    def __init__(self, server_ip, smtp_port, pop_port):
+    def __init__(self, server_ip, smtp_port, pop_port, imap_port=None):
         self.server_ip = server_ip
         self.smtp_port = smtp_port
         self.pop_port = pop_port
+        self.imap_port = IMAP_PORT if imap_port is None else imap_port
 
     def validate_password(self) -> bool:
-        s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        s.connect((self.server_ip, self.pop_port))
-        s.recv(1024)  # greeting
+        s, _ = open_connection(self.server_ip, self.pop_port)
         s.sendall(f"USER {self.username}\r\n".encode('utf-8'))
-        s.recv(1024) # ok message (username always ok)
+        s.recv(RECV_SIZE) # ok message (username always ok)
         s.sendall(f"PASS {self.password}\r\n".encode('utf-8'))
-        auth_resp = s.recv(1024).decode('utf-8').strip() # logged in or not message
-        s.sendall("QUIT".encode('utf-8'))
-        s.recv(1024) # goodbye message
+        auth_resp = s.recv(RECV_SIZE).decode('utf-8').strip() # logged in or not message
+        s.sendall("QUIT\r\n".encode('utf-8'))
+        s.recv(RECV_SIZE) # goodbye message
+        close_connection(s)
         return auth_resp.startswith("+OK")
 
     def authenticate(self) -> None:
@@ -90,7 +119,7 @@ class MailClient:
             if line.strip() == ".":
                 break
             lines.append(line)
-        mail_text = "\r\n".join(lines)
+        mail_text = "\r\n".join(dot_stuff(lines))
         
         # Simple format validation using regex (checking headers exist)
         if not lines[0][:6] == "From: " or not self.is_valid_email(lines[0][6:]):
@@ -104,46 +133,44 @@ class MailClient:
             return
         
         mail_from = lines[0][6:]
-        if mail_from.split("@")[0] != self.username or mail_from.split("@")[1] != "swmgmail.com":
+        if mail_from.split("@")[0] != self.username or mail_from.split("@")[1] != config.domain:
             print("Can't send mails from other email address")
             return
         rcpt_to = lines[1][4:]
-        if rcpt_to.split("@")[1] != "swmgmail.com":
+        if rcpt_to.split("@")[1] != config.domain:
             print("Can currently only send emails to other swmgmail accounts")
             return
 
         try:
-            s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            s.connect((self.server_ip, self.smtp_port))
-            s.recv(1024) # ready message
+            s, _ = open_connection(self.server_ip, self.smtp_port, smtp=True)
 
             # SMTP dialogue
             s.sendall(b"HELO client\r\n")
-            s.recv(1024)
+            s.recv(RECV_SIZE)
 
             # Extract sender and recipient from mail text
             s.sendall(f"MAIL FROM:<{mail_from}>\r\n".encode())
-            s.recv(1024)
+            s.recv(RECV_SIZE)
 
             s.sendall(f"RCPT TO:<{rcpt_to}>\r\n".encode())
-            response = s.recv(1024).decode("utf-8").strip()
+            response = s.recv(RECV_SIZE).decode("utf-8").strip()
             if response.startswith("550"):
                 print("Receiver doesn't exist")
                 s.sendall(b"QUIT\r\n")
-                s.recv(1024)
-                s.close()
+                s.recv(RECV_SIZE)
+                close_connection(s)
                 return
 
             s.sendall(b"DATA\r\n")
-            s.recv(1024)
+            s.recv(RECV_SIZE)
 
             # Send the mail text followed by the termination sequence
             s.sendall((mail_text + "\r\n.\r\n").encode("utf-8"))
-            s.recv(1024)
+            s.recv(RECV_SIZE)
 
             s.sendall(b"QUIT\r\n")
-            s.recv(1024)
-            s.close()
+            s.recv(RECV_SIZE)
+            close_connection(s)
             print("Mail sent successfully.\n")
         except Exception as e:
             print("Error sending mail:", e)
@@ -151,14 +178,14 @@ class MailClient:
     def manage_mail(self):
         s = self.start_pop_session()
 
-        s.sendall(b'STAT') #get the amount of emails
-        stats = s.recv(1024).decode("utf-8")
+        s.sendall(b'STAT\r\n') #get the amount of emails
+        stats = s.recv(RECV_SIZE).decode("utf-8")
         amnt = stats.split(' ')[1]
         amnt = int(amnt)
 
         for i in range(1, amnt + 1):
-            s.sendall(f'RETR {i}'.encode('utf-8'))
-            content = s.recv(1024).decode("utf-8")
+            s.sendall(f'RETR {i}\r\n'.encode('utf-8'))
+            content = s.recv(RECV_SIZE).decode("utf-8")
             summary = summarize_mail(content)
             print(f"{i} {summary}")
 
@@ -172,66 +199,72 @@ class MailClient:
                 print("6) Save changes and quit")
                 choice = input("Enter your choice: ")
                 if choice == "1":
-                    s.sendall(b'STAT') #get the amount of emails
-                    stats = s.recv(1024).decode("utf-8")
+                    s.sendall(b'STAT\r\n') #get the amount of emails
+                    stats = s.recv(RECV_SIZE).decode("utf-8")
                     print(stats)
                 elif choice == "2":
                     emailno = input('What email would you like to get statistics of? (leave empty for list of all emails)\n')
                     if emailno == '':
-                        s.sendall(b'LIST')
-                        stats = s.recv(1024).decode("utf-8")
+                        s.sendall(b'LIST\r\n')
+                        stats = s.recv(RECV_SIZE).decode("utf-8")
                         print(stats)
                     else:
-                        s.sendall(f'LIST {emailno}'.encode())
-                        stats = s.recv(1024).decode("utf-8")
+                        s.sendall(f'LIST {emailno}\r\n'.encode())
+                        stats = s.recv(RECV_SIZE).decode("utf-8")
                         print(stats)
                 elif choice == "3":
                     emailno = input('What email would you like to retrieve?\n')
-                    s.sendall(f'RETR {emailno}'.encode())
-                    mail = s.recv(1024).decode("utf-8")
+                    s.sendall(f'RETR {emailno}\r\n'.encode())
+                    mail = s.recv(RECV_SIZE).decode("utf-8")
                     print(f'\n{mail}')
                 elif choice == "4":
                     emailno = input('What email would you like to delete?\n')
-                    s.sendall(f'DELE {emailno}'.encode())
-                    response = s.recv(1024).decode("utf-8")
+                    s.sendall(f'DELE {emailno}\r\n'.encode())
+                    response = s.recv(RECV_SIZE).decode("utf-8")
                     print(response)
                 elif choice == "5":
-                    s.sendall(b'RSET')
-                    response = s.recv(1024).decode('utf-8')
+                    s.sendall(b'RSET\r\n')
+                    response = s.recv(RECV_SIZE).decode('utf-8')
                     print(response)
                 elif choice == "6":
-                    s.sendall(b'QUIT')
-                    response = s.recv(1024).decode('utf-8')
+                    s.sendall(b'QUIT\r\n')
+                    response = s.recv(RECV_SIZE).decode('utf-8')
                     print(response)
                     break
                 else:
                     print("Invalid option. Please try again.")
 
     def search_mail(self):
-        s = self.start_pop_session()
+        with MailIndex(index_path(INDEX_DIR, self.username, self.server_ip, self.imap_port)) as index:
+            try:
+                update_index(index, self.server_ip, self.imap_port, self.pop_port, self.username, self.password)
+            except OSError as e:
+                print("Could not update the search index, searching the mail downloaded before:", e)
 
-        while True:
-            print("\nSearching Options:")
-            print("1) Search for words/sentences")
-            print("2) Search for date")
-            print("3) Search for emailadress")
-            print("4) Exit")
-            choice = input("Enter your choice: ")
-            if choice == '1':
-                query = input('Enter query: ')
-                self.search_query(query, s)
-            elif choice == '2':
-                date = input('Enter date (in MM/DD/YY): ')
-                self.search_date(date, s)
-            elif choice == '3':
-                adress = input('Enter emailaddress: ')
-                self.search_adress(adress, s)
-            elif choice == '4':
-                s.sendall(b'QUIT')
-                s.recv(1024)
-                break
-            else:
-                print('Invalid option. Please try again.')
+            while True:
+                print("\nSearching Options:")
+                print("1) Search for words/sentences")
+                print("2) Search for date")
+                print("3) Search for emailadress")
+                print("4) Exit")
+                choice = input("Enter your choice: ")
+                if choice == '1':
+                    query = input('Enter query: ')
+                    self.print_results(index.search(text=query))
+                elif choice == '2':
+                    date = input('Enter date (in MM/DD/YYYY): ')
+                    self.print_results(index.search(received=date))
+                elif choice == '3':
+                    adress = input('Enter emailaddress: ')
+                    self.print_results(index.search(address=adress))
+                elif choice == '4':
+                    break
+                else:
+                    print('Invalid option. Please try again.')
+
+    def print_results(self, results):
+        for number, sender, recipient, subject, received in results:
+            print(f'{number}. From: {sender} To: {recipient} Received: {received} Subject: {subject}')
 
     def summarize_mail(self, content):
         lines = content.split("\n")
@@ -240,14 +273,6 @@ class MailClient:
         subject = next((line.split(": ")[1] for line in lines if line.startswith("Subject:")), "No Subject")
         return f"From: {sender} Received: {received} Subject: {subject}"
     
-    def summarize_mail_with_recipient(self, content):
-        lines = content.split("\n")
-        sender = next((line.split(": ")[1] for line in lines if line.startswith("From:")), "Unknown")
-        recipient = next((line.split(": ")[1] for line in lines if line.startswith("To:")), "Unknown")
-        received = next((line.split(": ")[1] + ": " + line.split(": ")[2] for line in lines if line.startswith("Received:")), "Unknown")
-        subject = next((line.split(": ")[1] for line in lines if line.startswith("Subject:")), "No Subject")
-        return f"From: {sender} To: {recipient} Received: {received} Subject: {subject}"
-    
     def start_pop_session(self):
         authenticated = False
         while not authenticated:
@@ -257,58 +282,17 @@ class MailClient:
                 self.authenticate
         
         #start POP3 session
-        s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        s.connect((self.server_ip, self.pop_port))
-        greeting = s.recv(1024).decode("utf-8")
+        s, greeting = open_connection(self.server_ip, self.pop_port)
         print(greeting)
         s.sendall(f"USER {self.username}\r\n".encode('utf-8'))
-        s.recv(1024) # ok message (username always ok)
+        s.recv(RECV_SIZE) # ok message (username always ok)
         s.sendall(f"PASS {self.password}\r\n".encode('utf-8'))
-        s.recv(1024) # ok message since login has been checked
+        s.recv(RECV_SIZE) # ok message since login has been checked
         return s
-    
-    def search_query(self, query, s):
-        s.sendall(b'STAT') #get the amount of emails
-        stats = s.recv(1024).decode("utf-8")
-        amnt = stats.split(' ')[1]
-        amnt = int(amnt)
-
-        for i in range(1, amnt + 1):
-            s.sendall(f'RETR {i}'.encode('utf-8'))
-            content = s.recv(1024).decode()
-            if query in content:
-                print(f'{i}. {self.summarize_mail_with_recipient(content)}')
-
-    def search_date(self, date, s):
-        s.sendall(b'STAT') #get the amount of emails
-        stats = s.recv(1024).decode("utf-8")
-        amnt = stats.split(' ')[1]
-        amnt = int(amnt)
-
-        for i in range(1, amnt + 1):
-            s.sendall(f'RETR {i}'.encode('utf-8'))
-            content = s.recv(1024).decode()
-            dateline = content.split('\n')[4]
-            if date in dateline:
-                print(f'{i}. {self.summarize_mail_with_recipient(content)}')
-
-    def search_adress(self, adress, s):
-        s.sendall(b'STAT') #get the amount of emails
-        stats = s.recv(1024).decode("utf-8")
-        amnt = stats.split(' ')[1]
-        amnt = int(amnt)
-
-        for i in range(1, amnt + 1):
-            s.sendall(f'RETR {i}'.encode('utf-8'))
-            content = s.recv(1024).decode()
-            fromLine = content.split('\n')[1]
-            toLine = content.split('\n')[2]
-            if adress in fromLine or adress in toLine:
-                print(f'{i}. {self.summarize_mail_with_recipient(content)}')
 
 
 class MailClientGUI:
-    def __init__(self, root, server_ip, smtp_port, pop_port):
+    def __init__(self, root, server_ip, smtp_port, pop_port, imap_port=None):
         self.root = root
         self.root.title("Mail Client")
         self.root.geometry("600x600")  # Set default window size
@@ -317,6 +301,7 @@ class MailClientGUI:
         self.server_ip = server_ip
         self.smtp_port = smtp_port
         self.pop_port = pop_port
+        self.imap_port = IMAP_PORT if imap_port is None else imap_port
         
         self.username = tk.StringVar()
         self.password = tk.StringVar()
@@ -324,6 +309,12 @@ class MailClientGUI:
         self.default_font = tkFont.Font(family="Arial", size=16)
 
         self.pop_connection = None
+        self.showing_mailbox = False
+        self.watcher = None
+        self.root.bind("<<NewMail>>", self.on_new_mail)
+        self.index = None # MailIndex searched by the GUI thread
+        self.indexer = None
+        self.index_wanted = threading.Event() # set to have the indexer bring the index up to date
         
         self.create_login_screen()
     
@@ -349,24 +340,84 @@ class MailClientGUI:
             self.u = username
             self.p = password
             self.create_main_menu()
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.watch_mailbox, daemon=True)
+                self.watcher.start()
+            if self.indexer is None:
+                self.index_file = index_path(INDEX_DIR, username, self.server_ip, self.imap_port)
+                self.indexer = threading.Thread(target=self.keep_index, daemon=True)
+                self.indexer.start()
+            self.index_wanted.set()
         else:
             messagebox.showerror("Login Failed", "Incorrect username or password!")
     
     def validate_password(self, username, password) -> bool:
         try:
-            s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            s.connect((self.server_ip, self.pop_port))
-            s.recv(1024)
-            s.sendall(f"USER {username}".encode('utf-8'))
-            s.recv(1024)
-            s.sendall(f"PASS {password}".encode('utf-8'))
-            auth_resp = s.recv(1024).decode('utf-8').strip()
-            s.sendall(b"QUIT")
-            s.recv(1024)
+            s, _ = open_connection(self.server_ip, self.pop_port)
+            s.sendall(f"USER {username}\r\n".encode('utf-8'))
+            s.recv(RECV_SIZE)
+            s.sendall(f"PASS {password}\r\n".encode('utf-8'))
+            auth_resp = s.recv(RECV_SIZE).decode('utf-8').strip()
+            s.sendall(b"QUIT\r\n")
+            s.recv(RECV_SIZE)
+            close_connection(s)
             return auth_resp.startswith("+OK")
         except Exception:
             return False
     
+    def watch_mailbox(self):
+        """Waits for new mail with POP3 IDLE on a connection of its own, runs in a daemon thread."""
+        while True:
+            try:
+                s, _ = open_connection(self.server_ip, self.pop_port)
+                try:
+                    s.sendall(f"USER {self.u}\r\n".encode('utf-8'))
+                    s.recv(RECV_SIZE)
+                    s.sendall(f"PASS {self.p}\r\n".encode('utf-8'))
+                    if not s.recv(RECV_SIZE).startswith(b"+OK"):
+                        return
+                    s.sendall(b"IDLE\r\n")
+                    buffer = b""
+                    while True:
+                        data = s.recv(RECV_SIZE)
+                        if not data:
+                            raise ConnectionError("POP3 server closed the connection")
+                        *lines, buffer = (buffer + data).split(b"\r\n")
+                        for line in lines:
+                            if line.startswith(b"*"):
+                                self.root.event_generate("<<NewMail>>", when="tail")
+                            elif line.startswith(b"+OK: idle done"):
+                                s.sendall(b"IDLE\r\n")  # the server's idle timeout passed
+                            elif b"shutting down" in line:
+                                raise ConnectionError("POP3 server shutting down")
+                            elif line.startswith(b"-ERR"):
+                                return  # the server does not support IDLE
+                finally:
+                    close_connection(s)
+            except OSError:
+                pass
+            except (RuntimeError, tk.TclError):
+                return  # the window is gone
+            time.sleep(WATCH_RETRY)
+
+    def keep_index(self):
+        """Brings the search index up to date whenever index_wanted is set, runs in a daemon thread."""
+        with MailIndex(self.index_file) as index:
+            while True:
+                self.index_wanted.wait()
+                self.index_wanted.clear()
+                try:
+                    update_index(index, self.server_ip, self.imap_port, self.pop_port, self.u, self.p)
+                except (OSError, sqlite3.Error):
+                    pass # searches use what was indexed before, the next new mail tries again
+
+    def on_new_mail(self, event):
+        self.index_wanted.set()
+        if self.showing_mailbox:
+            self.manage_mail()
+        else:
+            self.root.title("Mail Client - new mail")
+
     def create_main_menu(self):
         self.clear_screen()
         frame = tk.Frame(self.root, padx=20, pady=20, bg="#f0f0f0")
@@ -402,7 +453,7 @@ class MailClientGUI:
             self.open_pop_connection()
 
         self.send_message('STAT') #get the amount of emails
-        stats = self.pop_connection.recv(1024).decode("utf-8")
+        stats = self.pop_connection.recv(RECV_SIZE).decode("utf-8")
         amnt = stats.split(' ')[1]
         amnt = int(amnt)
         bytes = stats.split(' ')[2].strip('\r\n')
@@ -431,41 +482,41 @@ class MailClientGUI:
         self.inner_frame.bind("<Configure>", self.on_frame_configure)
 
         self.send_message('LIST')
-        response = self.pop_connection.recv(1024).decode('utf-8')
+        response = self.pop_connection.recv(RECV_SIZE).decode('utf-8')
         mails = response.split('\n')
 
         for mail in mails[1:]:
             number = mail.split(' ')[0]
             self.send_message(f'RETR {number}')
-            content = self.pop_connection.recv(1024).decode("utf-8")
+            content = self.pop_connection.recv(RECV_SIZE).decode("utf-8")
             if not content.startswith('-ERR'):
                 summary = f'{number}. {summarize_mail(content)}'
                 tk.Button(self.inner_frame, text=summary, font=("Arial", 12), bg="#f0f0f0", fg="#000000", wraplength=400, anchor="w", justify="left", command=lambda number=number: self.view_mail(number, lambda: self.manage_mail())).pack(fill="x", pady=2, expand=True)
         
         tk.Button(frame, text="Reset changes", font=self.default_font, command=lambda: self.reset_changes(), bg="#9E9E9E", fg="#000000").pack(pady=10, fill="x")
         tk.Button(frame, text="Save changes and exit", font=self.default_font, command=lambda: self.save_changes(), bg="#9E9E9E", fg="#000000").pack(pady=10, fill="x")
+        self.root.title("Mail Client")
+        self.showing_mailbox = True
     
     def close_pop_connection(self):
         self.pop_connection.sendall(b'QUIT\r\n')
-        self.pop_connection.recv(1024)
-        self.pop_connection.close()
+        self.pop_connection.recv(RECV_SIZE)
+        close_connection(self.pop_connection)
         self.pop_connection = None
     
     def open_pop_connection(self):
-        self.pop_connection = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        self.pop_connection.connect((self.server_ip, self.pop_port))
-        self.pop_connection.recv(1024)
+        self.pop_connection, _ = open_connection(self.server_ip, self.pop_port)
         self.pop_connection.sendall(f"USER {self.u}\r\n".encode('utf-8'))
-        self.pop_connection.recv(1024)
+        self.pop_connection.recv(RECV_SIZE)
         self.pop_connection.sendall(f"PASS {self.p}\r\n".encode('utf-8'))
-        self.pop_connection.recv(1024)
+        self.pop_connection.recv(RECV_SIZE)
     
     def delete_mail(self, mail_number, callback_fn):
         open_connection = True
         if self.pop_connection is None:
             open_connection = False
             self.open_pop_connection()
-        self.pop_connection.sendall(f'DELE {mail_number}'.encode('utf-8'))
+        self.pop_connection.sendall(f'DELE {mail_number}\r\n'.encode('utf-8'))
         response = self.pop_connection.recv(2024).decode('utf-8')
         if response.startswith('+OK'):
             messagebox.showinfo('Delete', 'Message deleted.')
@@ -473,6 +524,7 @@ class MailClientGUI:
             messagebox.showinfo('Delete', 'Something went wrong')
         if not open_connection:
             self.close_pop_connection()
+            self.index_wanted.set()
         callback_fn()
     
     def view_mail(self, mail_number, back_fn):
@@ -484,8 +536,8 @@ class MailClientGUI:
         if self.pop_connection is None:
             open_connection = False
             self.open_pop_connection()
-        self.pop_connection.sendall(f'RETR {mail_number}'.encode('utf-8'))
-        content = self.pop_connection.recv(1024).decode()
+        self.pop_connection.sendall(f'RETR {mail_number}\r\n'.encode('utf-8'))
+        content = self.pop_connection.recv(RECV_SIZE).decode()
         if not open_connection:
             self.close_pop_connection()
         lines = content.split('\n')
@@ -494,8 +546,10 @@ class MailClientGUI:
         for line in lines:
             if line.startswith('+OK'):
                 bytes = line.split('+OK: ')[1]
+            elif line.strip() == '.':
+                break  # end of the message
             else:
-                email_content += f'{line}\n'
+                email_content += f'{line[1:] if line.startswith("..") else line}\n'
         email_content += f'Amount of bytes: {bytes}\n'
 
 
@@ -504,90 +558,51 @@ class MailClientGUI:
         tk.Button(frame, text="Delete", font=self.default_font, command=lambda: self.delete_mail(mail_number, back_fn), bg="#f44336", fg="#000000").pack(pady=10, fill="x")
         tk.Button(frame, text="Back", font=self.default_font, command=back_fn, bg="#9E9E9E", fg="#000000").pack(pady=10, fill="x")
     
-    def search_mail(self):
+    def search_mail(self, query=None):
         self.clear_screen()
         frame = tk.Frame(self.root, padx=20, pady=20, bg="#f0f0f0")
         frame.pack(expand=True)
         
-        tk.Label(frame, text="Search Emails (enter date as MM/DD/YYYY)", font=self.default_font, bg="#f0f0f0", fg="#000000").pack(pady=10)
-        
-        self.search_entry = tk.Entry(frame, font=self.default_font)
-        self.search_entry.pack(fill="x", pady=5)
-        
-        button_frame = tk.Frame(frame, bg="#f0f0f0")
-        button_frame.pack(pady=5, fill="x")
+        tk.Label(frame, text="Search Emails (enter dates as MM/DD/YYYY)", font=self.default_font, bg="#f0f0f0", fg="#000000").pack(pady=10)
 
-        tk.Button(button_frame, text="Search by Keyword", font=self.default_font, command=self.perform_search, bg="#4CAF50").pack(side="left", expand=True, fill="x", padx=2)
-        tk.Button(button_frame, text="Search by Date", font=self.default_font, command=self.search_by_date, bg="#2196F3").pack(side="left", expand=True, fill="x", padx=2)
-        tk.Button(button_frame, text="Search by Sender", font=self.default_font, command=self.search_by_sender, bg="#FF9800").pack(side="left", expand=True, fill="x", padx=2)
+        fields = tk.Frame(frame, bg="#f0f0f0")
+        fields.pack(fill="x", pady=5)
+        self.search_entries = {}
+        for row, (name, label) in enumerate([("text", "Keyword:"), ("address", "Sender/recipient:"), ("since", "From date:"), ("until", "To date:")]):
+            tk.Label(fields, text=label, font=self.default_font, bg="#f0f0f0", fg="#000000").grid(row=row, column=0, sticky="w")
+            entry = tk.Entry(fields, font=self.default_font)
+            entry.grid(row=row, column=1, sticky="ew", pady=2)
+            if query is not None:
+                entry.insert(0, query[name])
+            self.search_entries[name] = entry
+        fields.columnconfigure(1, weight=1)
+
+        tk.Button(frame, text="Search", font=self.default_font, command=self.perform_search, bg="#4CAF50").pack(pady=5, fill="x")
         
         self.results_box = scrolledtext.ScrolledText(frame, height=10, font=self.default_font)
         self.results_box.configure(state='disabled')
         self.results_box.pack(fill="both", pady=5)
         
         tk.Button(frame, text="Back", font=self.default_font, command=self.create_main_menu, bg="#9E9E9E").pack(pady=5, fill="x")
-    
-    def get_all_mails(self):
-        self.open_pop_connection()
-        self.pop_connection.sendall(b'STAT\r\n')
-        stats = self.pop_connection.recv(1024).decode("utf-8")
-        amnt = int(stats.split(' ')[1])
-        
-        self.all_mails = []
-        for i in range(1, amnt + 1):
-            self.pop_connection.sendall(f'RETR {i}\r\n'.encode('utf-8'))
-            self.all_mails.append(self.pop_connection.recv(4096).decode("utf-8"))
-        
-        self.close_pop_connection()
-    
-    def get_search_query(self, query=None):
+
+    def perform_search(self, query=None):
+        """Searches the local index with every filled in field at once, without contacting the server."""
         if query is None:
-            query = self.search_entry.get().strip()
+            query = {name: entry.get().strip() for name, entry in self.search_entries.items()}
         else:
-            self.search_mail()
-            self.search_entry.insert(0, query)
-        return query
-
-    def search_by_date(self, query=None):
-        query = self.get_search_query(query)
-        if not query:
-            messagebox.showerror("Error", "Please enter a search query.")
-            return
-        self.get_all_mails()
-        results = []
-        for i, mail in enumerate(self.all_mails):
-            dateline = mail.split('\n')[4]
-            if query in dateline:
-                results.append((i+1, summarize_mail(mail)))
-        self.display_results(results, lambda query=query: self.search_by_date(query))
-
-    def search_by_sender(self, query=None):
-        query = self.get_search_query(query)
-        if not query:
+            self.search_mail(query)
+        if not any(query.values()):
             messagebox.showerror("Error", "Please enter a search query.")
             return
-        self.get_all_mails()
-        results = []
-        for i, mail in enumerate(self.all_mails):
-            fromLine = mail.split('\n')[1]
-            toLine = mail.split('\n')[2]
-            if query in fromLine or query in toLine:
-                results.append((i+1, summarize_mail(mail)))
-        self.display_results(results, lambda query=query: self.search_by_sender(query))
-
-
-    def perform_search(self, query=None):
-        query = self.get_search_query(query)
-        if not query:
-            messagebox.showerror("Error", "Please enter a search query.")
+        try:
+            since, before = parse_date_range(query["since"], query["until"])
+        except ValueError:
+            messagebox.showerror("Error", "Please enter dates as MM/DD/YYYY.")
             return
-        
-        self.get_all_mails()
-        
-        results = []
-        for i, mail in enumerate(self.all_mails):
-            if query.lower() in mail.lower():
-                results.append((i+1, summarize_mail(mail)))
+        if self.index is None:
+            self.index = MailIndex(self.index_file)
+        results = [(number, f"\nFrom: {sender} \nReceived: {received} \nSubject: {subject}")
+                   for number, sender, _, subject, received in self.index.search(query["text"], query["address"], since, before)]
         self.display_results(results, lambda query=query: self.perform_search(query))
     
     def display_results(self, results, back_fn):
@@ -608,7 +623,7 @@ class MailClientGUI:
         return True
     
     def send_mail(self):
-        mail_from = f"{self.username.get()}@swmgmail.com"
+        mail_from = f"{self.username.get()}@{config.domain}"
         rcpt_to = self.recipient_entry.get()
         subject = self.subject_entry.get()
         message_body = self.message_text.get("1.0", tk.END).strip()
@@ -621,36 +636,35 @@ class MailClientGUI:
             messagebox.showerror("Error", "To field is not a valid email.")
             return
         
-        if not rcpt_to.split("@")[1] == "swmgmail.com":
+        if not rcpt_to.split("@")[1] == config.domain:
             messagebox.showerror("Error", "Can currently only send mail to other swmgmail accounts.")
             return
         
         try:
-            s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            s.connect((self.server_ip, self.smtp_port))
-            s.recv(1024)
+            s, _ = open_connection(self.server_ip, self.smtp_port, smtp=True)
             s.sendall(b"HELO client\r\n")
-            s.recv(1024)
+            s.recv(RECV_SIZE)
             
             s.sendall(f"MAIL FROM:<{mail_from}>\r\n".encode())
-            s.recv(1024)
+            s.recv(RECV_SIZE)
             s.sendall(f"RCPT TO:<{rcpt_to}>\r\n".encode())
-            response = s.recv(1024).decode("utf-8").strip()
+            response = s.recv(RECV_SIZE).decode("utf-8").strip()
             if response.startswith("550"):
                 messagebox.showerror("Error", "Receiver doesn't exist")
                 s.sendall(b"QUIT\r\n")
-                s.recv(1024)
-                s.close()
+                s.recv(RECV_SIZE)
+                close_connection(s)
                 return
             
             s.sendall(b"DATA\r\n")
-            s.recv(1024)
-            mail_text = f"From: {mail_from}\r\nTo: {rcpt_to}\r\nSubject: {subject}\r\n{message_body}\r\n.\r\n"
+            s.recv(RECV_SIZE)
+            body = "\r\n".join(dot_stuff(message_body.splitlines()))
+            mail_text = f"From: {mail_from}\r\nTo: {rcpt_to}\r\nSubject: {subject}\r\n{body}\r\n.\r\n"
             s.sendall(mail_text.encode())
-            s.recv(1024)
+            s.recv(RECV_SIZE)
             s.sendall(b"QUIT\r\n")
-            s.recv(1024)
-            s.close()
+            s.recv(RECV_SIZE)
+            close_connection(s)
             
             messagebox.showinfo("Success", "Mail sent successfully.")
             self.create_main_menu()
@@ -658,16 +672,18 @@ class MailClientGUI:
             messagebox.showerror("Error", f"Failed to send mail: {e}")
     
     def clear_screen(self):
+        self.showing_mailbox = False
         for widget in self.root.winfo_children():
             widget.destroy()
 
     def save_changes(self):
         self.close_pop_connection()
+        self.index_wanted.set()
         self.create_main_menu()
 
     def reset_changes(self):
         self.send_message('RSET')
-        self.pop_connection.recv(1024)
+        self.pop_connection.recv(RECV_SIZE)
         self.manage_mail()
 
     def on_frame_configure(self, event):
@@ -683,6 +699,120 @@ class MailClientGUI:
             self.create_login_screen()
 
 
+def open_connection(server_ip, port, smtp=False):
+    """Connects to a server and reads its greeting, upgrading to TLS first with --tls.
+
+    Returns the socket and the greeting.
+    """
+    s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    s.connect((server_ip, port))
+    greeting = s.recv(RECV_SIZE).decode("utf-8")
+    if TLS is None:
+        return s, greeting
+    if smtp:
+        s.sendall(b"EHLO client\r\n")
+        s.recv(RECV_SIZE)
+    s.sendall(b"STARTTLS\r\n" if smtp else b"STLS\r\n")
+    response = s.recv(RECV_SIZE).decode("utf-8")
+    if not response.startswith("220" if smtp else "+OK"):
+        s.close()
+        raise ConnectionError(f"Server refused TLS: {response.strip()}")
+    return TLS.wrap(s, server_ip, port), greeting
+
+
+def close_connection(s):
+    """Closes a connection, keeping its TLS session to resume on the next one."""
+    if TLS is not None:
+        TLS.remember(s)
+    s.close()
+
+
+def update_index(index, server_ip, imap_port, pop_port, username, password):
+    """Brings a MailIndex up to date: incrementally over IMAP, or by downloading the whole
+    mailbox over POP3 when no IMAP server answers. Returns the number of messages downloaded."""
+    import imaplib # only syncing needs it, the headless commands start faster without
+    try:
+        imap = imaplib.IMAP4(server_ip, imap_port)
+    except OSError:
+        messages = retrieve_all(server_ip, pop_port, username, password)
+        index.replace(messages)
+        return len(messages)
+    try:
+        if TLS is not None:
+            imap.starttls(TLS.context)
+        imap.login(username, password)
+        return index.sync(imap)
+    except imaplib.IMAP4.error as e:
+        raise ConnectionError(f"IMAP: {e}") from e
+    finally:
+        try:
+            imap.logout()
+        except (OSError, imaplib.IMAP4.error):
+            pass
+
+
+def retrieve_all(server_ip, pop_port, username, password):
+    """Downloads every message over POP3, returns them as (number, content) pairs."""
+    with pop_session(server_ip, pop_port, username, password) as (s, reader):
+        messages = []
+        for number, _ in pop_list(s, reader):
+            content = pop_retrieve(s, reader, number)
+            if content is not None:
+                messages.append((number, content.decode("utf-8", "replace")))
+        pop_quit(s, reader)
+    return messages
+
+
+@contextlib.contextmanager
+def pop_session(server_ip, pop_port, username, password):
+    """Opens a POP3 session and logs in, yields the socket and a line reader over it."""
+    s, _ = open_connection(server_ip, pop_port)
+    reader = s.makefile("rb")
+    try:
+        pop_command(s, reader, f"USER {username}")
+        if not pop_command(s, reader, f"PASS {password}").startswith("+OK"):
+            raise ConnectionError("POP3 login failed")
+        yield s, reader
+    finally:
+        reader.close()
+        close_connection(s)
+
+
+def pop_command(s, reader, command):
+    """Sends a POP3 command, returns the first line of the reply."""
+    s.sendall(f"{command}\r\n".encode('utf-8'))
+    line = reader.readline()
+    if not line:
+        raise ConnectionError("POP3 server closed the connection")
+    return line.decode('utf-8', 'replace').strip()
+
+
+def pop_list(s, reader):
+    """Returns (number, octets) of every message not marked deleted."""
+    reply = pop_command(s, reader, "LIST")
+    if not reply.startswith("+OK"):
+        raise ConnectionError(f"POP3 LIST failed: {reply}")
+    amnt = int(reply.split(' ')[1])
+    listing = [reader.readline().split() for _ in range(amnt)]
+    reader.readline() # the listing ends with an empty line
+    return [(int(number), int(octets)) for number, octets in listing]
+
+
+def pop_retrieve(s, reader, number):
+    """Returns message number (bytes, dot-stuffing undone), None if the server refuses."""
+    if not pop_command(s, reader, f"RETR {number}").startswith("+OK"):
+        return None
+    lines = []
+    while (line := reader.readline()) not in (b".\r\n", b""):
+        lines.append(line[1:] if line.startswith(b"..") else line)
+    return b"".join(lines)
+
+
+def pop_quit(s, reader):
+    """Ends the session, which is when the server removes the messages marked deleted."""
+    return pop_command(s, reader, "QUIT")
+
+
 def summarize_mail(content):
     lines = content.split("\n")
     sender = next((line.split(": ")[1] for line in lines if line.startswith("From:")), "Unknown")
@@ -691,25 +821,257 @@ def summarize_mail(content):
     return f"\nFrom: {sender} \nReceived: {received} \nSubject: {subject}"
 
 
-def main():
-    if len(sys.argv) != 2:
-        print("Usage: python mail_client.py <server_IP>")
-        sys.exit(1)
-    
-    server_ip = sys.argv[1]
-    smtp_port = 2525
-    pop_port = 1100
-    
+def dot_stuff(lines):
+    """Doubles a leading '.' so body lines are not mistaken for the end of the message."""
+    return ["." + line if line.startswith(".") else line for line in lines]
+
+
+def parse_date_range(since, until):
+    """Turns MM/DD/YYYY dates (either may be empty) into since and before datetimes, until included."""
+    since = datetime.datetime.strptime(since, "%m/%d/%Y") if since else None
+    before = datetime.datetime.strptime(until, "%m/%d/%Y") + datetime.timedelta(days=1) if until else None
+    return since, before
+
+
+def smtp_command(s, reader, command):
+    s.sendall(f"{command}\r\n".encode('utf-8'))
+    return smtp_reply(reader)
+
+
+def smtp_reply(reader):
+    """Reads an SMTP reply, returns its last line."""
+    while True:
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("SMTP server closed the connection")
+        line = line.decode('utf-8', 'replace').strip()
+        if line[3:4] != "-":
+            return line
+
+
+def read_batch(path):
+    """Yields the JSON values on the lines of a file, - for stdin."""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def batch_numbers(args):
+    """The message numbers on the command line and in --batch, as numbers or objects with a number."""
+    numbers = list(args.numbers)
+    if args.batch:
+        for item in read_batch(args.batch):
+            if isinstance(item, dict):
+                item = item.get("number")
+            if not isinstance(item, int):
+                raise ValueError(f"message number expected in --batch, got {item!r}")
+            numbers.append(item)
+    return numbers
+
+
+def command_send(args):
+    if args.batch:
+        messages = read_batch(args.batch)
+    elif args.to:
+        messages = [{"to": args.to, "subject": args.subject, "body": sys.stdin.read() if args.body is None else args.body}]
+    else:
+        raise ValueError("--to or --batch expected")
+    mail_from = f"{args.user}@{config.domain}"
+    s, _ = open_connection(args.server, args.smtp_port, smtp=True)
+    reader = s.makefile("rb")
+    try:
+        smtp_command(s, reader, "HELO client")
+        for message in messages:
+            rcpt_to = message.get("to", "")
+            subject = message.get("subject", "")
+            reply = smtp_command(s, reader, f"MAIL FROM:<{mail_from}>")
+            if reply.startswith("250"):
+                reply = smtp_command(s, reader, f"RCPT TO:<{rcpt_to}>")
+            if reply.startswith("250"):
+                reply = smtp_command(s, reader, "DATA")
+            if reply.startswith("354"):
+                body = "\r\n".join(dot_stuff(message.get("body", "").splitlines()))
+                s.sendall(f"From: {mail_from}\r\nTo: {rcpt_to}\r\nSubject: {subject}\r\n{body}\r\n.\r\n".encode('utf-8'))
+                reply = smtp_reply(reader)
+            if reply.startswith("250"):
+                yield {"to": rcpt_to, "subject": subject, "sent": True}
+            else:
+                smtp_command(s, reader, "RSET")
+                yield {"to": rcpt_to, "subject": subject, "error": reply}
+        smtp_command(s, reader, "QUIT")
+    finally:
+        reader.close()
+        close_connection(s)
+
+
+def command_list(args):
+    with pop_session(args.server, args.pop_port, args.user, args.password) as (s, reader):
+        for number, octets in pop_list(s, reader):
+            record = {"number": number, "octets": octets}
+            if args.headers:
+                content = pop_retrieve(s, reader, number)
+                if content is not None:
+                    sender, recipient, subject, received = parse_message(content.decode("utf-8", "replace"))
+                    record.update({"from": sender, "to": recipient, "subject": subject, "received": format_received(received)})
+            yield record
+        pop_quit(s, reader)
+
+
+def command_fetch(args):
+    numbers = batch_numbers(args)
+    with pop_session(args.server, args.pop_port, args.user, args.password) as (s, reader):
+        for number in numbers or [number for number, _ in pop_list(s, reader)]:
+            content = pop_retrieve(s, reader, number)
+            if content is None:
+                yield {"number": number, "error": "no such message"}
+            else:
+                yield {"number": number, "message": content.decode("utf-8", "replace")}
+        pop_quit(s, reader)
+
+
+def command_delete(args):
+    numbers = batch_numbers(args)
+    if not numbers:
+        raise ValueError("message numbers expected")
+    with pop_session(args.server, args.pop_port, args.user, args.password) as (s, reader):
+        results = []
+        for number in numbers:
+            reply = pop_command(s, reader, f"DELE {number}")
+            results.append({"number": number, "deleted": True} if reply.startswith("+OK") else {"number": number, "error": reply})
+        # Nothing is deleted before the session ends
+        reply = pop_quit(s, reader)
+    if not reply.startswith("+OK"):
+        raise ConnectionError(f"POP3 QUIT failed: {reply}")
+    yield from results
+
+
+def command_search(args):
+    since, before = parse_date_range(args.since, args.until)
+    with MailIndex(index_path(INDEX_DIR, args.user, args.server, args.imap_port)) as index:
+        if args.sync:
+            update_index(index, args.server, args.imap_port, args.pop_port, args.user, args.password)
+        for number, sender, recipient, subject, received in index.search(args.text, args.address, since, before):
+            yield {"number": number, "from": sender, "to": recipient, "subject": subject, "received": received}
+
+
+def command_sync(args):
+    with MailIndex(index_path(INDEX_DIR, args.user, args.server, args.imap_port)) as index:
+        downloaded = update_index(index, args.server, args.imap_port, args.pop_port, args.user, args.password)
+        yield {"messages": len(index), "downloaded": downloaded}
+
+
+COMMANDS = {
+    "send": (command_send, "send mail, given as options or as JSON lines with to, subject and body (--batch)"),
+    "list": (command_list, "list the number and size of every message"),
+    "fetch": (command_fetch, "print messages, by number or all of them"),
+    "search": (command_search, "search the local index (see sync) on keyword, address and date range"),
+    "delete": (command_delete, "delete messages by number"),
+    "sync": (command_sync, "bring the local search index up to date"),
+}
+
+
+def run_command(command, argv):
+    """Runs a headless command, writing its results to stdout as JSON lines; returns the exit status."""
+    handler, description = COMMANDS[command]
+    parser = argparse.ArgumentParser(prog=f"mail_client.py {command}", description=description)
+    parser.add_argument("--server", default="localhost", help="address of the mail servers")
+    add_client_arguments(parser)
+    if command in ("fetch", "delete"):
+        parser.add_argument("numbers", nargs="*", type=int, help="message numbers" + (" (default: all)" if command == "fetch" else ""))
+    if command in ("send", "fetch", "delete"):
+        parser.add_argument("--batch", help="file with one JSON value per line, - for stdin"
+                            + (" (e.g. the output of list or search)" if command != "send" else ""))
+    if command == "send":
+        parser.add_argument("--to", help="recipient address")
+        parser.add_argument("--subject", default="")
+        parser.add_argument("--body", help="message text (default: read from stdin)")
+    elif command == "list":
+        parser.add_argument("--headers", action="store_true", help="also download each message for its From, To, Subject and Received")
+    elif command == "search":
+        parser.add_argument("--text", help="text anywhere in the message")
+        parser.add_argument("--address", help="text in the sender or recipient")
+        parser.add_argument("--since", help="first day received, MM/DD/YYYY")
+        parser.add_argument("--until", help="last day received, MM/DD/YYYY")
+        parser.add_argument("--sync", action="store_true", help="bring the index up to date first")
+    args = config.parse_args(parser, "client", argv=argv)
+    if not args.user or (args.password is None and (command != "search" or args.sync)):
+        parser.error("--user and --password are required")
+    apply_client_options(args)
+    try:
+        for record in handler(args):
+            print(json.dumps(record), flush=True)
+    except BrokenPipeError:
+        # Whoever reads the output (e.g. head) has stopped, so stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    except (OSError, ValueError) as e:
+        print(json.dumps({"error": str(e)}), flush=True)
+        return 1
+    return 0
+
+
+def add_client_arguments(parser):
+    parser.add_argument("--smtp-port", type=int, default=SMTP_PORT)
+    parser.add_argument("--pop-port", type=int, default=POP3_PORT)
+    parser.add_argument("--imap-port", type=int, default=IMAP_PORT, help="IMAP port the search index is synced over")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR, help="where the local search indexes are kept")
+    parser.add_argument("--recv-size", type=int, default=RECV_SIZE, help="bytes read from the servers at a time")
+    parser.add_argument("--domain", default=config.DEFAULT_DOMAIN, help="mail domain of the accounts")
+    parser.add_argument("--tls", action="store_true", help="upgrade every connection to TLS")
+    parser.add_argument("--cafile", help="CA certificates to verify the servers with, e.g. a self-signed certificate")
+    parser.add_argument("--user", help="account to log in with")
+    parser.add_argument("--password", help="its password (e.g. from SWMGMAIL_CLIENT_PASSWORD)")
+
+
+def apply_client_options(args):
+    global RECV_SIZE, TLS, INDEX_DIR
+    config.domain = args.domain
+    RECV_SIZE = args.recv_size
+    INDEX_DIR = args.index_dir
+    if args.tls:
+        from tls import ClientTLS # ssl is only loaded for TLS
+        TLS = ClientTLS(args.cafile)
+
+
+def load_tkinter():
+    """Imports tkinter for the GUI, which the headless commands never load."""
+    global tk, messagebox, scrolledtext, tkFont
+    import tkinter as tk
+    from tkinter import messagebox, scrolledtext
+    import tkinter.font as tkFont
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        sys.exit(run_command(argv[0], argv[1:]))
+    parser = argparse.ArgumentParser(usage="python mail_client.py [<server_IP>] [--terminal] [--config FILE]\n"
+                                           "       python mail_client.py {send,list,fetch,search,delete,sync} [--help]")
+    parser.add_argument("server", nargs="?", default="localhost", help="address of the mail servers")
+    add_client_arguments(parser)
+    parser.add_argument("--terminal", action="store_true", help="run the interactive terminal client instead of the GUI")
+    args = config.parse_args(parser, "client", argv=argv)
+    apply_client_options(args)
+
+    if args.terminal:
+        MailClient(args.server, args.smtp_port, args.pop_port, args.imap_port).start()
+        return
+
+    load_tkinter()
     root = tk.Tk()
-    MailClientGUI(root, server_ip, smtp_port, pop_port)
+    gui = MailClientGUI(root, args.server, args.smtp_port, args.pop_port, args.imap_port)
+    gui.username.set(args.user or "")
+    gui.password.set(args.password or "")
     root.mainloop()
 
-    """client = MailClient(server_ip, smtp_port, pop_port)
-    client.start()"""
-
 if __name__ == "__main__":
     main()
 
 """
 The GUI has an intuitive way to interact with it. Just run `python3 mailserver_smtp.py 2525`, `python3 pop_server.py 1100` and then `python3 mail_client.py localhost`, then a GUI window will pop up to interact with.
-"""
\ No newline at end of file
+"""
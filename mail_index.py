@@ -0,0 +1,202 @@
+"""
+mail_index.py
+-------------
+The mail client's local search index: an SQLite database per account (~/.swmgmail by default)
+holding every downloaded message with its sender, recipient, subject and received time, plus a
+full-text index of the message text (FTS5 with the trigram tokenizer, so any substring of three
+or more characters is an index lookup; shorter ones and SQLite builds without FTS5 fall back to
+scanning the local copies). Searches combine keyword, address and date range in one query and
+never touch the network.
+The index is brought up to date over IMAP: messages are keyed by UID, so a sync only downloads
+messages it has not seen, drops the ones gone from the server and renumbers the rest. Without an
+IMAP server the client downloads the whole mailbox over POP3 and the index is replaced.
+"""
+
+import datetime
+import os
+import re
+import sqlite3
+
+from mailstore import RECEIVED_FORMAT
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".swmgmail")
+FETCH_BATCH = 100  # messages downloaded per IMAP FETCH
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS messages (
+    uid INTEGER PRIMARY KEY,
+    number INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    received TEXT,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_received ON messages (received);
+"""
+FTS_SCHEMA = ("CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5"
+              "(content, content='messages', content_rowid='uid', tokenize='trigram')")
+
+
+def index_path(directory, username, server, port):
+    name = re.sub(r"[^A-Za-z0-9@._-]", "_", f"{username}@{server}_{port}")
+    return os.path.join(directory, f"{name}.db")
+
+
+def parse_message(content):
+    """Returns (sender, recipient, subject, received) of a message, received as YYYY-MM-DD HH:MM."""
+    fields = {}
+    for line in content.split("\n"):
+        line = line.rstrip("\r")
+        name, sep, value = line.partition(": ")
+        if not line or not sep or " " in name:
+            break
+        fields.setdefault(name.lower(), value)
+    try:
+        received = datetime.datetime.strptime(fields.get("received", ""), RECEIVED_FORMAT).strftime(DATE_FORMAT)
+    except ValueError:
+        received = None
+    return fields.get("from", ""), fields.get("to", ""), fields.get("subject", ""), received
+
+
+class MailIndex:
+    """One account's index; a connection of its own, so use one per thread."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.execute(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False  # no FTS5 or trigram tokenizer in this SQLite build
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _state(self, name):
+        row = self.db.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _add(self, uid, number, content):
+        self.db.execute("INSERT OR REPLACE INTO messages (uid, number, sender, recipient, subject, received, content) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", (uid, number, *parse_message(content), content))
+        if self.fts:
+            self.db.execute("INSERT INTO messages_text (rowid, content) VALUES (?, ?)", (uid, content))
+
+    def _remove(self, uids):
+        if self.fts:
+            self.db.executemany("INSERT INTO messages_text (messages_text, rowid, content) "
+                                "SELECT 'delete', uid, content FROM messages WHERE uid = ?", [(uid,) for uid in uids])
+        self.db.executemany("DELETE FROM messages WHERE uid = ?", [(uid,) for uid in uids])
+
+    def _clear(self):
+        self.db.execute("DELETE FROM messages")
+        if self.fts:
+            self.db.execute("INSERT INTO messages_text (messages_text) VALUES ('delete-all')")
+
+    def sync(self, imap):
+        """Brings the index up to date with the INBOX of a logged in imaplib connection.
+
+        Returns the number of messages downloaded.
+        """
+        imap.select("INBOX", readonly=True)
+        uidvalidity = int(imap.response("UIDVALIDITY")[1][0])
+        uids = [int(uid) for uid in imap.uid("SEARCH", "ALL")[1][0].split()]
+        self.db.execute("BEGIN")
+        try:
+            if self._state("uidvalidity") != uidvalidity:
+                self._clear()  # UIDs from another numbering, or a POP3 download
+                self.db.execute("INSERT OR REPLACE INTO state (name, value) VALUES ('uidvalidity', ?)", (uidvalidity,))
+            known = {uid for uid, in self.db.execute("SELECT uid FROM messages")}
+            current = set(uids)
+            self._remove(known - current)
+            numbers = {uid: number for number, uid in enumerate(uids, start=1)}
+            self.db.executemany("UPDATE messages SET number = ? WHERE uid = ?",
+                                [(numbers[uid], uid) for uid in known & current])
+            new = [uid for uid in uids if uid not in known]
+            for start in range(0, len(new), FETCH_BATCH):
+                batch = ",".join(str(uid) for uid in new[start:start + FETCH_BATCH])
+                for item in imap.uid("FETCH", batch, "(BODY.PEEK[])")[1]:
+                    if not isinstance(item, tuple):
+                        continue
+                    match = re.search(rb"UID (\d+)", item[0])
+                    if match is not None and int(match.group(1)) in numbers:
+                        uid = int(match.group(1))
+                        self._add(uid, numbers[uid], item[1].decode("utf-8", "replace"))
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return len(new)
+
+    def replace(self, messages):
+        """Replaces the index with messages given as (number, content), e.g. downloaded over POP3."""
+        self.db.execute("BEGIN")
+        try:
+            self._clear()
+            self.db.execute("DELETE FROM state WHERE name = 'uidvalidity'")
+            for number, content in messages:
+                self._add(number, number, content)
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def search(self, text=None, address=None, since=None, before=None, received=None):
+        """Returns (number, sender, recipient, subject, received) of the matching messages, by number.
+
+        text is looked for anywhere in the message, address in the sender and recipient, all
+        ignoring case; since and before (datetimes) bound the received time, and received
+        matches the received time as the server writes it (e.g. 03/18/2025) as a substring.
+        """
+        conditions = ["1"]
+        args = []
+        if text:
+            if self.fts and len(text) >= 3:
+                conditions.append("uid IN (SELECT rowid FROM messages_text WHERE messages_text MATCH ?)")
+                args.append('"' + text.replace('"', '""') + '"')
+            else:
+                conditions.append("instr(lower(content), ?)")
+                args.append(text.lower())
+        if address:
+            conditions.append("(instr(lower(sender), ?) OR instr(lower(recipient), ?))")
+            args += [address.lower()] * 2
+        if since is not None:
+            conditions.append("received >= ?")
+            args.append(since.strftime(DATE_FORMAT))
+        if before is not None:
+            conditions.append("received < ?")
+            args.append(before.strftime(DATE_FORMAT))
+        if received:
+            conditions.append("instr(strftime('%m/%d/%Y : %H:%M', received), ?)")
+            args.append(received)
+        rows = self.db.execute(f"SELECT number, sender, recipient, subject, received FROM messages "
+                               f"WHERE {' AND '.join(conditions)} ORDER BY number", args)
+        return [(number, sender, recipient, subject, format_received(received))
+                for number, sender, recipient, subject, received in rows]
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM messages").fetchone()[0]
+
+
+def format_received(received):
+    """Turns a stored received time back into the form the server writes it in."""
+    if received is None:
+        return "Unknown"
+    return datetime.datetime.strptime(received, DATE_FORMAT).strftime(RECEIVED_FORMAT)
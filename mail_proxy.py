@@ -0,0 +1,550 @@
+"""
+mail_proxy.py
+-------------
+A front proxy that spreads the users over several mail backends (shards), so mailbox storage and
+CPU can grow by adding hosts. Every backend is an SMTP server and a POP3 server sharing a mail
+root of their own; --backend HOST:SMTP_PORT:POP3_PORT names one, and every proxy process must be
+given the same list. A user's backend is found by consistent hashing of the user name, so adding
+a backend moves only about 1/N of the users (--locate USER shows where a user lives).
+   smtp   The proxy speaks SMTP to the client and starts the transaction on the backend of each
+          recipient as it is named; RCPT TO is answered with that backend's reply, and a message
+          for users on several backends is sent to each of them. Recipients in other domains are
+          only taken from clients in --relay-networks (default the loopback addresses) and go to
+          the sender's backend, which relays them; as the backends see the proxy's address, theirs
+          has to be in the backends' --relay-networks. Connections to the backends are
+          pooled (--pool-size idle ones per backend) and reused for the next message.
+   pop3   The proxy answers CAPA and STLS itself and passes USER and PASS on to the user's backend;
+          once the backend accepts the login the connection is relayed unchanged until either side
+          closes, so STAT, LIST, RETR, DELE and IDLE are served by the backend.
+Clients all reach the backends from the proxy's address, so rate limits per client address belong
+on the proxy, not on the backends.
+Usage: python mail_proxy.py smtp|pop3 [<port>] --backend HOST:SMTP_PORT:POP3_PORT [--backend ...]
+                            [--workers N] [--config FILE]
+       python mail_proxy.py --backend ... --locate USER
+"""
+
+import argparse
+import bisect
+import contextlib
+import functools
+import hashlib
+import select
+import smtplib
+import socket
+import threading
+
+import config
+from mailserver_smtp import SMTP_PORT, SMTPServer, SMTPSession, SMTPState, extract_email
+from pop_server import POP3_IDLE_TIMEOUT, POP3_PORT
+from profiling import add_profiling_arguments, apply_profiling_options, install_profiler_signal, timed
+from ratelimit import add_rate_limit_arguments, rate_limit_options
+from relay import DEFAULT_RELAY_NETWORKS, add_relay_network_arguments, is_trusted, relay_networks
+from sessions import (DEFAULT_COMMAND_TIMEOUT, DEFAULT_DRAIN_TIMEOUT, DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_SESSIONS,
+                      DEFAULT_RECV_SIZE, UNTERMINATED_LINE_DELAY, LineBuffer, ReplyBuffer, SessionRegistry,
+                      add_session_arguments, reject, session_options, wait_for_input)
+from tls import add_tls_arguments, is_tls, tls_options
+from workers import add_worker_arguments, create_listener, handle_sigterm, run_workers
+
+VIRTUAL_NODES = 100  # points per backend on the hash ring, evens out the share of users each gets
+DEFAULT_POOL_SIZE = 4
+CONNECT_TIMEOUT = 30
+RELAY_BUFFER_SIZE = 64 * 1024  # bytes copied at a time between a POP3 client and its backend
+POP3_UNAUTHENTICATED = {"STAT", "LIST", "RETR", "DELE", "RSET", "IDLE"}
+
+
+def parse_backend(value):
+    """Splits "host:smtp_port:pop3_port" (an IPv6 host in brackets) into a Backend."""
+    rest, _, pop3_port = value.rpartition(":")
+    host, _, smtp_port = rest.rpartition(":")
+    if not host or not smtp_port.isdigit() or not pop3_port.isdigit():
+        raise ValueError(f"Invalid backend {value!r}, expected HOST:SMTP_PORT:POP3_PORT")
+    return Backend(host.strip("[]"), int(smtp_port), int(pop3_port))
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class Backend:
+    """One shard: its SMTP and POP3 server, and the idle SMTP connections kept to it."""
+
+    def __init__(self, host, smtp_port, pop3_port, pool_size=DEFAULT_POOL_SIZE):
+        self.host = host
+        self.smtp_port = smtp_port
+        self.pop3_port = pop3_port
+        self.pool_size = pool_size
+        self._idle = []  # smtplib.SMTP connections between transactions
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        host = f"[{self.host}]" if ":" in self.host else self.host
+        return f"{host}:{self.smtp_port}:{self.pop3_port}"
+
+    def smtp_connection(self):
+        """Returns an SMTP connection ready for a new transaction, from the pool if one is left."""
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = smtplib.SMTP(self.host, self.smtp_port, timeout=CONNECT_TIMEOUT)
+                try:
+                    conn.ehlo_or_helo_if_needed()
+                except (OSError, smtplib.SMTPException):
+                    conn.close()
+                    raise
+                return conn
+            if is_open(conn):
+                return conn
+            conn.close()
+
+    def release(self, conn, clean=True):
+        """Puts a connection back in the pool; clean is False if it is in the middle of a transaction."""
+        try:
+            if not clean and conn.rset()[0] != 250:
+                conn.close()
+                return
+        except (OSError, smtplib.SMTPException):
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        quit_smtp(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            quit_smtp(conn)
+
+    def pop3_connection(self):
+        """Opens a connection to the POP3 server and reads its greeting."""
+        conn = socket.create_connection((self.host, self.pop3_port), timeout=CONNECT_TIMEOUT)
+        try:
+            read_reply(conn)
+        except OSError:
+            conn.close()
+            raise
+        return conn
+
+
+def is_open(conn):
+    """Whether an idle SMTP connection is still usable: the backend sends nothing between
+    transactions unless it is closing the connection (its idle timeout, a shutdown)."""
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError, TypeError):
+        return False
+    return not readable
+
+
+def quit_smtp(conn):
+    try:
+        conn.quit()
+    except (OSError, smtplib.SMTPException):
+        conn.close()
+
+
+class ShardRing:
+    """Consistent hashing of user names onto the backends."""
+
+    def __init__(self, backends, virtual_nodes=VIRTUAL_NODES):
+        points = sorted((ring_hash(f"{backend.name}#{i}"), n)
+                        for n, backend in enumerate(backends) for i in range(virtual_nodes))
+        self.backends = list(backends)
+        self._hashes = [point for point, _ in points]
+        self._owners = [self.backends[n] for _, n in points]
+
+    def backend(self, username):
+        """Returns the backend holding username's mailbox."""
+        index = bisect.bisect(self._hashes, ring_hash(username)) % len(self._hashes)
+        return self._owners[index]
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+
+
+class ProxySMTPSession(SMTPSession):
+    """An SMTP session whose recipients are checked, and whose mail is delivered, by the backends."""
+
+    def __init__(self, conn, addr, ring, relay_networks=None, **options):
+        self.ring = ring
+        self.relay_networks = DEFAULT_RELAY_NETWORKS if relay_networks is None else relay_networks
+        self.transactions = {}  # backend -> connection that MAIL FROM was sent on
+        super().__init__(conn, addr, **options)
+
+    def reset(self):
+        self.release_backends(clean=False)
+        super().reset()
+
+    def release_backends(self, clean=True):
+        transactions, self.transactions = self.transactions, {}
+        for backend, conn in transactions.items():
+            backend.release(conn, clean)
+
+    def handle_client(self):
+        try:
+            super().handle_client()
+        finally:
+            self.release_backends(clean=False)
+
+    def transaction(self, backend):
+        """Returns the connection carrying this message to backend, sending MAIL FROM on first use."""
+        conn = self.transactions.get(backend)
+        if conn is None:
+            conn = backend.smtp_connection()
+            try:
+                code, reply = conn.mail(self.sender)
+            except (OSError, smtplib.SMTPException):
+                conn.close()
+                raise
+            if code != 250:
+                backend.release(conn, clean=False)
+                raise smtplib.SMTPSenderRefused(code, reply, self.sender)
+            self.transactions[backend] = conn
+        return conn
+
+    def drop_backend(self, backend):
+        conn = self.transactions.pop(backend, None)
+        if conn is not None:
+            conn.close()
+
+    def handle_rcpt_to(self, line):
+        """Hands RCPT TO to the recipient's backend and passes its reply on."""
+        if self.state not in {SMTPState.MAIL_FROM_DONE, SMTPState.RCPT_TO_DONE}:
+            self.send_response("500 Error: send MAIL FROM first")
+            return
+        recipient = extract_email(line)
+        if recipient == "Invalid address":
+            self.send_response("500 Error: Invalid address")
+            return
+        username, domain = recipient.split("@")[:2]
+        if domain != config.domain and not is_trusted(self.addr[0], self.relay_networks):
+            # Checked here, the backend sees every client at the proxy's address
+            self.send_response("550 5.7.1 Relaying denied")
+            return
+        # Mail for other domains is relayed by the sender's backend, which knows whether it is local
+        owner = username if domain == config.domain else self.sender.partition("@")[0]
+        backend = self.ring.backend(owner)
+        try:
+            code, reply = timed("io", self.transaction(backend).rcpt, recipient)
+        except smtplib.SMTPResponseException as e:
+            code, reply = e.smtp_code, e.smtp_error
+        except (OSError, smtplib.SMTPException) as e:
+            print(f"Backend {backend.name} failed for {self.addr}: {e}")
+            self.drop_backend(backend)
+            self.send_response("451 4.4.1 Mailbox server unavailable, try again later")
+            return
+        if code in (250, 251):
+            self.recipients.append(recipient)
+            self.state = SMTPState.RCPT_TO_DONE
+        self.send_response(f"{code} {reply.decode('utf-8', 'replace')}")
+
+    def finalize_message(self):
+        """Sends the message to every backend a recipient is on, the backends stamp and store it."""
+        body = "".join(f"{line}\r\n" for line in self.data_lines).encode("utf-8")
+        failures = []
+        delivered = []
+        for backend, conn in list(self.transactions.items()):
+            try:
+                code, reply = timed("io", conn.data, body)
+            except smtplib.SMTPResponseException as e:
+                code, reply = e.smtp_code, e.smtp_error
+            except (OSError, smtplib.SMTPException) as e:
+                print(f"Backend {backend.name} failed for {self.addr}: {e}")
+                self.drop_backend(backend)
+                failures.append((451, b"Requested action aborted: local error in processing"))
+                continue
+            (delivered if code == 250 else failures).append((code, reply))
+        # The backends are done with the transaction whatever they replied
+        self.release_backends()
+        if not failures:
+            self.send_response("250 Mail accepted for delivery")
+        else:
+            if delivered:
+                # Already stored on the other backends, a retry by the client delivers it there twice
+                print(f"Mail from {self.addr} delivered to {len(delivered)} of {len(delivered) + len(failures)} backends")
+            code, reply = min(failures, key=lambda failure: failure[0] >= 500)  # a temporary error if any
+            self.send_response(f"{code} {reply.decode('utf-8', 'replace')}")
+        self.reset()
+        self.state = SMTPState.HELO_DONE
+
+
+class ProxySMTPServer(SMTPServer):
+    """The SMTP accept loop with ProxySMTPSession sessions."""
+
+    def __init__(self, port, ring, server_socket=None, relay_networks=None, **options):
+        super().__init__(port, server_socket, **options)
+        self.ring = ring
+        self.relay_networks = relay_networks
+
+    def handle_connection(self, conn, addr):
+        session = ProxySMTPSession(conn, addr, self.ring, self.relay_networks, idle_timeout=self.idle_timeout,
+                                   command_timeout=self.command_timeout, draining=self.sessions.draining,
+                                   recv_size=self.recv_size, limits=self.limits, tls=self.tls, sessions=self.sessions)
+        try:
+            session.handle_client()
+        finally:
+            self.sessions.remove(session.conn)
+
+    def shutdown(self):
+        super().shutdown()
+        self.ring.close()
+
+
+def read_reply(conn):
+    """Reads a one-line POP3 reply from a backend."""
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(DEFAULT_RECV_SIZE)
+        if not chunk:
+            raise ConnectionError("backend closed the connection")
+        data += chunk
+    return data
+
+
+def relay_connection(client, backend):
+    """Copies data both ways between the client and its backend until either side closes."""
+    poller = select.poll()
+    poller.register(client, select.POLLIN)
+    poller.register(backend, select.POLLIN)
+    peers = {client.fileno(): (client, backend), backend.fileno(): (backend, client)}
+    while True:
+        if is_tls(client) and client.pending():
+            ready = [client.fileno()]
+        else:
+            ready = [fd for fd, _ in poller.poll()]
+        for fd in ready:
+            source, destination = peers[fd]
+            data = source.recv(RELAY_BUFFER_SIZE)
+            if not data:
+                return
+            timed("io", destination.sendall, data)
+
+
+class ProxyPOP3Session:
+    """A POP3 client until it has logged in on its backend, after that the two are relayed."""
+
+    def __init__(self, conn, addr, ring, sessions, idle_timeout=POP3_IDLE_TIMEOUT, limits=None, tls=None):
+        self.conn = conn
+        self.addr = addr
+        self.ring = ring
+        self.sessions = sessions
+        self.idle_timeout = idle_timeout
+        self.limits = limits
+        self.tls = tls
+        self.backend = None  # connection to the backend of the user named by USER
+        self.output = ReplyBuffer(conn)
+        self.input = LineBuffer()
+
+    def send_message(self, message):
+        self.output.write(f"{message}\r\n".encode("utf-8"))
+
+    def forward(self, line):
+        """Sends a command to the backend, passes its reply on and returns it."""
+        timed("io", self.backend.sendall, f"{line}\r\n".encode("utf-8"))
+        reply = read_reply(self.backend)
+        self.output.write(reply)
+        return reply
+
+    def close_backend(self):
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+
+    def handle_client(self, recv_size=DEFAULT_RECV_SIZE):
+        try:
+            self.send_message("+OK: POP3 server ready")
+            while True:
+                line = self.input.next_line()
+                if line is None:
+                    timed("io", self.output.flush)
+                    # Read like the POP3 server does, so clients that leave out the CRLF work the same
+                    if len(self.input) and not wait_for_input(self.conn, UNTERMINATED_LINE_DELAY):
+                        line = self.input.take().decode("utf-8", "replace")
+                    else:
+                        if not wait_for_input(self.conn, self.idle_timeout, self.sessions.draining):
+                            if self.sessions.draining.is_set():
+                                self.send_message("-ERR: POP3 server shutting down")
+                            else:
+                                self.send_message("-ERR: autologout, idle for too long")
+                            return
+                        data = self.conn.recv(recv_size)
+                        if not data:
+                            return
+                        self.input.feed(data)
+                        continue
+                line = line.strip()
+                if self.limits is not None and line.upper() != "QUIT" and not self.limits.allow_command(self.addr[0]):
+                    self.send_message("-ERR: too many commands, slow down")
+                    continue
+                result = self.handle_command(line)
+                if result == "quit":
+                    return
+                if result == "relay":
+                    # Logged in, whatever the client sent after PASS is for the backend, as it was sent
+                    timed("io", self.output.flush)
+                    rest = self.input.take()
+                    if rest:
+                        timed("io", self.backend.sendall, rest)
+                    relay_connection(self.conn, self.backend)
+                    return
+                if result == "tls":
+                    self.input.take()  # anything sent along with STLS was in clear and is dropped
+        except OSError as e:
+            print(f"POP3 proxy exception with client {self.addr}: {e}")
+        finally:
+            with contextlib.suppress(OSError):
+                timed("io", self.output.flush)
+            self.close_backend()
+
+    def handle_command(self, line):
+        command_list = line.split(" ")
+        command = command_list[0]
+        if command == "QUIT":
+            self.send_message("+OK: POP3 server saying good-bye")
+            return "quit"
+        if command == "CAPA":
+            capabilities = ["USER", "IDLE"]
+            if self.tls is not None and not is_tls(self.conn):
+                capabilities.append("STLS")
+            self.send_message("+OK: Capability list follows\r\n" + "".join(f"{c}\r\n" for c in capabilities) + ".")
+        elif command == "STLS":
+            if self.tls is None:
+                self.send_message("-ERR: STLS not available")
+            elif is_tls(self.conn):
+                self.send_message("-ERR: TLS already active")
+            else:
+                self.send_message("+OK: Begin TLS negotiation")
+                timed("io", self.output.flush)
+                self.close_backend()
+                # The handshake is bounded by the command timeout set on the socket
+                tls_conn = self.tls.wrap_socket(self.conn, server_side=True)
+                self.sessions.replace(self.conn, tls_conn)
+                self.conn = tls_conn
+                self.output = ReplyBuffer(tls_conn)
+                return "tls"
+        elif command == "USER":
+            if len(command_list) != 2:
+                self.send_message("-ERR: USER <username> expected")
+                return
+            backend = self.ring.backend(command_list[1])
+            self.close_backend()
+            try:
+                self.backend = backend.pop3_connection()
+                self.forward(line)
+            except OSError as e:
+                print(f"Backend {backend.name} failed for {self.addr}: {e}")
+                self.close_backend()
+                self.send_message("-ERR: mailbox server unavailable, try again later")
+        elif command == "PASS":
+            if self.backend is None:
+                self.send_message("-ERR: USER expected first")
+            elif self.forward(line).startswith(b"+OK"):
+                return "relay"
+        elif command in POP3_UNAUTHENTICATED:
+            self.send_message("-ERR: authenticate first")
+        else:
+            self.send_message("-ERR: unsupported command")
+
+
+def serve_pop3(server_socket, ring, idle_timeout=POP3_IDLE_TIMEOUT, command_timeout=DEFAULT_COMMAND_TIMEOUT,
+               max_sessions=DEFAULT_MAX_SESSIONS, drain_timeout=DEFAULT_DRAIN_TIMEOUT, recv_size=DEFAULT_RECV_SIZE,
+               limits=None, tls=None):
+    print(f"POP3 proxy running on port {server_socket.getsockname()[1]} for {len(ring.backends)} backends...")
+    install_profiler_signal()
+    sessions = SessionRegistry(max_sessions)
+
+    def handle_connection(conn, addr):
+        conn.settimeout(command_timeout)
+        session = ProxyPOP3Session(conn, addr, ring, sessions, idle_timeout, limits, tls)
+        try:
+            session.handle_client(recv_size)
+        finally:
+            session.conn.close()
+            sessions.remove(session.conn)
+
+    try:
+        while True:
+            c, addr = server_socket.accept()
+            if limits is not None and not limits.allow_connection(addr[0]):
+                reject(c, "-ERR: too many connections from your address, try again later")
+                continue
+            if not sessions.add(c):
+                reject(c, "-ERR: too many connections, try again later")
+                continue
+            threading.Thread(target=handle_connection, args=(c, addr)).start()
+    except KeyboardInterrupt:
+        print("\nShutting down the POP3 proxy.")
+    finally:
+        server_socket.close()
+        if len(sessions):
+            print(f"Draining {len(sessions)} open sessions...")
+        leftover = sessions.drain(drain_timeout)
+        if leftover:
+            print(f"Closed {leftover} sessions that did not finish in time.")
+
+
+def serve_smtp(server_socket, ring, **options):
+    ProxySMTPServer(server_socket.getsockname()[1], ring, server_socket, **options).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(usage="python mail_proxy.py smtp|pop3 [<port>] --backend HOST:SMTP_PORT:POP3_PORT "
+                                           "[--backend ...] [--workers N] [--config FILE]")
+    parser.add_argument("protocol", choices=("smtp", "pop3"), nargs="?")
+    parser.add_argument("port", type=int, nargs="?")
+    parser.add_argument("--backend", action="append", metavar="HOST:SMTP_PORT:POP3_PORT",
+                        help="SMTP and POP3 server of one shard (repeatable, the same list for every proxy)")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_SIZE,
+                        help="idle SMTP connections kept per backend")
+    parser.add_argument("--locate", action="append", metavar="USER", help="print the backend of USER and exit")
+    parser.add_argument("--domain", default=config.DEFAULT_DOMAIN, help="mail domain served")
+    add_worker_arguments(parser)
+    add_session_arguments(parser, default_idle_timeout=None)
+    add_rate_limit_arguments(parser, "sender")
+    add_relay_network_arguments(parser)
+    add_tls_arguments(parser)
+    add_profiling_arguments(parser)
+    args = config.parse_args(parser, "proxy")
+    config.domain = args.domain
+    if not args.backend:
+        parser.error("at least one --backend is needed")
+    try:
+        backends = [parse_backend(value) for value in args.backend]
+    except ValueError as e:
+        parser.error(str(e))
+    for backend in backends:
+        backend.pool_size = args.pool_size
+    ring = ShardRing(backends)
+    if args.locate:
+        for username in args.locate:
+            print(f"{username} {ring.backend(username).name}")
+        return
+    if args.protocol is None:
+        parser.error("smtp or pop3 expected")
+    apply_profiling_options(args)
+
+    options = session_options(args)
+    if args.idle_timeout is None:
+        options["idle_timeout"] = DEFAULT_IDLE_TIMEOUT if args.protocol == "smtp" else POP3_IDLE_TIMEOUT
+    options["limits"] = rate_limit_options(args)
+    options["tls"] = tls_options(args)
+    if args.protocol == "smtp":
+        port = args.port or SMTP_PORT
+        serve = functools.partial(serve_smtp, ring=ring, relay_networks=relay_networks(args), **options)
+    else:
+        port = args.port or POP3_PORT
+        serve = functools.partial(serve_pop3, ring=ring, **options)
+    if args.workers > 1:
+        run_workers(serve, port, args.workers, args.backlog)
+    else:
+        handle_sigterm()
+        serve(create_listener(port, args.backlog))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
-import socket
+import argparse
+import contextlib
+import functools
+import sqlite3
 import threading
-import sys
-import os
 import datetime
 from enum import Enum, auto
-import fcntl
+
+import config
+import notify
+from journal import DEFAULT_COMMIT_INTERVAL, DeliveryJournal, JournalError
+import storage
+from mailstore import COMPRESSORS
+from profiling import CommandTimer, add_profiling_arguments, apply_profiling_options, install_profiler_signal, timed
+from ratelimit import add_rate_limit_arguments, rate_limit_options
+from relay import Relay, add_relay_arguments, message_lines, relay_options
+from sessions import (DEFAULT_COMMAND_TIMEOUT, DEFAULT_DRAIN_TIMEOUT, DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_SESSIONS,
+                      DEFAULT_RECV_SIZE, ReplyBuffer, SessionRegistry, add_session_arguments, reject, session_options,
+                      wait_for_input)
+from tls import add_tls_arguments, is_tls, tls_options
+from workers import DEFAULT_BACKLOG, add_worker_arguments, create_listener, handle_sigterm, run_workers
+
+SMTP_PORT = 2525
 
 
 class SMTPState(Enum):
@@ -18,9 +34,22 @@ class SMTPState(Enum):
 class SMTPSession:
     """Handles a single SMTP session with a client."""
     
-    def __init__(self, conn, addr):
+    def __init__(self, conn, addr, idle_timeout=DEFAULT_IDLE_TIMEOUT, command_timeout=DEFAULT_COMMAND_TIMEOUT, draining=None,
+                 compression=None, journal=None, quotas=None, recv_size=DEFAULT_RECV_SIZE, relay=None, limits=None, tls=None, sessions=None):
         self.conn = conn
         self.addr = addr
+        self.idle_timeout = idle_timeout
+        self.command_timeout = command_timeout
+        self.recv_size = recv_size
+        self.draining = draining
+        self.compression = compression
+        self.journal = journal
+        self.quotas = quotas
+        self.relay = relay
+        self.limits = limits
+        self.tls = tls
+        self.sessions = sessions
+        self.output = ReplyBuffer(conn)
         self.reset()
     
     def reset(self):
@@ -30,30 +59,64 @@ class SMTPSession:
         self.data_lines = []
     
     def send_response(self, message):
-        """Sends an SMTP response to the client."""
-        self.conn.sendall((message + "\r\n").encode("utf-8"))
+        """Queues an SMTP response, it is sent at the next flush."""
+        self.output.write((message + "\r\n").encode("utf-8"))
+
+    def flush(self):
+        timed("io", self.output.flush)
 
     def handle_client(self):
         """Processes SMTP commands from the client."""
         try:
+            self.conn.settimeout(self.command_timeout)
             self.send_response("220 MailServer SMTP Ready")
-            
+            buffer = b""  # received bytes after the last complete line
+
             while True:
-                data = self.conn.recv(1024).decode("utf-8")
+                # Everything received so far is answered before waiting for more
+                self.flush()
+                # A message being transferred is always finished, even while draining
+                draining = self.draining if self.state != SMTPState.DATA else None
+                if not wait_for_input(self.conn, self.idle_timeout, draining):
+                    if draining is not None and draining.is_set():
+                        self.send_response(f"421 {config.domain} shutting down, closing connection")
+                    else:
+                        self.send_response(f"421 {config.domain} idle timeout, closing connection")
+                    break
+                data = self.conn.recv(self.recv_size)
                 if not data:
                     break  # Client disconnected
-                
-                for line in data.splitlines():
+
+                conn = self.conn
+                # Only complete lines are handled, a line cut off by the read waits for the rest
+                *lines, buffer = (buffer + data).split(b"\n")
+                for line in lines:
+                    line = line.rstrip(b"\r").decode("utf-8", "replace")
                     print(f"[{self.addr}] Received: {line}")
 
-                    self.process_command(line.strip())
+                    if self.state == SMTPState.DATA:
+                        # Message lines are kept as sent, leading and trailing blanks included
+                        command = "<end of DATA>" if line == "." else "<DATA line>"
+                    elif self.limits is not None and not self.limits.allow_command(self.addr[0]):
+                        self.send_response(f"421 4.7.0 {config.domain} too many commands, closing connection")
+                        return
+                    else:
+                        line = command = line.strip()
+                    with CommandTimer("smtp", self.addr, command):
+                        self.process_command(line)
 
                     if self.state == SMTPState.QUIT:
                         return
+                    if self.conn is not conn:
+                        # Upgraded to TLS, anything sent along with STARTTLS was in clear and is dropped
+                        buffer = b""
+                        break
         
         except Exception as e:
             print(f"Exception with client {self.addr}: {e}")
         finally:
+            with contextlib.suppress(OSError):
+                self.flush()  # e.g. the reply to QUIT
             self.conn.close()
 
     def process_command(self, line):
@@ -63,11 +126,27 @@ class SMTPSession:
             self.handle_data_body(line)
                     
         elif line.upper() == "QUIT":
-            self.send_response("221 swmgmail.com closing connection")
+            self.send_response(f"221 {config.domain} closing connection")
             self.state = SMTPState.QUIT
 
         elif line.upper().startswith("HELO"):
             self.handle_helo(line)
+
+        elif line.upper().startswith("EHLO"):
+            self.handle_ehlo(line)
+
+        elif line.upper() == "STARTTLS":
+            self.handle_starttls()
+
+        elif line.upper() == "NOOP":
+            self.send_response("250 OK")
+
+        elif line.upper() == "RSET":
+            # Drops the transaction in progress, the HELO stays valid
+            if self.state != SMTPState.INIT:
+                self.reset()
+                self.state = SMTPState.HELO_DONE
+            self.send_response("250 OK")
         
         elif self.state == SMTPState.INIT: # Can always restart with HELO
             self.send_response("500 Error: send HELO first")
@@ -91,9 +170,40 @@ class SMTPSession:
         if len(line.split(" ")) != 2:
             self.send_response("501 Syntax: HELO hostname")
         else:
-            self.send_response("250 OK Hello swmgmail.com")
+            self.send_response(f"250 OK Hello {config.domain}")
             self.state = SMTPState.HELO_DONE
 
+    def handle_ehlo(self, line):
+        """Handles the EHLO command, which is HELO listing the extensions offered."""
+        self.reset()
+        if len(line.split(" ")) != 2:
+            self.send_response("501 Syntax: EHLO hostname")
+            return
+        lines = [f"{config.domain} Hello"]
+        if self.tls is not None and not is_tls(self.conn):
+            lines.append("STARTTLS")
+        replies = [f"250-{text}" for text in lines[:-1]] + [f"250 {lines[-1]}"]
+        self.send_response("\r\n".join(replies))
+        self.state = SMTPState.HELO_DONE
+
+    def handle_starttls(self):
+        """Handles the STARTTLS command (RFC 3207), the client has to say HELO again afterwards."""
+        if self.tls is None:
+            self.send_response("502 5.5.1 STARTTLS not available")
+            return
+        if is_tls(self.conn):
+            self.send_response("503 5.5.1 TLS already active")
+            return
+        self.send_response("220 2.0.0 Ready to start TLS")
+        self.flush()
+        # The handshake is bounded by the command timeout set on the socket
+        tls_conn = self.tls.wrap_socket(self.conn, server_side=True)
+        if self.sessions is not None:
+            self.sessions.replace(self.conn, tls_conn)
+        self.conn = tls_conn
+        self.output = ReplyBuffer(tls_conn)
+        self.reset()
+
     def handle_mail_from(self, line):
         """Handles the MAIL FROM command."""
         if self.state != SMTPState.HELO_DONE:
@@ -102,6 +212,10 @@ class SMTPSession:
         sender = extract_email(line, can_be_empty=True)
         if sender == "Invalid address":
             self.send_response("500 Error: Invalid address")
+            return
+        if self.limits is not None and not self.limits.allow_account(sender.lower()):
+            self.send_response("450 4.7.1 Sender rate limit exceeded, try again later")
+            return
         self.sender = sender
         self.send_response("250 OK")
         self.state = SMTPState.MAIL_FROM_DONE
@@ -118,9 +232,24 @@ class SMTPSession:
         
         username = recipient.split("@")[0]
         domain = recipient.split("@")[1]
-        if domain != "swmgmail.com" or username not in get_valid_usernames():
+        if domain != config.domain:
+            # The client address decides, MAIL FROM is only checked so bounces have a mailbox to go to
+            if self.relay is None or not self.relay.allows(self.addr[0]) or not is_local_address(self.sender):
+                self.send_response("550 5.7.1 Relaying denied")
+                return
+            if self.relay.destination(domain) is None:
+                self.send_response("550 5.1.2 No route to domain")
+                return
+            self.recipients.append(recipient)
+            self.send_response("250 OK")
+            self.state = SMTPState.RCPT_TO_DONE
+            return
+        if not storage.store.has_user(username):
             self.send_response("550 5.1.1 User unknown")
             return
+        if self.quotas is not None and self.quotas.remaining(username) <= 0:
+            self.send_response("452 4.2.2 Mailbox full")
+            return
 
         self.recipients.append(recipient)
         self.send_response("250 OK")
@@ -139,39 +268,74 @@ class SMTPSession:
         """Handles the body of the email message."""
         if line == ".":
             self.finalize_message()
+        elif line.startswith("."):
+            self.data_lines.append(line[1:]) # Remove the client's dot-stuffing
         else:
             self.data_lines.append(line)
 
     def finalize_message(self):
         """Finalizes and stores the email message."""
-        timestamp = datetime.datetime.now().strftime("%m/%d/%Y : %H:%M")
-        message = "".join(f"{line}\r\n" for line in self.data_lines[:3]) # First the From, To and Subject lines
-        message += f"Received: {timestamp}\r\n" # Then the data line
-        message += "".join(f"{line}\r\n" for line in self.data_lines[3:]) # Then the message body
-        message += ".\r\n"  # End marker
+        message = stamp_message(self.data_lines)
         
-        # Save the message to each recipient's mailbox
-        for rec in self.recipients:
-            username = rec.split("@")[0]
-            os.makedirs(username, exist_ok=True)
-            mailbox_path = os.path.join(username, "my_mailbox.txt")
-            threading.Thread(target=write_message, args=(message, mailbox_path)).start()
-
-        self.send_response("250 Mail accepted for delivery")
+        usernames = [rec.split("@")[0] for rec in self.recipients if rec.split("@")[1] == config.domain]
+        remote = [rec for rec in self.recipients if rec.split("@")[1] != config.domain]
+        if self.quotas is not None:
+            octets = len(message.encode("utf-8")) - len(".\r\n")
+            if any(self.quotas.remaining(username) < octets for username in usernames):
+                self.send_response("552 5.2.2 Mailbox full, message exceeds storage allocation")
+                self.reset()
+                self.state = SMTPState.HELO_DONE
+                return
+
+        try:
+            if remote:
+                # Spooled for the relay; it is on disk before the mail is acknowledged
+                timed("io", self.relay.submit, self.sender, remote, message)
+            if self.journal is not None:
+                # Acknowledged once it is safely in the journal, the mailboxes follow shortly
+                timed("io", self.journal.submit, message, usernames, self.compression)
+            else:
+                # Save the message to each recipient's mailbox before acknowledging it
+                for username in usernames:
+                    write_message(message, username, self.compression)
+        except (OSError, sqlite3.Error, JournalError) as e:
+            print(f"Delivery failed for {self.addr}: {e}")
+            self.send_response("451 Requested action aborted: local error in processing")
+        else:
+            self.send_response("250 Mail accepted for delivery")
         
         # Reset state for new message
         self.reset()
         self.state = SMTPState.HELO_DONE
 
-def write_message(message, mailbox_path):
-    with open(mailbox_path, "a") as f:
-        # Lock the file before writing
-        fcntl.flock(f, fcntl.LOCK_EX)
-        try:
-            f.write(message)
-            f.flush()
-        finally:
-            fcntl.flock(f, fcntl.LOCK_UN)
+def get_timestamp() -> str:
+    return datetime.datetime.now().strftime("%m/%d/%Y : %H:%M")
+
+
+def stamp_message(data_lines, timestamp=None) -> str:
+    """Builds the stored form of a message, adding the Received: header.
+
+    The result is in POP3 wire form (CRLF, dot-stuffed, terminated), so the mailbox
+    can hand it out unchanged and its size is known up front.
+    """
+    if timestamp is None:
+        timestamp = get_timestamp()
+    data_lines = ["." + line if line.startswith(".") else line for line in data_lines]
+    message = "".join(f"{line}\r\n" for line in data_lines[:3]) # First the From, To and Subject lines
+    message += f"Received: {timestamp}\r\n" # Then the data line
+    message += "".join(f"{line}\r\n" for line in data_lines[3:]) # Then the message body
+    message += ".\r\n"  # End marker
+    return message
+
+
+def write_message(message, username, compression=None):
+    write_messages([message], username, compression)
+
+
+def write_messages(messages, username, compression=None):
+    """Stores a batch of stamped messages in a user's mailbox in one go (a single lock or transaction)."""
+    storage.store.deliver(username, messages, compression)
+    notify.new_mail([username])
 
 def extract_email(line: str, can_be_empty=False) -> str:
     # Ensure the command contains '<' and '>'
@@ -194,48 +358,162 @@ def extract_email(line: str, can_be_empty=False) -> str:
     return address
 
 
+class Quotas:
+    """Per-user mailbox size limits in octets, checked against the mailbox usage counters."""
+
+    def __init__(self, default=None, overrides=None):
+        self.default = default
+        self.overrides = overrides or {}
+
+    @classmethod
+    def from_file(cls, path, default=None):
+        """Reads "<username> <octets>" lines, 0 meaning unlimited."""
+        overrides = {}
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    overrides[parts[0]] = int(parts[1]) or None
+        return cls(default, overrides)
+
+    def limit(self, username):
+        return self.overrides.get(username, self.default)
+
+    def remaining(self, username):
+        """Octets username can still receive (infinite without a limit)."""
+        limit = self.limit(username)
+        if limit is None:
+            return float("inf")
+        return limit - storage.store.usage(username)[1]
+
+
+def is_local_address(address) -> bool:
+    username, _, domain = address.partition("@")
+    return domain == config.domain and storage.store.has_user(username)
+
+
+def bounce_message(sender, failures, message):
+    """Returns relayed mail that could not be delivered to its sender's mailbox."""
+    if not is_local_address(sender):
+        print(f"Dropping bounce for {sender}: not a local address")
+        return
+    lines = [f"From: MAILER-DAEMON@{config.domain}", f"To: {sender}", "Subject: Undelivered Mail Returned to Sender",
+             "Your message could not be delivered to the following recipients:"]
+    lines += [f"   {recipient}: {reason}" for recipient, reason in failures.items()]
+    lines += ["", "----- Original message -----"] + message_lines(message)
+    write_message(stamp_message(lines), sender.partition("@")[0])
+
+
 def get_valid_usernames() -> list:
-    # no lock since this file is written manually
-    usernames = []
-    with open('userinfo.txt', "r") as f:
-        content = f.read()
-    for line in content.splitlines():
-        usernames.append(line.split(' ')[0])
-    return usernames
+    return storage.store.usernames()
 
 
 class SMTPServer:
     """Manages the SMTP server and client connections."""
 
-    def __init__(self, port):
+    def __init__(self, port, server_socket=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, command_timeout=DEFAULT_COMMAND_TIMEOUT,
+                 max_sessions=DEFAULT_MAX_SESSIONS, drain_timeout=DEFAULT_DRAIN_TIMEOUT, compression=None,
+                 journal_dir=None, journal_commit_interval=DEFAULT_COMMIT_INTERVAL, quotas=None, recv_size=DEFAULT_RECV_SIZE,
+                 backlog=DEFAULT_BACKLOG, relay=None, limits=None, tls=None):
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        self.server_socket.bind(("", port))
-        self.server_socket.listen(5)
+        if server_socket is None:
+            server_socket = create_listener(port, backlog)
+        self.server_socket = server_socket
+        self.idle_timeout = idle_timeout
+        self.command_timeout = command_timeout
+        self.recv_size = recv_size
+        self.drain_timeout = drain_timeout
+        self.compression = compression
+        self.journal = DeliveryJournal(journal_dir, journal_commit_interval) if journal_dir else None
+        self.quotas = quotas
+        self.relay = Relay(bounce=bounce_message, **relay) if relay else None
+        self.limits = limits
+        self.tls = tls
+        self.sessions = SessionRegistry(max_sessions)
     
     def start(self):
         """Starts the SMTP server to accept incoming connections."""
         print(f"SMTP Server running on port {self.port}...")
+        install_profiler_signal()
         try:
             while True:
                 conn, addr = self.server_socket.accept()
+                if self.limits is not None and not self.limits.allow_connection(addr[0]):
+                    reject(conn, f"421 4.7.0 {config.domain} too many connections from your address, try again later")
+                    continue
+                if not self.sessions.add(conn):
+                    reject(conn, f"421 {config.domain} too many connections, try again later")
+                    continue
                 print(f"Connection established with {addr}")
                 threading.Thread(target=self.handle_connection, args=(conn, addr)).start()
         except KeyboardInterrupt:
             print("\nShutting down the SMTP server.")
         finally:
             self.server_socket.close()
+            self.shutdown()
+
+    def shutdown(self):
+        """Lets open sessions finish their current transaction, then closes them."""
+        if len(self.sessions):
+            print(f"Draining {len(self.sessions)} open sessions...")
+        leftover = self.sessions.drain(self.drain_timeout)
+        if leftover:
+            print(f"Closed {leftover} sessions that did not finish in time.")
+        if self.journal is not None:
+            self.journal.close()
+        if self.relay is not None:
+            self.relay.close()
 
     def handle_connection(self, conn, addr):
         """Handles a new SMTP connection."""
-        session = SMTPSession(conn, addr)
-        session.handle_client()
+        session = SMTPSession(conn, addr, self.idle_timeout, self.command_timeout, self.sessions.draining,
+                              self.compression, self.journal, self.quotas, self.recv_size, self.relay,
+                              self.limits, self.tls, self.sessions)
+        try:
+            session.handle_client()
+        finally:
+            self.sessions.remove(session.conn)
+
+def serve(server_socket, **options):
+    """Runs an SMTP accept loop on an already listening socket (used by the workers)."""
+    SMTPServer(server_socket.getsockname()[1], server_socket, **options).start()
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python mailserver_smtp.py <port>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(usage="python mailserver_smtp.py [<port>] [--workers N] [--config FILE]")
+    parser.add_argument("port", type=int, nargs="?", default=SMTP_PORT)
+    add_worker_arguments(parser)
+    config.add_mail_arguments(parser)
+    parser.add_argument("--compression", choices=sorted(COMPRESSORS), help="compress delivered mail with this codec")
+    parser.add_argument("--journal", metavar="DIR", help="journal accepted mail in DIR before acknowledging it")
+    parser.add_argument("--journal-commit-interval", type=float, default=DEFAULT_COMMIT_INTERVAL,
+                        help="seconds a journal commit waits for more mail to share its fsync")
+    parser.add_argument("--quota", type=int, help="default mailbox size limit per user in octets")
+    parser.add_argument("--quota-file", help='per-user limits, one "<username> <octets>" line each (0 is unlimited)')
+    add_relay_arguments(parser)
+    add_session_arguments(parser, default_idle_timeout=DEFAULT_IDLE_TIMEOUT)
+    add_rate_limit_arguments(parser, "sender")
+    add_tls_arguments(parser)
+    add_profiling_arguments(parser)
+    args = config.parse_args(parser, "smtp")
+    config.apply_mail_options(args)
+    apply_profiling_options(args)
+    options = session_options(args)
+    options["compression"] = args.compression
+    options["journal_dir"] = args.journal
+    options["journal_commit_interval"] = args.journal_commit_interval
+    if args.relay_spool:
+        options["relay"] = relay_options(args)
+    options["limits"] = rate_limit_options(args)
+    options["tls"] = tls_options(args)
+    if args.quota_file:
+        options["quotas"] = Quotas.from_file(args.quota_file, args.quota)
+    elif args.quota:
+        options["quotas"] = Quotas(args.quota)
 
-    port = int(sys.argv[1])
-    server = SMTPServer(port)
-    server.start()
+    if args.workers > 1:
+        run_workers(functools.partial(serve, **options), args.port, args.workers, args.backlog)
+    else:
+        handle_sigterm()
+        server = SMTPServer(args.port, backlog=args.backlog, **options)
+        server.start()
@@ -0,0 +1,650 @@
+"""
+mailstore.py
+------------
+Access to the mailbox files (<mail root>/<ab>/<cd>/<username>/my_mailbox.txt) and their size index.
+Users are spread over two levels of directories named after the first hex digits of the MD5 hash
+of their name, so no directory grows large however many users there are.
+A mailbox holds messages in POP3 wire form: CRLF line endings, lines starting with "."
+dot-stuffed, and each message terminated by a line holding only ".".
+Next to every mailbox lives an index (<username>/my_mailbox.idx) with one line per message:
+   <offset> <length> <octets> [<codec>]
+offset and length locate the stored message (terminator included) in the mailbox, octets is
+its RFC 1939 size. Entries are written when a message is delivered, so STAT and LIST read
+sizes from the index instead of re-scanning the mailbox. Mailboxes without a valid index
+(older or hand-written ones) are scanned once, normalised to wire form and re-indexed.
+Deployments can compress messages on delivery (zlib or lzma). A compressed message is stored as
+a frame "\0<codec> <octets> <compressed length>\n<compressed data>" and its index entry names
+the codec; plain and compressed messages can share a mailbox. Compressed messages are inflated
+in chunks while they are sent, the index keeps both sizes so STAT and LIST never decompress.
+A third file (<username>/my_mailbox.usage) holds "<messages> <octets> <mailbox size>", the running
+totals of the mailbox. It is updated with every delivery and deletion, so quota checks and STAT
+cost a single small read; when the recorded mailbox size does not match the file it is recomputed.
+Mailboxes read over IMAP also get stable message UIDs and flags: <username>/my_mailbox.uids holds
+a line "<uid> [<flag> ...]" per message in mailbox order, and <username>/my_mailbox.uidnext holds
+"<uidvalidity> <uidnext>". Both are created on the first IMAP access, extended on delivery and
+filtered along with the mailbox when messages are removed; if they stop matching the mailbox
+(a rebuilt or merged mailbox) they are dropped and made afresh under a new UIDVALIDITY.
+"""
+
+import datetime
+import fcntl
+import hashlib
+import lzma
+import mmap
+import os
+import shutil
+import threading
+import zlib
+
+from profiling import timed
+
+TERMINATOR = b".\r\n"
+FRAME_MARKER = b"\0"
+COMPRESSORS = {
+    "zlib": zlib.compress,
+    "lzma": lzma.compress,
+}
+DECOMPRESSORS = {
+    "zlib": zlib.decompressobj,
+    "lzma": lzma.LZMADecompressor,
+}
+CHUNK_SIZE = 64 * 1024
+RECEIVED_FORMAT = "%m/%d/%Y : %H:%M"
+DEFAULT_MAIL_ROOT = "mail"
+MAILBOX_NAME = "my_mailbox.txt"
+
+mail_root = DEFAULT_MAIL_ROOT
+
+
+def set_mail_root(path):
+    """Selects the directory mailboxes are kept under (set once at startup)."""
+    global mail_root
+    mail_root = path
+
+
+def get_user_dir(username, root=None):
+    """Returns <root>/<ab>/<cd>/<username>, ab and cd being the first bytes of the name's MD5 hash."""
+    digest = hashlib.md5(username.encode("utf-8")).hexdigest()
+    return os.path.join(mail_root if root is None else root, digest[0:2], digest[2:4], username)
+
+
+def get_mailbox_path(username, root=None):
+    return os.path.join(get_user_dir(username, root), MAILBOX_NAME)
+
+
+def get_index_path(mailbox_path):
+    return os.path.splitext(mailbox_path)[0] + ".idx"
+
+
+def get_usage_path(mailbox_path):
+    return os.path.splitext(mailbox_path)[0] + ".usage"
+
+
+def get_uids_path(mailbox_path):
+    return os.path.splitext(mailbox_path)[0] + ".uids"
+
+
+def get_uidnext_path(mailbox_path):
+    return os.path.splitext(mailbox_path)[0] + ".uidnext"
+
+
+def get_maildrop_lock_path(username):
+    return os.path.splitext(get_mailbox_path(username))[0] + ".lock"
+
+
+def scan_messages(buf):
+    """Returns (start, end, next_start) for every complete message in buf.
+
+    buf[start:end] is the message without its line ending and terminator line,
+    next_start is where the following message begins.
+    """
+    spans = []
+    size = len(buf)
+    start = 0
+    while start < size:
+        if buf[start:start + 1] == FRAME_MARKER:
+            # Compressed message, its header gives the length
+            try:
+                next_start = parse_frame(buf, start)[3]
+            except ValueError:
+                break  # incomplete frame header
+            if next_start > size:
+                break  # incomplete frame
+            end = next_start
+        elif buf[start:start + 2] == b".\n" or buf[start:start + 3] == b".\r\n":
+            # Empty message: the terminator is the first line
+            end = start
+            next_start = start + (2 if buf[start + 1:start + 2] == b"\n" else 3)
+        else:
+            pos = buf.find(b"\n.", start)
+            while pos != -1:
+                line_end = buf[pos + 2:pos + 4]
+                if line_end[:1] == b"\n" or line_end == b"\r\n":
+                    break
+                pos = buf.find(b"\n.", pos + 2)
+            if pos == -1:
+                break  # incomplete message, e.g. still being written
+            next_start = pos + (3 if line_end[:1] == b"\n" else 4)
+            end = pos - 1 if buf[pos - 1:pos] == b"\r" else pos
+        spans.append((start, end, next_start))
+        start = next_start
+    return spans
+
+
+def parse_frame(buf, offset):
+    """Returns (codec, octets, data_start, frame_end) of the compressed frame at offset."""
+    header = bytes(buf[offset:offset + 64])
+    header_end = header.index(b"\n")
+    codec, octets, length = header[1:header_end].decode("ascii").split()
+    data_start = offset + header_end + 1
+    return codec, int(octets), data_start, data_start + int(length)
+
+
+def make_record(message, compression=None):
+    """Encodes a stamped message for storage, returns (record, octets, codec).
+
+    Messages that do not get smaller by compressing them are stored plain.
+    """
+    record = message.encode("utf-8")
+    return encode_record(record, len(record) - len(TERMINATOR), compression)
+
+
+def encode_record(record, octets, compression=None):
+    if compression is not None:
+        data = COMPRESSORS[compression](record)
+        header = FRAME_MARKER + f"{compression} {octets} {len(data)}\n".encode("ascii")
+        if len(header) + len(data) < len(record):
+            return header + data, octets, compression
+    return record, octets, None
+
+
+def parse_received(head):
+    """Returns the Received: time found in a message head, or None."""
+    start = head.find(b"Received: ")
+    if start == -1:
+        return None
+    start += len(b"Received: ")
+    end = head.find(b"\r\n", start)
+    try:
+        return datetime.datetime.strptime(bytes(head[start:end]).decode("ascii"), RECEIVED_FORMAT)
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+def to_wire_form(content):
+    """Converts a message stored with bare LF line endings to CRLF, dot-stuffed form."""
+    lines = bytes(content).split(b"\n")
+    lines = [b"." + line if line.startswith(b".") else line for line in (line.rstrip(b"\r") for line in lines)]
+    return b"\r\n".join(lines) + b"\r\n" + TERMINATOR
+
+
+def parse_index(data, mailbox_size):
+    """Parses index file contents, returns None if they do not describe the mailbox exactly."""
+    entries = []
+    expected_offset = 0
+    try:
+        for line in data.splitlines():
+            fields = line.split()
+            offset, length, octets = (int(field) for field in fields[:3])
+            codec = fields[3] if len(fields) > 3 else None
+            if offset != expected_offset or (codec is not None and codec not in DECOMPRESSORS):
+                return None
+            entries.append((offset, length, octets, codec))
+            expected_offset = offset + length
+    except ValueError:
+        return None
+    if expected_offset != mailbox_size:
+        return None
+    return entries
+
+
+def format_index(entries):
+    return "".join(f"{offset} {length} {octets} {codec}\n" if codec else f"{offset} {length} {octets}\n"
+                   for offset, length, octets, codec in entries)
+
+
+def write_index(mailbox_path, entries):
+    index_path = get_index_path(mailbox_path)
+    with open(index_path + ".tmp", "w") as f:
+        f.write(format_index(entries))
+    os.replace(index_path + ".tmp", index_path)
+
+
+def write_usage(mailbox_path, count, octets, size):
+    usage_path = get_usage_path(mailbox_path)
+    tmp_path = f"{usage_path}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "w") as f:
+        f.write(f"{count} {octets} {size}\n")
+    os.replace(tmp_path, usage_path)
+
+
+def _load_usage(mailbox_path, mailbox_size):
+    """Returns the recorded (messages, octets), or None if they do not match the mailbox."""
+    try:
+        with open(get_usage_path(mailbox_path), "r") as f:
+            count, octets, size = (int(field) for field in f.read().split())
+    except (FileNotFoundError, ValueError):
+        return None
+    return (count, octets) if size == mailbox_size else None
+
+
+def read_usage(mailbox_path):
+    """Returns (messages, octets) stored in a mailbox without scanning it."""
+    try:
+        mailbox_size = os.stat(mailbox_path).st_size
+    except FileNotFoundError:
+        return 0, 0
+    usage = _load_usage(mailbox_path, mailbox_size)
+    if usage is None:
+        with MailboxReader(mailbox_path) as mailbox:
+            usage = (len(mailbox), sum(mailbox.sizes()))
+            write_usage(mailbox_path, *usage, mailbox._size)
+    return usage
+
+
+def read_uids(mailbox_path, count):
+    """Returns (uidvalidity, uidnext, [(uid, flags)]) of a mailbox holding count messages.
+
+    Returns None when the mailbox has no UIDs yet or they do not match it (count None skips that check).
+    """
+    try:
+        with open(get_uidnext_path(mailbox_path), "r") as f:
+            uidvalidity, uidnext = (int(field) for field in f.read().split())
+        with open(get_uids_path(mailbox_path), "r") as f:
+            lines = f.read().splitlines()
+        messages = []
+        for line in lines:
+            uid, *flags = line.split()
+            messages.append((int(uid), frozenset(flags)))
+    except (FileNotFoundError, ValueError):
+        return None
+    if count is not None and len(messages) != count:
+        return None
+    return uidvalidity, uidnext, messages
+
+
+def write_uids(mailbox_path, uidvalidity, uidnext, messages):
+    """Writes the UIDs and flags of a mailbox, which the caller holds the exclusive lock of."""
+    uids_path = get_uids_path(mailbox_path)
+    with open(uids_path + ".tmp", "w") as f:
+        f.write("".join(" ".join([str(uid), *sorted(flags)]) + "\n" for uid, flags in messages))
+    os.replace(uids_path + ".tmp", uids_path)
+    _write_uidnext(mailbox_path, uidvalidity, uidnext)
+
+
+def _write_uidnext(mailbox_path, uidvalidity, uidnext):
+    uidnext_path = get_uidnext_path(mailbox_path)
+    with open(uidnext_path + ".tmp", "w") as f:
+        f.write(f"{uidvalidity} {uidnext}\n")
+    os.replace(uidnext_path + ".tmp", uidnext_path)
+
+
+def drop_uids(mailbox_path):
+    """Forgets a mailbox's UIDs, the next IMAP access numbers its messages afresh."""
+    for path in (get_uidnext_path(mailbox_path), get_uids_path(mailbox_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _append_uids(mailbox_path, count):
+    """Gives count newly appended messages the next UIDs, if the mailbox has UIDs at all."""
+    try:
+        with open(get_uidnext_path(mailbox_path), "r") as f:
+            uidvalidity, uidnext = (int(field) for field in f.read().split())
+    except (FileNotFoundError, ValueError):
+        return
+    with open(get_uids_path(mailbox_path), "a") as f:
+        f.write("".join(f"{uid}\n" for uid in range(uidnext, uidnext + count)))
+    _write_uidnext(mailbox_path, uidvalidity, uidnext + count)
+
+
+def _write_out(f, data, fsync=False):
+    f.write(data)
+    f.flush()
+    if fsync:
+        os.fsync(f.fileno())
+
+
+def append_messages(mailbox_path, messages, compression=None, fsync=False):
+    """Appends stamped messages to a mailbox and its index under a single lock.
+
+    compression names the codec ("zlib" or "lzma") to store the messages with, if any.
+    With fsync=True the mailbox is on disk when this returns.
+    """
+    encoded = [make_record(message, compression) for message in messages]
+    try:
+        f = open(mailbox_path, "ab")
+    except FileNotFoundError:
+        # First delivery to this user
+        os.makedirs(os.path.dirname(mailbox_path), exist_ok=True)
+        f = open(mailbox_path, "ab")
+    with f:
+        # Lock the file before writing
+        timed("lock", fcntl.flock, f, fcntl.LOCK_EX)
+        try:
+            offset = f.seek(0, os.SEEK_END)
+            usage = _load_usage(mailbox_path, offset)
+            entries = []
+            for record, octets, codec in encoded:
+                entries.append((offset, len(record), octets, codec))
+                offset += len(record)
+            timed("io", _write_out, f, b"".join(record for record, _, _ in encoded), fsync)
+            with open(get_index_path(mailbox_path), "a") as index:
+                index.write(format_index(entries))
+            _append_uids(mailbox_path, len(entries))
+            if usage is not None:
+                write_usage(mailbox_path, usage[0] + len(entries), usage[1] + sum(entry[2] for entry in entries), offset)
+            elif os.path.exists(get_usage_path(mailbox_path)):
+                os.remove(get_usage_path(mailbox_path))  # recomputed on the next read
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class MaildropLock:
+    """The lock a POP3 session holds on its user's maildrop from login until it ends (RFC 1939).
+
+    Sessions take it shared, so a client may keep several open (e.g. one in IDLE); maintenance
+    takes it exclusively and leaves mailboxes it cannot get alone, since rewriting a mailbox
+    renumbers the messages a session refers to. Removals do not depend on it: POP3 and IMAP
+    sessions both mark mail by UID and remove it with remove_uids, so removals by one session
+    never shift those of another, and IMAP sessions (which report such removals as EXPUNGE)
+    do not take it. It is a file of its own next to the mailbox, for either store.
+    """
+
+    def __init__(self, username):
+        path = get_maildrop_lock_path(username)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a")
+
+    def acquire(self, exclusive=False, blocking=True):
+        """Takes the lock, returns False if it is held elsewhere and blocking is False."""
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            timed("lock", fcntl.flock, self._file, operation if blocking else operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def release(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class MailboxReader:
+    """Gives indexed access to a mailbox for the duration of a with-block.
+
+    The mailbox is held under a shared lock (exclusive when exclusive=True) so it cannot
+    be rewritten meanwhile. entries holds the (offset, length, octets, codec) index of
+    every message; the file is only memory-mapped when a message body is requested, and
+    message bodies are handed out as memoryview slices of that mapping.
+    A missing mailbox reads as empty.
+    """
+
+    def __init__(self, path, exclusive=False):
+        self.path = path
+        self.exclusive = exclusive
+        self._file = None
+        self._size = 0
+        self.buf = b""
+        self.entries = []
+
+    def __enter__(self):
+        self._open(self.exclusive)
+        if self.entries is None:
+            # Rebuilding needs the exclusive lock; keep it for the rest of the block
+            if not self.exclusive:
+                self.close()
+                self._open(True)
+            if self.entries is None:
+                self._rebuild()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _open(self, exclusive):
+        try:
+            self._file = open(self.path, "r+b" if exclusive else "rb")
+        except FileNotFoundError:
+            self.entries = []
+            return
+        timed("lock", fcntl.flock, self._file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        self._size = os.fstat(self._file.fileno()).st_size
+        try:
+            with open(get_index_path(self.path), "r") as index:
+                self.entries = parse_index(index.read(), self._size)
+        except FileNotFoundError:
+            self.entries = [] if self._size == 0 else None
+
+    def _map(self):
+        if self._size > 0 and not isinstance(self.buf, mmap.mmap):
+            self.buf = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+        return self.buf
+
+    def _unmap(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.buf = b""
+
+    def _rebuild(self):
+        """Scans the mailbox, normalises it to wire form and writes a fresh index."""
+        buf = self._map()
+        spans = scan_messages(buf)
+        records = []
+        details = []
+        rewrite = False
+        for start, end, next_start in spans:
+            record = buf[start:next_start]
+            if record[:1] == FRAME_MARKER:
+                codec, octets, _, _ = parse_frame(record, 0)
+            else:
+                if record.count(b"\n") != record.count(b"\r\n"):
+                    record = to_wire_form(buf[start:end])
+                    rewrite = True
+                codec, octets = None, len(record) - len(TERMINATOR)
+            records.append(record)
+            details.append((len(record), octets, codec))
+        tail = buf[spans[-1][2] if spans else 0:]
+        if tail.strip() and tail[:1] != FRAME_MARKER:
+            # An unterminated message left behind by an interrupted write
+            record = to_wire_form(tail.rstrip(b"\r\n"))
+            records.append(record)
+            details.append((len(record), len(record) - len(TERMINATOR), None))
+        if tail or rewrite:
+            self._replace_content(b"".join(records))
+        entries = []
+        offset = 0
+        for length, octets, codec in details:
+            entries.append((offset, length, octets, codec))
+            offset += length
+        write_index(self.path, entries)
+        write_usage(self.path, len(entries), sum(entry[2] for entry in entries), self._size)
+        drop_uids(self.path)
+        self.entries = entries
+
+    def _replace_content(self, content):
+        """Overwrites the locked mailbox in place (blocked appenders hold the inode, not the name)."""
+        self._unmap()
+        self._file.seek(0)
+        timed("io", _write_out, self._file, content)
+        self._file.truncate()
+        self._size = len(content)
+
+    def close(self):
+        self._unmap()
+        self.entries = []
+        if self._file is not None:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            finally:
+                self._file.close()
+                self._file = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def message(self, number):
+        """Returns message number (1-based) in wire form, terminator included.
+
+        Plain messages come as a memoryview of the mapping, compressed ones as bytes.
+        Returns None if the message does not exist.
+        """
+        if not (1 <= number <= len(self.entries)):
+            return None
+        offset, length, _, codec = self.entries[number - 1]
+        view = memoryview(self._map())[offset:offset + length]
+        if codec is None:
+            return view
+        try:
+            return b"".join(self._inflate(view, codec))
+        finally:
+            view.release()
+
+    def message_chunks(self, number):
+        """Yields message number (1-based) in wire form piece by piece.
+
+        A plain message is a single memoryview slice, a compressed one is inflated
+        CHUNK_SIZE compressed bytes at a time so it never sits in memory whole.
+        The generator must be finished or closed before the reader is closed.
+        """
+        offset, length, _, codec = self.entries[number - 1]
+        view = memoryview(self._map())[offset:offset + length]
+        try:
+            if codec is None:
+                yield view
+            else:
+                yield from self._inflate(view, codec)
+        finally:
+            view.release()
+
+    @staticmethod
+    def _inflate(frame, codec):
+        _, _, data_start, frame_end = parse_frame(frame, 0)
+        decompressor = DECOMPRESSORS[codec]()
+        for pos in range(data_start, frame_end, CHUNK_SIZE):
+            chunk = decompressor.decompress(frame[pos:min(pos + CHUNK_SIZE, frame_end)])
+            if chunk:
+                yield chunk
+        if hasattr(decompressor, "flush"):
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+
+    def message_head(self, number, limit=1024):
+        """Returns at most the first limit bytes of message number, enough for its headers."""
+        offset, length, _, codec = self.entries[number - 1]
+        buf = self._map()
+        if codec is None:
+            return buf[offset:offset + min(length, limit)]
+        _, _, data_start, frame_end = parse_frame(buf, offset)
+        decompressor = DECOMPRESSORS[codec]()
+        return decompressor.decompress(buf[data_start:min(frame_end, data_start + CHUNK_SIZE)], limit)
+
+    def record(self, number):
+        """Returns message number as stored, a compressed message as its frame."""
+        offset, length, _, _ = self.entries[number - 1]
+        return bytes(self._map()[offset:offset + length])
+
+    def octets(self, number):
+        return self.entries[number - 1][2]
+
+    def sizes(self):
+        return [entry[2] for entry in self.entries]
+
+    def uids(self):
+        """Returns the UID of every message, None if the mailbox has none assigned."""
+        state = read_uids(self.path, len(self.entries))
+        return None if state is None else [uid for uid, _ in state[2]]
+
+
+def remove_messages(path, numbers):
+    """Rewrites a mailbox and its index without the given (1-based) message numbers.
+
+    The whole rewrite happens under an exclusive lock, so mail appended by other
+    processes before the lock was taken is kept.
+    """
+    if not numbers:
+        return
+    rewrite_mailbox(path, lambda mailbox, number: number not in numbers)
+
+
+def rewrite_mailbox(path, keep=None, compression=None):
+    """Rewrites a mailbox in place under an exclusive lock, together with its index and usage.
+
+    keep(mailbox, number) decides which messages stay; with compression, plain messages
+    are compressed on the way. The file is only rewritten when something changes.
+    Returns (messages dropped, bytes the mailbox shrank by).
+    """
+    with MailboxReader(path, exclusive=True) as mailbox:
+        if mailbox._file is None:
+            return 0, 0
+        view = memoryview(mailbox._map())
+        uid_state = read_uids(path, len(mailbox.entries))
+        parts = []
+        entries = []
+        kept = []
+        new_offset = 0
+        record = None
+        for i, (offset, length, octets, codec) in enumerate(mailbox.entries, start=1):
+            if keep is not None and not keep(mailbox, i):
+                continue
+            kept.append(i)
+            record = view[offset:offset + length]
+            if compression is not None and codec is None:
+                record, _, codec = encode_record(bytes(record), octets, compression)
+                length = len(record)
+            parts.append(record)
+            entries.append((new_offset, length, octets, codec))
+            new_offset += length
+        dropped = len(mailbox.entries) - len(entries)
+        if new_offset == mailbox._size and not dropped:
+            del parts, view, record
+            return 0, 0
+        content = b"".join(parts)
+        del parts, view, record
+        old_size = mailbox._size
+        mailbox._replace_content(content)
+        write_index(path, entries)
+        write_usage(path, len(entries), sum(entry[2] for entry in entries), len(content))
+        if uid_state is not None:
+            uidvalidity, uidnext, uids = uid_state
+            write_uids(path, uidvalidity, uidnext, [uids[i - 1] for i in kept])
+        else:
+            drop_uids(path)
+        return dropped, old_size - len(content)
+
+
+def move_mailbox(source, target):
+    """Moves a mailbox with its index and usage files to target.
+
+    When target already holds mail the two are merged, the messages from source first.
+    """
+    with MailboxReader(source, exclusive=True) as old:
+        if old._file is None:
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if not os.path.exists(target):
+            # The reader has brought the index up to date; move the mailbox last
+            for path_of in (get_index_path, get_usage_path, get_uids_path, get_uidnext_path, lambda path: path):
+                if os.path.exists(path_of(source)):
+                    shutil.move(path_of(source), path_of(target))
+            return
+        old_content = bytes(old._map())
+        old_entries = old.entries
+        with MailboxReader(target, exclusive=True) as new:
+            content = old_content + bytes(new._map())
+            entries = old_entries + [(offset + len(old_content), length, octets, codec)
+                                     for offset, length, octets, codec in new.entries]
+            new._replace_content(content)
+            write_index(target, entries)
+            write_usage(target, len(entries), sum(entry[2] for entry in entries), len(content))
+            drop_uids(target)
+        drop_uids(source)
+        for path in (get_index_path(source), get_usage_path(source), source):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,151 @@
+"""
+maintenance.py
+--------------
+Background mailbox maintenance: retention expiry and compaction.
+A pass walks every user's mailbox and, under the mailbox lock, drops messages whose Received:
+timestamp is older than the user's retention period, compresses plain messages when a codec is
+configured, and rewrites the mailbox with a fresh index and usage counters. Stale indexes are
+rebuilt along the way. With the SQLite store the same pass deletes and compresses rows instead
+and returns freed pages to the file system. Work is paced to a byte budget per second and, inside the POP3 server,
+postponed while the server is busy, so it does not compete with RETR traffic. Only one process
+runs a pass at a time (<mail root>/maintenance.lock), so it is safe with --workers and with a
+separate maintenance process next to the servers. Mailboxes with a POP3 session open are left
+for the next pass, so the message numbers of the session (and its deletions) stay valid.
+Usage: python maintenance.py [--config FILE] [--mail-root DIR] [--retention-days N] [--retention-file FILE]
+                             [--maintenance-compression zlib|lzma] [--maintenance-interval SECONDS]
+                             [--io-rate BYTES_PER_SECOND] [--once]
+"""
+
+import argparse
+import fcntl
+import os
+import sqlite3
+import threading
+
+import mailstore
+import storage
+from mailserver_smtp import get_valid_usernames
+import config
+from mailstore import COMPRESSORS
+
+DEFAULT_INTERVAL = 3600
+DEFAULT_IO_RATE = 8 * 1024 * 1024
+QUIET_CHECK_INTERVAL = 5
+LOCK_FILE = "maintenance.lock"
+
+
+def load_retention(path):
+    """Reads "<username> <days>" lines, 0 meaning keep forever."""
+    retention = {}
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                retention[parts[0]] = int(parts[1]) or None
+    return retention
+
+
+class MaintenanceWorker(threading.Thread):
+    """Runs maintenance passes every interval seconds until stopped."""
+
+    def __init__(self, retention_days=None, retention=None, compression=None, interval=DEFAULT_INTERVAL,
+                 io_rate=DEFAULT_IO_RATE, is_quiet=None):
+        super().__init__(name="maintenance")
+        self.retention_days = retention_days
+        self.retention = retention or {}
+        self.compression = compression
+        self.interval = interval
+        self.io_rate = io_rate
+        self.is_quiet = is_quiet
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.run_pass()
+            self._stop_event.wait(self.interval)
+
+    def run_pass(self):
+        """Maintains every mailbox once, returns (messages expired, bytes reclaimed)."""
+        os.makedirs(mailstore.mail_root, exist_ok=True)
+        with open(os.path.join(mailstore.mail_root, LOCK_FILE), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0, 0  # another process is already running a pass
+            expired = reclaimed = busy = 0
+            for username in get_valid_usernames():
+                if not self._wait_until_quiet():
+                    break
+                size = storage.store.size(username)
+                if not size:
+                    continue
+                try:
+                    with mailstore.MaildropLock(username) as maildrop:
+                        if not maildrop.acquire(exclusive=True, blocking=False):
+                            busy += 1  # a POP3 session has it open
+                            continue
+                        dropped, shrunk = storage.store.maintain(
+                            username, self.retention.get(username, self.retention_days), self.compression)
+                except (OSError, sqlite3.Error) as e:
+                    print(f"Maintenance of {username}'s mailbox failed: {e}")
+                    continue
+                expired += dropped
+                reclaimed += shrunk
+                # Pace the pass: each mailbox costs its size in I/O budget
+                if self.io_rate and self._stop_event.wait(size / self.io_rate):
+                    break
+            if expired or reclaimed:
+                print(f"Maintenance expired {expired} messages and reclaimed {reclaimed} bytes.")
+            if busy:
+                print(f"Maintenance skipped {busy} mailboxes in use by POP3 sessions.")
+            return expired, reclaimed
+
+    def _wait_until_quiet(self):
+        """Blocks while the server is busy, returns False if stopped meanwhile."""
+        while self.is_quiet is not None and not self.is_quiet():
+            if self._stop_event.wait(QUIET_CHECK_INTERVAL):
+                return False
+        return not self._stop_event.is_set()
+
+
+def add_maintenance_arguments(parser):
+    parser.add_argument("--retention-days", type=int, help="expire mail older than this many days")
+    parser.add_argument("--retention-file", help='per-user retention, one "<username> <days>" line each (0 keeps forever)')
+    parser.add_argument("--maintenance-compression", choices=sorted(COMPRESSORS),
+                        help="compress plain mail in the mailboxes with this codec")
+    parser.add_argument("--maintenance-interval", type=float, default=DEFAULT_INTERVAL, help="seconds between passes")
+    parser.add_argument("--io-rate", type=int, default=DEFAULT_IO_RATE, help="mailbox bytes processed per second")
+
+
+def maintenance_options(args):
+    return {"retention_days": args.retention_days,
+            "retention": load_retention(args.retention_file) if args.retention_file else None,
+            "compression": args.maintenance_compression,
+            "interval": args.maintenance_interval,
+            "io_rate": args.io_rate}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expire and compact swmgmail mailboxes.")
+    add_maintenance_arguments(parser)
+    config.add_mail_arguments(parser)
+    parser.add_argument("--once", action="store_true", help="run a single pass and exit")
+    args = config.parse_args(parser, "maintenance")
+    config.apply_mail_options(args)
+    worker = MaintenanceWorker(**maintenance_options(args))
+    if args.once:
+        worker.run_pass()
+        return
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        print("\nStopping maintenance.")
+
+
+if __name__ == "__main__":
+    main()
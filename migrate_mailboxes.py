@@ -0,0 +1,90 @@
+"""
+migrate_mailboxes.py
+--------------------
+Moves existing mailboxes into the sharded layout under the mail root.
+Every <username>/my_mailbox.txt found below the source directory (the old layout kept users
+directly in the servers' working directory, which is the default source) is moved, together with
+its index and usage files, to <mail root>/<ab>/<cd>/<username>/. A source that is itself a sharded
+mail root works too, so the same command moves mail to a new root. If the target mailbox already
+holds mail, the old messages are put in front of it. Run it while the servers are stopped.
+With --database the users (--userinfo) and mailboxes are copied into an SQLite store instead
+(--store sqlite), leaving the files in place; users who already have mail in the database are
+skipped, so an interrupted import can simply be run again.
+Usage: python migrate_mailboxes.py [--config FILE] [--from DIR] [--mail-root DIR] [--database DB [--userinfo FILE]]
+                                   [--dry-run]
+"""
+
+import argparse
+import os
+
+import config
+from mailstore import DEFAULT_MAIL_ROOT, MAILBOX_NAME, MailboxReader, get_mailbox_path, move_mailbox
+from storage import FileStore, SQLiteStore
+
+MAX_DEPTH = 4  # <root>/<ab>/<cd>/<username>/my_mailbox.txt
+
+
+def find_mailboxes(directory, skip=None):
+    """Yields (username, mailbox path) for the mailboxes below directory, leaving out skip."""
+    skip = os.path.realpath(skip) if skip is not None else None
+    top = directory.rstrip(os.sep).count(os.sep)
+    for path, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and os.path.realpath(os.path.join(path, d)) != skip]
+        if path.count(os.sep) - top >= MAX_DEPTH - 1:
+            dirs[:] = []
+        if MAILBOX_NAME in files and path != directory:
+            yield os.path.basename(path), os.path.join(path, MAILBOX_NAME)
+
+
+def import_to_database(args):
+    """Copies the users and the mailboxes below --from into the SQLite database."""
+    users = FileStore(args.userinfo)
+    database = None if args.dry_run else SQLiteStore(args.database)
+    for username in users.usernames():
+        if database is not None:
+            database.set_password(username, users.password(username) or "")
+    imported = 0
+    for username, source in list(find_mailboxes(args.source)):
+        if database is not None:
+            if database.usage(username)[0]:
+                print(f"{source}: {username} already has mail in {args.database}, skipped")
+                continue
+            with MailboxReader(source) as mailbox:
+                count = database.import_mailbox(username, mailbox)
+            print(f"{source} -> {args.database} ({count} messages)")
+        else:
+            print(f"{source} -> {args.database}")
+        imported += 1
+    print(f"{'Would import' if args.dry_run else 'Imported'} {imported} mailboxes.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move swmgmail mailboxes into the sharded mail root.")
+    parser.add_argument("--from", dest="source", default=".", help="directory holding the old mailboxes")
+    parser.add_argument("--mail-root", default=DEFAULT_MAIL_ROOT, help="directory the mailboxes are moved under")
+    parser.add_argument("--database", help="copy the users and mailboxes into this SQLite database instead")
+    parser.add_argument("--userinfo", default=config.DEFAULT_USERINFO, help="users to copy into the database")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be moved")
+    args = config.parse_args(parser, "migrate_mailboxes")
+    if args.database:
+        import_to_database(args)
+        return
+
+    moved = 0
+    for username, source in list(find_mailboxes(args.source, skip=args.mail_root)):
+        target = get_mailbox_path(username, args.mail_root)
+        if os.path.realpath(source) == os.path.realpath(target):
+            continue
+        print(f"{source} -> {target}")
+        if not args.dry_run:
+            move_mailbox(source, target)
+            try:
+                os.rmdir(os.path.dirname(source))
+            except OSError:
+                pass  # something else is still in there
+        moved += 1
+    print(f"{'Would move' if args.dry_run else 'Moved'} {moved} mailboxes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+notify.py
+---------
+New-mail notifications, so clients can wait for mail instead of polling with STAT.
+A session waiting for a user's mail subscribes to the user and polls the subscription together
+with its connection; storing mail for the user wakes every such subscription in the process.
+Mail is mostly stored by other processes (the SMTP server and its workers, the journal,
+bulk_import.py), so a process with subscribers also binds a Unix datagram socket
+<mail root>/notify/<pid>.sock, and whoever stores mail sends the usernames to each of those
+sockets, where a listener thread wakes the local subscribers. Sockets left behind by processes
+that are gone are removed by the next sender.
+"""
+
+import os
+import socket
+import threading
+
+import mailstore
+
+NOTIFY_DIR = "notify"
+MAX_DATAGRAM = 64 * 1024
+
+_subscriptions = {}  # username -> set of Subscription
+_lock = threading.Lock()
+_listener = None
+
+
+class Subscription:
+    """Becomes readable (poll its fileno) whenever mail for the user has been stored."""
+
+    def __init__(self, username):
+        self.username = username
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, b"x")
+        except BlockingIOError:
+            pass  # already woken
+
+    def clear(self):
+        """Forgets the wake-ups seen so far."""
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        with _lock:
+            subscriptions = _subscriptions.get(self.username)
+            if subscriptions is not None:
+                subscriptions.discard(self)
+                if not subscriptions:
+                    del _subscriptions[self.username]
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def subscribe(username) -> Subscription:
+    """Returns a subscription to username's new mail, to be closed when done."""
+    _start_listener()
+    subscription = Subscription(username)
+    with _lock:
+        _subscriptions.setdefault(username, set()).add(subscription)
+    return subscription
+
+
+def wake_local(usernames):
+    with _lock:
+        subscriptions = [s for username in usernames for s in _subscriptions.get(username, ())]
+    for subscription in subscriptions:
+        subscription.wake()
+
+
+def new_mail(usernames):
+    """Wakes everyone waiting for the mail of usernames, in this and in other processes."""
+    usernames = list(usernames)
+    if not usernames:
+        return
+    wake_local(usernames)
+    directory = os.path.join(mailstore.mail_root, NOTIFY_DIR)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return  # nobody is listening
+    own = f"{os.getpid()}.sock"
+    payload = "\n".join(usernames).encode("utf-8")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+        sender.setblocking(False)
+        for name in names:
+            if name == own or not name.endswith(".sock"):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                sender.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.remove(path)  # its process is gone
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                pass  # a busy listener misses this one, its clients see the mail on their next wake-up
+
+
+def _start_listener():
+    global _listener
+    with _lock:
+        if _listener is not None and _listener[0] == os.getpid():
+            return
+        directory = os.path.join(mailstore.mail_root, NOTIFY_DIR)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{os.getpid()}.sock")
+        if os.path.exists(path):
+            os.remove(path)  # left behind by an earlier process with the same pid
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        _listener = (os.getpid(), sock, path)
+    threading.Thread(target=_listen, args=(sock,), name="notify", daemon=True).start()
+
+
+def _listen(sock):
+    while True:
+        try:
+            payload = sock.recv(MAX_DATAGRAM)
+        except OSError:
+            return
+        if not payload:
+            return  # shut down by stop_listener
+        wake_local(payload.decode("utf-8", "replace").split("\n"))
+
+
+def stop_listener():
+    """Closes this process's notification socket, if it has one."""
+    global _listener
+    with _lock:
+        if _listener is None or _listener[0] != os.getpid():
+            return
+        _, sock, path = _listener
+        _listener = None
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    try:
+        sock.shutdown(socket.SHUT_RDWR)  # ends the listener's recv
+    except OSError:
+        pass
+    sock.close()
@@ -2,50 +2,122 @@
 pop_server.py
 -------------
 A simple concurrent POP3 server that authenticates users using a local "userinfo.txt"
-file and allows mail retrieval/deletion from the mailbox (./<username>/my_mailbox.txt).
+file (or the SQLite store) and allows mail retrieval/deletion from the user's mailbox.
 Supported commands (after authentication): STAT, LIST, RETR <msg>, DELE <msg>, RSET, QUIT.
-Usage: python pop_server.py <POP3_port>
+Before authentication CAPA and, with a certificate configured, STLS (upgrade to TLS) are available.
+IDLE (an extension modelled on IMAP IDLE) lets a logged in client wait for new mail instead of
+polling STAT: the server answers "+OK", then sends "* <messages> <octets>" whenever mail arrives,
+until the client sends DONE or the idle timeout passes, both ending with "+OK: idle done".
+With --read-only (a replication standby, see replication.py) DELE is refused and nothing is removed.
+Usage: python pop_server.py [<POP3_port>] [--workers N] [--maintenance [--retention-days N]] [--read-only] [--config FILE]
 """
 
-import fcntl
-import socket
+import argparse
+import contextlib
+import functools
+import select
+import sqlite3
 import threading
-import sys
+import time
 
-MESSAGE_SIZE = 1024
+import config
+from mailstore import MaildropLock
+from maintenance import MaintenanceWorker, add_maintenance_arguments, maintenance_options
+import notify
+import storage
+from profiling import CommandTimer, add_profiling_arguments, apply_profiling_options, install_profiler_signal, timed
+from ratelimit import add_rate_limit_arguments, rate_limit_options
+from sessions import (DEFAULT_COMMAND_TIMEOUT, DEFAULT_DRAIN_TIMEOUT, DEFAULT_MAX_SESSIONS, DEFAULT_RECV_SIZE,
+                      POLL_INTERVAL, UNTERMINATED_LINE_DELAY, LineBuffer, ReplyBuffer, SessionRegistry,
+                      add_session_arguments, reject, session_options, wait_for_input)
+from tls import add_tls_arguments, is_tls, tls_options
+from workers import add_worker_arguments, create_listener, handle_sigterm, run_workers
+
+POP3_PORT = 1100
+POP3_IDLE_TIMEOUT = 600 # RFC 1939: the autologout timer is at least 10 minutes
+MAINTENANCE_QUIET_SESSIONS = 2 # maintenance only runs while at most this many sessions are open
 
 class Session:
 
-    def __init__(self, connection):
+    def __init__(self, connection, tls=None, require_tls=False, idle_timeout=POP3_IDLE_TIMEOUT, draining=None,
+                 read_only=False):
         self._authenticated = False
         self._username = None
         self._password = None
         self._connection = connection
-        self._deleted = set()
-        self._mailbox_path = None
-        connection.sendall(b"+OK: POP3 server ready\r\n")
+        self._deleted = {} # UID -> octets, so sessions removing mail meanwhile do not shift them
+        self._uidvalidity = None # of the UIDs in _deleted
+        self._tls = tls
+        self._require_tls = require_tls
+        self._idle_timeout = idle_timeout
+        self._draining = draining
+        self._read_only = read_only
+        self._output = ReplyBuffer(connection)
+        self._input = LineBuffer()
+        self._maildrop = None # held from login to the end of the session
+        self.send_message("+OK: POP3 server ready")
     
     def get_password(self, username):
-        with open("userinfo.txt", "r") as f:
-            for line in f:
-                parts = line.strip().split(maxsplit=1)  # Split into username and password
-                if len(parts) == 2 and parts[0] == username:
-                    return parts[1]  # Return the password
-        return None
+        return storage.store.password(username)
     
+    @property
+    def user(self):
+        """The logged in user, None before authentication."""
+        return self._username if self._authenticated else None
+
+    @property
+    def input(self):
+        """What the client sent that has not been handled yet."""
+        return self._input
+
+    @property
+    def connection(self):
+        """The client socket, replaced by a TLS socket after STLS."""
+        return self._connection
+
     def send_message(self, message):
-        self._connection.sendall(f"{message}\r\n".encode("utf-8"))
+        """Queues a reply, it is sent at the next flush."""
+        self._output.write(f"{message}\r\n".encode("utf-8"))
+
+    def flush(self, *parts):
+        timed("io", self._output.flush, *parts)
     
     def handle_quit(self, command_list):
-        if self._authenticated:
-            self.delete_mails()
-        self.send_message("+OK: POP3 server saying good-bye")
+        if self._authenticated and not self.delete_mails():
+            self.send_message("-ERR: some deleted messages not removed")
+        else:
+            self.send_message("+OK: POP3 server saying good-bye")
+        self.flush()
         self._connection.close()
         return True
     
+    def handle_capa(self, command_list):
+        capabilities = ["USER", "IDLE"]
+        if self._tls is not None and not is_tls(self._connection):
+            capabilities.append("STLS")
+        self.send_message("+OK: Capability list follows\r\n" + "".join(f"{c}\r\n" for c in capabilities) + ".")
+
+    def handle_stls(self, command_list):
+        """Upgrades the connection to TLS (RFC 2595), only allowed before authentication."""
+        if self._tls is None:
+            self.send_message("-ERR: STLS not available")
+        elif is_tls(self._connection):
+            self.send_message("-ERR: TLS already active")
+        elif self._authenticated:
+            self.send_message("-ERR: STLS only before authentication")
+        else:
+            self.send_message("+OK: Begin TLS negotiation")
+            self.flush()
+            # The handshake is bounded by the command timeout set on the socket
+            self._connection = self._tls.wrap_socket(self._connection, server_side=True)
+            self._output = ReplyBuffer(self._connection)
+            self._username = None
+
     def handle_user(self, command_list):
         if self._authenticated:
             self.send_message("-ERR: Already authenticated")
+        elif self._require_tls and not is_tls(self._connection):
+            self.send_message("-ERR: use STLS first")
         elif len(command_list) != 2:
             self.send_message("-ERR: USER <username> expected")
         else: 
@@ -57,13 +129,18 @@ class Session:
             self.send_message("-ERR: already authenticated")
         elif len(command_list) != 2:
             self.send_message("-ERR: PASS <password> expected")
+        elif self._require_tls and not is_tls(self._connection):
+            self.send_message("-ERR: use STLS first")
         elif self._username is None:
             self.send_message("-ERR: USER expected first")
         else: 
             self._password = command_list[1]
             if self._password == self.get_password(self._username):
+                # Keeps maintenance from renumbering the messages while the session refers to them;
+                # other sessions may hold it too, deletions are marked by UID for that
+                self._maildrop = MaildropLock(self._username)
+                self._maildrop.acquire()
                 self._authenticated = True
-                self._mailbox_path = f"{self._username}/my_mailbox.txt"
                 self.send_message("+OK: Logged in")
             else:
                 self.send_message("-ERR: USER or PASS incorrect")
@@ -84,19 +161,22 @@ class Session:
             return
         if len(command_list) == 1: 
             [amnt, total_size, emails] = self.list_emails()
-            self.send_message(f"+OK: {amnt} Messages ({total_size} bytes)\n{emails}")
+            # Queued as two buffers, the listing of a big mailbox is not copied into the status line
+            self._output.write(f"+OK: {amnt} Messages ({total_size} bytes)\n".encode("utf-8"))
+            self.send_message(emails)
         elif len(command_list) == 2:
             [amount_mails, size] = self.get_mailbox_stats()
             emailno = command_list[1]
             if not emailno.isnumeric():
                 self.send_message("-ERR: emailno must be a number")
+                return
             emailno = int(emailno)
-            if not (1 <= emailno <= amount_mails):
+            emails = self.list_emails(emailno)
+            if emails is None:
                 self.send_message("-ERR: emailno not found")
-            if emailno in self._deleted:
+            elif not emails:
                 self.send_message("-ERR: email deleted")
             else:
-                emails = self.list_emails(emailno)
                 self.send_message(f"+OK:\n{emails}")
         else:
             self.send_message("-ERR: LIST [emailno] with emailno optional expected")
@@ -112,14 +192,11 @@ class Session:
             self.send_message("-ERR: RETR <emailno> emailno must be number")
             return
         emailno = int(command_list[1])
-        if emailno in self._deleted:
+        sent = self.send_email(emailno)
+        if sent is None:
             self.send_message("-ERR: email marked deleted")
-        else:
-            (size, email) = self.get_email_by_number(emailno)
-            if size != None and email != None:
-                self.send_message(f"+OK: {size}\n{email}")
-            else:
-                self.send_message("-ERR: RETR <emailno> mail not found")
+        elif not sent:
+            self.send_message("-ERR: RETR <emailno> mail not found")
     
     def handle_dele(self, command_list):
         if not self._authenticated:
@@ -131,16 +208,23 @@ class Session:
         if not command_list[1].isnumeric():
             self.send_message("-ERR: DELE <emailno> emailno must be number")
             return
+        if self._read_only:
+            self.send_message("-ERR: read-only mailbox, delete mail on the primary server")
+            return
         emailno = int(command_list[1])
-        amount_mails = self.get_mailbox_stats()[0]
-        if (1 <= emailno <= amount_mails):
-            if emailno in self._deleted:
-                self.send_message("-ERR: email already deleted")
-            else:
-                self._deleted.add(emailno)
-                self.send_message(f"+OK: email no {emailno} deleted")
-        else:
+        # Marked by UID: another session removing mail before our QUIT must not make us remove the wrong one
+        uidvalidity, _, messages = storage.store.uids(self._username)
+        if not (1 <= emailno <= len(messages)):
             self.send_message("-ERR: emailno not found")
+        elif self._uidvalidity is not None and uidvalidity != self._uidvalidity:
+            self.send_message("-ERR: mailbox renumbered meanwhile, RSET first")
+        elif messages[emailno - 1][0] in self._deleted:
+            self.send_message("-ERR: email already deleted")
+        else:
+            uid, octets, _ = messages[emailno - 1]
+            self._uidvalidity = uidvalidity
+            self._deleted[uid] = octets
+            self.send_message(f"+OK: email no {emailno} deleted")
     
     def handle_rset(self, command_list):
         if not self._authenticated:
@@ -149,15 +233,79 @@ class Session:
         if len(command_list) != 1:
             self.send_message("-ERR: RSET takes no arguments")
         else:
-            self._deleted = set()
+            self._deleted = {}
+            self._uidvalidity = None
             amount_mails = self.get_mailbox_stats()[0]
             self.send_message(f"+OK: mailbox contains {amount_mails} messages")
     
+    def handle_idle(self, command_list):
+        """Reports mailbox changes as "* <messages> <octets>" lines until the client sends DONE."""
+        if not self._authenticated:
+            self.send_message("-ERR: authenticate first")
+            return
+        if len(command_list) != 1:
+            self.send_message("-ERR: IDLE takes no arguments")
+            return
+        # Subscribing before taking the stats means no delivery slips in between unnoticed
+        with notify.subscribe(self._username) as subscription:
+            stats = self.get_mailbox_stats()
+            self.send_message("+OK: idling, send DONE to stop")
+            self.flush()
+            poller = select.poll()
+            poller.register(self._connection, select.POLLIN)
+            poller.register(subscription, select.POLLIN)
+            if self.done_received():
+                return  # sent right behind IDLE
+            deadline = time.monotonic() + self._idle_timeout if self._idle_timeout else None
+            while True:
+                if self._draining is not None and self._draining.is_set():
+                    self.send_message("-ERR: POP3 server shutting down")
+                    return True
+                wait = POLL_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # The client starts a new IDLE, which also tells us it is still there
+                        self.send_message("+OK: idle done")
+                        return
+                    wait = min(wait, remaining)
+                if is_tls(self._connection) and self._connection.pending():
+                    ready = {self._connection.fileno()}
+                else:
+                    ready = {fd for fd, _ in poller.poll(wait * 1000)}
+                if subscription.fileno() in ready:
+                    subscription.clear()
+                    current = self.get_mailbox_stats()
+                    if current != stats:
+                        stats = current
+                        self.send_message(f"* {stats[0]} {stats[1]}")
+                        self.flush()
+                if self._connection.fileno() in ready:
+                    data = self._connection.recv(DEFAULT_RECV_SIZE)
+                    if not data:
+                        return True  # Client disconnected
+                    self._input.feed(data)
+                    if self.done_received():
+                        return
+
+    def done_received(self):
+        """Looks for a DONE line in the input, answers it and returns True if there is one.
+
+        Lines before it are dropped, commands after it stay in the input for the command loop.
+        """
+        while True:
+            line = self._input.next_line()
+            if line is None:
+                return False
+            if line.strip().upper() == "DONE":
+                self.send_message("+OK: idle done")
+                return True
+
     def handle_command(self, input):
         command_list = input.split(" ")
         command = command_list[0]
 
-        command_dict = {"QUIT": self.handle_quit, "USER": self.handle_user, "PASS": self.handle_pass, "STAT": self.handle_stat, "LIST": self.handle_list, "RETR": self.handle_retr, "DELE": self.handle_dele, "RSET": self.handle_rset}
+        command_dict = {"QUIT": self.handle_quit, "CAPA": self.handle_capa, "STLS": self.handle_stls, "USER": self.handle_user, "PASS": self.handle_pass, "STAT": self.handle_stat, "LIST": self.handle_list, "RETR": self.handle_retr, "DELE": self.handle_dele, "RSET": self.handle_rset, "IDLE": self.handle_idle}
 
         if command not in command_dict.keys():
             self.send_message("-ERR: unsupported command")
@@ -165,118 +313,194 @@ class Session:
 
         return command_dict[command](command_list)
     
-    def read_mailbox(self):
-        with open(self._mailbox_path, "r", encoding="utf-8") as mailbox:
-            # Lock the file before reading
-            fcntl.flock(mailbox, fcntl.LOCK_EX)
-            try:
-                return mailbox.readlines()
-            finally:
-                fcntl.flock(mailbox, fcntl.LOCK_UN)
+    def open_mailbox(self, exclusive=False):
+        return storage.store.open_mailbox(self._username, exclusive)
     
     def get_mailbox_stats(self):
-        amount_mails = 0
-        index = 1
-        total_size = 0
-        email_size = 0
-        for line in self.read_mailbox():
-            email_size += len(line.encode("utf-8"))
-            if line.strip() == ".":
-                if index not in self._deleted:
-                    amount_mails += 1
-                    total_size += email_size
-                email_size = 0
-                index += 1
-        return [amount_mails, total_size]
+        if not self._deleted:
+            # The usage counters make this O(1)
+            return list(storage.store.usage(self._username))
+        # Only the marked messages still there are subtracted, others may have been removed meanwhile
+        _, _, messages = storage.store.uids(self._username)
+        kept = [octets for uid, octets, _ in messages if uid not in self._deleted]
+        return [len(kept), sum(kept)]
+
+    def marked_numbers(self, mailbox):
+        """Returns the numbers the messages marked deleted have in the open mailbox."""
+        if not self._deleted:
+            return set()
+        return {number for number, uid in enumerate(mailbox.uids() or [], start=1) if uid in self._deleted}
     
     def list_emails(self, email_number = None):
-        emails = []
-        current_email= []
-        for line in self.read_mailbox():
-            if line.strip() == ".":
-                emails.append("\n".join(current_email))
-                current_email = []
-            else:
-                current_email.append(line.strip())
+        """Returns the LIST line of one message (None if there is none, "" if marked deleted),
+        or [messages, octets, lines] for all of them."""
+        with self.open_mailbox() as mailbox:
+            sizes = mailbox.sizes()
+            marked = self.marked_numbers(mailbox)
 
-        output = ""
         if email_number is not None:
-            email_size = len(emails[email_number - 1].encode("utf-8"))
-            output += f"{email_number} {email_size}\n"
-            return output
+            if not (1 <= email_number <= len(sizes)):
+                return None
+            return "" if email_number in marked else f"{email_number} {sizes[email_number - 1]}\n"
         else:
             amnt = 0
             total = 0
-            for i, email in enumerate(emails, start=1):
-                if i not in self._deleted:
-                    amnt+= 1
-                    email_size = len(email.encode("utf-8"))
+            lines = []
+            for i, email_size in enumerate(sizes, start=1):
+                if i not in marked:
+                    amnt += 1
                     total += email_size
-                    output += f"{i} {email_size}\n"
-            return [amnt, total, output]
+                    lines.append(f"{i} {email_size}\n")
+            return [amnt, total, "".join(lines)]
     
-    def get_email_by_number(self, emailno):
-        emails = []
-        current_email = []
-        for line in self.read_mailbox():
-            if line.strip() == ".":
-                emails.append("\n".join(current_email))
-                current_email = []
-            else:
-                current_email.append(line.strip())
-        
-        if (1 <= emailno <= len(emails)):
-            email_content = emails[emailno - 1]
-            email_size = len(email_content.encode("utf-8"))
-            return email_size, email_content
-        else:
-            return None, None
+    def send_email(self, emailno):
+        """Sends RETR output straight from the mapped mailbox, returns False if there is no such mail
+        and None if it is marked deleted."""
+        with self.open_mailbox() as mailbox:
+            if not (1 <= emailno <= len(mailbox)):
+                return False
+            if emailno in self.marked_numbers(mailbox):
+                return None
+            # The stored message is already in wire form, terminator line included
+            # Goes out with the replies still queued, the chunks are sent from the mapping without copying
+            self.send_message(f"+OK: {mailbox.octets(emailno)}")
+            with contextlib.closing(mailbox.message_chunks(emailno)) as chunks:
+                for chunk in chunks:
+                    self.flush(chunk)
+        return True
     
     def delete_mails(self):
-        emails = []
-        current_email = []
-        for line in self.read_mailbox():
-            if line.strip() == ".":
-                emails.append("\n".join(current_email) + "\n.")
-                current_email = []
-            else:
-                current_email.append(line.rstrip())
+        """Removes the marked messages by UID, returns False if the mailbox was renumbered meanwhile."""
+        if not self._deleted:
+            return True
+        if storage.store.uids(self._username)[0] != self._uidvalidity:
+            return False
+        storage.store.remove_uids(self._username, self._deleted)
+        return True
+
+    def close(self):
+        """Releases the maildrop at the end of the session."""
+        if self._maildrop is not None:
+            self._maildrop.release()
+            self._maildrop = None
 
-        emails = [email for i, email in enumerate(emails, start=1) if i not in self._deleted]
-        
-        with open(self._mailbox_path, "w", encoding="utf-8") as mailbox:
-            # Lock the file before writing
-            fcntl.flock(mailbox, fcntl.LOCK_EX)
-            try:
-                mailbox.write("\n".join(emails) + "\n")
-            finally:
-                fcntl.flock(mailbox, fcntl.LOCK_UN)
+def handle_client(conn, addr, sessions, idle_timeout=POP3_IDLE_TIMEOUT, command_timeout=DEFAULT_COMMAND_TIMEOUT,
+                  recv_size=DEFAULT_RECV_SIZE, limits=None, tls=None, require_tls=False, read_only=False):
+    ses = None
+    try:
+        conn.settimeout(command_timeout)
+        ses = Session(conn, tls, require_tls, idle_timeout, sessions.draining, read_only)
+        while True:
+            line = ses.input.next_line()
+            if line is None:
+                # Everything received so far is answered before waiting for more
+                ses.flush()
+                if len(ses.input) and not wait_for_input(conn, UNTERMINATED_LINE_DELAY):
+                    # Nothing more is coming, the client left out the CRLF
+                    line = ses.input.take().decode("utf-8", "replace")
+                else:
+                    if not wait_for_input(conn, idle_timeout, sessions.draining):
+                        # Leaving without QUIT, so deletions are not committed
+                        if sessions.draining.is_set():
+                            ses.send_message("-ERR: POP3 server shutting down")
+                        else:
+                            ses.send_message("-ERR: autologout, idle for too long")
+                        break
+                    temp = conn.recv(recv_size)
+                    if not temp:
+                        break  # Client disconnected
+                    ses.input.feed(temp)
+                    continue
+            line = line.strip()
+            if limits is not None and line.upper() != "QUIT" and not limits.allow_command(addr[0], ses.user):
+                ses.send_message("-ERR: too many commands, slow down")
+                continue
+            with CommandTimer("pop3", addr, line):
+                if ses.handle_command(line):
+                    return
+            if ses.connection is not conn:
+                # Upgraded to TLS, anything sent along with STLS was in clear and is dropped
+                sessions.replace(conn, ses.connection)
+                conn = ses.connection
+                ses.input.take()
+    except (OSError, sqlite3.Error) as e:
+        print(f"POP3 exception with client {addr}: {e}")
+    finally:
+        if ses is not None:
+            with contextlib.suppress(OSError):
+                ses.flush()
+            ses.close()
+        conn.close()
+        sessions.remove(conn)
 
-def handle_client(conn, addr):
-    ses = Session(conn)
-    quit = False
-    while True:
-        temp = conn.recv(MESSAGE_SIZE).decode().strip()
-        for line in temp.splitlines():
-            quit = ses.handle_command(line)
-            if quit:
-                break
-        if quit:
-            break
+def serve(server_socket, idle_timeout=POP3_IDLE_TIMEOUT, command_timeout=DEFAULT_COMMAND_TIMEOUT,
+          max_sessions=DEFAULT_MAX_SESSIONS, drain_timeout=DEFAULT_DRAIN_TIMEOUT, recv_size=DEFAULT_RECV_SIZE,
+          maintenance=None, limits=None, tls=None, require_tls=False, read_only=False):
+    print(f"POP3 Server running on port {server_socket.getsockname()[1]}...")
+    install_profiler_signal()
+    sessions = SessionRegistry(max_sessions)
+    worker = None
+    if maintenance is not None:
+        worker = MaintenanceWorker(is_quiet=lambda: len(sessions) <= MAINTENANCE_QUIET_SESSIONS, **maintenance)
+        worker.start()
+    try:
+        while True:
+            c, addr = server_socket.accept()
+            if limits is not None and not limits.allow_connection(addr[0]):
+                reject(c, "-ERR: too many connections from your address, try again later")
+                continue
+            if not sessions.add(c):
+                reject(c, "-ERR: too many connections, try again later")
+                continue
+            print(f"POP3 connection established with {addr}")
+            threading.Thread(target=handle_client,
+                             args=(c, addr, sessions, idle_timeout, command_timeout, recv_size, limits, tls,
+                                   require_tls, read_only)).start()
+    except KeyboardInterrupt:
+        print("\nShutting down the POP3 server.")
+    finally:
+        server_socket.close()
+        notify.stop_listener()
+        if worker is not None:
+            worker.stop()
+        if len(sessions):
+            print(f"Draining {len(sessions)} open sessions...")
+        leftover = sessions.drain(drain_timeout)
+        if leftover:
+            print(f"Closed {leftover} sessions that did not finish in time.")
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python pop_server.py <POP3_port>")
-        sys.exit(1)
-    port = int(sys.argv[1])
-    server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-    server_socket.bind(("", port))
-    server_socket.listen(5)
-    print(f"POP3 Server running on port {port}...")
-    while True:
-        c, addr = server_socket.accept()
-        print(f"POP3 connection established with {addr}")
-        threading.Thread(target=handle_client, args=(c, addr)).start()
+    parser = argparse.ArgumentParser(
+        usage="python pop_server.py [<POP3_port>] [--workers N] [--maintenance [--retention-days N]] [--read-only] "
+              "[--config FILE]")
+    parser.add_argument("port", type=int, nargs="?", default=POP3_PORT)
+    add_worker_arguments(parser)
+    config.add_mail_arguments(parser)
+    add_session_arguments(parser, default_idle_timeout=POP3_IDLE_TIMEOUT)
+    add_profiling_arguments(parser)
+    add_rate_limit_arguments(parser, "user")
+    add_tls_arguments(parser)
+    parser.add_argument("--require-tls", action="store_true", help="refuse USER and PASS until the client has used STLS")
+    parser.add_argument("--maintenance", action="store_true", help="expire and compact mailboxes in the background")
+    parser.add_argument("--read-only", action="store_true", help="refuse DELE, for a replication standby")
+    add_maintenance_arguments(parser)
+    args = config.parse_args(parser, "pop3", shared=(config.SHARED_SECTION, "maintenance"))
+    config.apply_mail_options(args)
+    apply_profiling_options(args)
+    options = session_options(args)
+    options["limits"] = rate_limit_options(args)
+    options["tls"] = tls_options(args)
+    if args.require_tls and options["tls"] is None:
+        parser.error("--require-tls needs --tls-cert")
+    options["require_tls"] = args.require_tls
+    options["read_only"] = args.read_only
+    if args.maintenance:
+        options["maintenance"] = maintenance_options(args)
+    if args.workers > 1:
+        run_workers(functools.partial(serve, **options), args.port, args.workers, args.backlog)
+    else:
+        handle_sigterm()
+        serve(create_listener(args.port, args.backlog), **options)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,163 @@
+"""
+profiling.py
+------------
+Opt-in diagnostics for the SMTP and POP3 servers.
+Sending SIGUSR1 to a server starts a sampling profiler that records the stack of every thread
+every few milliseconds; the next SIGUSR1 stops it and writes the samples to
+<profile dir>/profile-<pid>-<time>.txt in collapsed-stack format ("frame;frame;... count" per
+distinct stack), which flamegraph.pl and speedscope read. With --workers the parent passes the
+signal on to every worker, each writing its own file. Since it samples wall-clock stacks, time
+spent blocked (flock, sendall, poll) shows up as well as CPU time.
+The slow-command log (--slow-log FILE) records every command that takes longer than
+--slow-threshold seconds, with its time split into mailbox lock waits, socket and disk I/O,
+CPU, and the rest (mostly waiting for the GIL and page faults on mapped mailboxes).
+"""
+
+import collections
+import datetime
+import os
+import signal
+import sys
+import threading
+import time
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_SLOW_THRESHOLD = 0.1
+
+# Set from the command line at startup
+profile_dir = "."
+slow_log_path = None
+slow_threshold = DEFAULT_SLOW_THRESHOLD
+
+_profiler = None
+_timings = threading.local()
+_slow_log_lock = threading.Lock()
+
+
+class SamplingProfiler:
+    """Periodically records the call stacks of all other threads."""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def toggle_profiler(signum=None, frame=None):
+    """Starts the sampling profiler, or stops it and writes out its samples."""
+    global _profiler
+    if _profiler is None:
+        _profiler = SamplingProfiler()
+        _profiler.start()
+        print(f"Profiling process {os.getpid()}, send SIGUSR1 again to stop.")
+        return
+    profiler, _profiler = _profiler, None
+    profiler.stop()
+    path = os.path.join(profile_dir, f"profile-{os.getpid()}-{int(time.time())}.txt")
+    try:
+        profiler.write(path)
+        print(f"Profile with {sum(profiler.samples.values())} samples written to {path}")
+    except OSError as e:
+        print(f"Could not write profile {path}: {e}")
+
+
+def install_profiler_signal():
+    """Lets SIGUSR1 toggle the profiler; must be called from the main thread."""
+    signal.signal(signal.SIGUSR1, toggle_profiler)
+
+
+def timed(category, func, *args):
+    """Calls func(*args), charging its duration to category ("lock" or "io") of the current command."""
+    timings = getattr(_timings, "current", None)
+    if timings is None:
+        return func(*args)
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[category] += time.perf_counter() - start
+
+
+class CommandTimer:
+    """Times one command and writes it to the slow-command log if it took too long."""
+
+    def __init__(self, server, client, command):
+        self.server = server
+        self.client = client
+        self.command = command
+
+    def __enter__(self):
+        if slow_log_path is not None:
+            _timings.current = {"lock": 0.0, "io": 0.0}
+            self._start = time.perf_counter()
+            self._cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timings = getattr(_timings, "current", None)
+        if timings is None:
+            return
+        _timings.current = None
+        elapsed = time.perf_counter() - self._start
+        if elapsed < slow_threshold:
+            return
+        cpu = time.thread_time() - self._cpu_start
+        other = max(elapsed - cpu - timings["lock"] - timings["io"], 0.0)
+        line = (f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {self.server} pid={os.getpid()} client={self.client} "
+                f"{describe_command(self.command)!r} total={elapsed * 1000:.1f}ms cpu={cpu * 1000:.1f}ms "
+                f"lock={timings['lock'] * 1000:.1f}ms io={timings['io'] * 1000:.1f}ms other={other * 1000:.1f}ms\n")
+        try:
+            with _slow_log_lock, open(slow_log_path, "a") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"Could not write the slow-command log: {e}")
+
+
+def describe_command(command):
+    """Shortens a command line for the log, leaving out passwords."""
+    words = command.split(" ", 2)
+    if words[0].upper() in ("PASS", "AUTH"):
+        return words[0]
+    if len(words) > 1 and words[1].upper() in ("LOGIN", "AUTHENTICATE"):
+        return " ".join(words[:2])  # an IMAP tag comes first
+    return command[:80]
+
+
+def add_profiling_arguments(parser):
+    parser.add_argument("--profile-dir", default=profile_dir, help="directory SIGUSR1 profiles are written to")
+    parser.add_argument("--slow-log", help="log commands slower than --slow-threshold to this file")
+    parser.add_argument("--slow-threshold", type=float, default=DEFAULT_SLOW_THRESHOLD,
+                        help="seconds after which a command counts as slow")
+
+
+def apply_profiling_options(args):
+    global profile_dir, slow_log_path, slow_threshold
+    profile_dir = args.profile_dir
+    slow_log_path = args.slow_log
+    slow_threshold = args.slow_threshold
@@ -0,0 +1,118 @@
+"""
+ratelimit.py
+------------
+Token-bucket rate limits for the SMTP and POP3 servers.
+Each limited key (a client address, a MAIL FROM sender, a POP3 user) has a bucket that refills
+at <rate> tokens per second up to <burst>; every connection, command or message takes a token,
+and requests finding the bucket empty are refused with a cheap temporary error instead of being
+served. Limits are off unless a rate is given, and they apply per server process (with
+--workers N a client may get up to N times the rate). At most MAX_TRACKED_KEYS buckets are kept
+per limit: keys whose buckets have refilled are forgotten as they age, and when the table is full
+the least recently seen key makes room (it starts over with a full bucket).
+"""
+
+import argparse
+import collections
+import threading
+import time
+
+MAX_TRACKED_KEYS = 100000
+
+
+class RateLimiter:
+    """A token bucket per key."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        if self.burst < 1:
+            raise ValueError("a burst below 1 never lets a request through")
+        self._buckets = collections.OrderedDict()  # key -> [tokens, last refill], least recently seen first
+        self._lock = threading.Lock()
+
+    def allow(self, key) -> bool:
+        """Takes a token from key's bucket, returns False if there is none."""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= MAX_TRACKED_KEYS:
+                    self._buckets.popitem(last=False)
+                self._buckets[key] = [self.burst - 1, now]
+                return True
+            self._buckets.move_to_end(key)
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+    def _prune(self, now):
+        """Forgets the least recently seen keys while their buckets have refilled, they behave like new ones.
+
+        Stops at the first key still limited, so every call does only as much work as it removes.
+        """
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst:
+                return
+            del self._buckets[key]
+
+
+class RateLimits:
+    """The connection, command and account limits of one server."""
+
+    def __init__(self, connection_rate=None, connection_burst=None, command_rate=None, command_burst=None,
+                 account_rate=None, account_burst=None):
+        self.connections = RateLimiter(connection_rate, connection_burst) if connection_rate else None
+        self.commands = RateLimiter(command_rate, command_burst) if command_rate else None
+        self.accounts = RateLimiter(account_rate, account_burst) if account_rate else None
+
+    def allow_connection(self, address) -> bool:
+        return self.connections is None or self.connections.allow(address)
+
+    def allow_command(self, address, account=None) -> bool:
+        if self.commands is not None and not self.commands.allow(address):
+            return False
+        return account is None or self.allow_account(account)
+
+    def allow_account(self, account) -> bool:
+        return self.accounts is None or self.accounts.allow(account)
+
+
+def parse_rate(value):
+    value = float(value)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"{value:g} is negative")
+    return value
+
+
+def parse_burst(value):
+    value = float(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{value:g} is below 1, the bucket would never let a request through")
+    return value
+
+
+def add_rate_limit_arguments(parser, account):
+    """Adds the limit options; account names what the third limit is per ("sender" or "user")."""
+    parser.add_argument("--connection-rate", type=parse_rate, help="new connections per second per client address")
+    parser.add_argument("--connection-burst", type=parse_burst, help="connections a client address may open at once")
+    parser.add_argument("--command-rate", type=parse_rate, help="commands per second per client address")
+    parser.add_argument("--command-burst", type=parse_burst, help="commands a client address may send at once")
+    parser.add_argument(f"--{account}-rate", dest="account_rate", type=parse_rate,
+                        help=f"requests per second per {account}")
+    parser.add_argument(f"--{account}-burst", dest="account_burst", type=parse_burst,
+                        help=f"requests a {account} may make at once")
+
+
+def rate_limit_options(args):
+    """Returns RateLimits for the given options, or None when no limit is set."""
+    rates = (args.connection_rate, args.command_rate, args.account_rate)
+    if not any(rates):
+        return None
+    return RateLimits(args.connection_rate, args.connection_burst, args.command_rate, args.command_burst,
+                      args.account_rate, args.account_burst)
@@ -0,0 +1,348 @@
+"""
+relay.py
+--------
+Outbound delivery of mail for other domains.
+The SMTP server spools accepted mail for foreign recipients, one file per message and
+destination, fsynced before the message is acknowledged. A destination is the smarthost mail is
+relayed through: one per domain (--relay-route DOMAIN=HOST[:PORT]) or the default --smarthost.
+A scheduler thread hands due spool entries to delivery threads; each destination gets at most
+--relay-connections of them, and a delivery thread keeps its connection open for the next message
+to the same destination. Temporary failures are retried with exponential backoff until the message
+is older than --relay-max-age; permanent failures and expired messages are bounced to the sender.
+Only clients connecting from --relay-networks (default the loopback addresses) may relay, and only
+for a local sender; MAIL FROM alone is not trusted, anyone can claim a local address.
+Spool files are named <next attempt>-<id>.json and locked while being delivered, so several
+server processes (--workers) can share one spool. Entries that cannot be read are renamed to
+<name>.corrupt and left for the administrator.
+"""
+
+import collections
+import fcntl
+import glob
+import ipaddress
+import json
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_SMTP_PORT = 25
+DEFAULT_CONNECTIONS = 2
+DEFAULT_RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+DEFAULT_MAX_AGE = 4 * 24 * 3600
+CONNECT_TIMEOUT = 30
+CONNECTION_IDLE = 5  # seconds a delivery thread waits for more mail before closing its connection
+SCAN_INTERVAL = 5
+DEFAULT_RELAY_NETWORKS = [ipaddress.ip_network("127.0.0.0/8"), ipaddress.ip_network("::1/128")]
+
+
+def parse_host(value, default_port=DEFAULT_SMTP_PORT):
+    """Splits "host[:port]" into (host, port)."""
+    host, sep, port = value.rpartition(":")
+    if not sep or "]" in port or (":" in host and not host.endswith("]")):
+        return value.strip("[]"), default_port  # no port, or a bare IPv6 address
+    return host.strip("[]"), int(port)
+
+
+def parse_routes(values):
+    """Turns "domain=host[:port]" strings into {domain: (host, port)}."""
+    routes = {}
+    for value in values or []:
+        domain, sep, host = value.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid relay route {value!r}, expected DOMAIN=HOST[:PORT]")
+        routes[domain.strip().lower()] = parse_host(host.strip())
+    return routes
+
+
+def parse_networks(value):
+    """Turns "CIDR[,CIDR...]" into a list of networks."""
+    return [ipaddress.ip_network(part) for part in value.replace(",", " ").split()]
+
+
+def is_trusted(address, networks):
+    """Tells whether a client address (IPv4-mapped or with a zone index alike) is in one of networks."""
+    try:
+        ip = ipaddress.ip_address(address.partition("%")[0])
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return any(ip in network for network in networks)
+
+
+def message_lines(message):
+    """Returns the lines of a stored (wire form) message with the dot-stuffing undone."""
+    lines = message[:-len(".\r\n")].split("\r\n")[:-1]
+    return [line[1:] if line.startswith("..") else line for line in lines]
+
+
+def to_outbound(message):
+    """Converts a stored message to what smtplib expects: CRLF lines, not stuffed, no terminator."""
+    return "".join(f"{line}\r\n" for line in message_lines(message)).encode("utf-8")
+
+
+class Relay:
+    """Spool and delivery threads relaying mail to smarthosts."""
+
+    def __init__(self, spool_dir, smarthost=None, routes=None, connections=DEFAULT_CONNECTIONS,
+                 retry_delay=DEFAULT_RETRY_DELAY, max_age=DEFAULT_MAX_AGE, bounce=None, networks=None):
+        os.makedirs(spool_dir, exist_ok=True)
+        self.spool_dir = spool_dir
+        self.smarthost = smarthost
+        self.routes = routes or {}
+        self.connections = connections
+        self.retry_delay = retry_delay
+        self.max_age = max_age
+        self.bounce = bounce
+        self.networks = DEFAULT_RELAY_NETWORKS if networks is None else networks
+
+        self._cond = threading.Condition()
+        self._queues = collections.defaultdict(collections.deque)  # destination -> claimed entries
+        self._active = collections.Counter()  # destination -> delivery threads
+        self._threads = set()
+        self._claimed = set()
+        self._stopping = False
+        self._wakeup = threading.Event()
+        self._scheduler = threading.Thread(target=self._schedule_loop, name="relay-scheduler")
+        self._scheduler.start()
+
+    def destination(self, domain):
+        """Returns the (host, port) mail for domain is relayed through, or None."""
+        return self.routes.get(domain.lower(), self.smarthost)
+
+    def allows(self, address):
+        """Tells whether a client connecting from address may relay."""
+        return is_trusted(address, self.networks)
+
+    def submit(self, sender, recipients, message):
+        """Spools a stamped message for foreign recipients; it is on disk when this returns."""
+        by_destination = {}
+        for recipient in recipients:
+            by_destination.setdefault(self.destination(recipient.partition("@")[2]), []).append(recipient)
+        for group in by_destination.values():
+            entry = {"id": uuid.uuid4().hex, "sender": sender, "recipients": group, "message": message,
+                     "created": time.time(), "attempts": 0}
+            self._write_entry(entry, 0)
+        self._wakeup.set()
+
+    def _write_entry(self, entry, next_attempt):
+        path = os.path.join(self.spool_dir, f"{int(next_attempt):012d}-{entry['id']}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+    def _schedule_loop(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                self._claim_due()
+            except OSError as e:
+                print(f"Relay spool scan failed: {e}")
+            self._wakeup.wait(SCAN_INTERVAL)
+
+    def _claim_due(self):
+        """Locks every spool entry that is due and queues it for its destination."""
+        now = time.time()
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, "*.json"))):
+            due = os.path.basename(path).split("-", 1)[0]
+            if not due.isdigit():
+                self._quarantine(path, None, "not a spool entry name")
+                continue
+            if int(due) > now:
+                break  # names sort by due time
+            with self._cond:
+                if path in self._claimed or self._stopping:
+                    continue
+            try:
+                f = open(path, "r")
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue  # being delivered by another process
+            if not os.path.exists(path):
+                f.close()
+                continue  # finished by another process meanwhile
+            try:
+                entry = json.load(f)
+                destination = self.destination(entry["recipients"][0].partition("@")[2])
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                self._quarantine(path, f, e)
+                continue
+            if destination is None:
+                self._finish(path, f, entry, {r: (550, "no relay route for this domain") for r in entry["recipients"]})
+                continue
+            with self._cond:
+                self._claimed.add(path)
+                self._queues[destination].append((path, f, entry))
+                if self._active[destination] < self.connections:
+                    self._active[destination] += 1
+                    thread = threading.Thread(target=self._deliver_loop, args=(destination,),
+                                              name=f"relay-{destination[0]}")
+                    self._threads.add(thread)
+                    thread.start()
+                else:
+                    self._cond.notify_all()
+
+    def _quarantine(self, path, f, error):
+        """Moves an unreadable spool entry out of the scan, so it does not stop the scheduler."""
+        print(f"Relay spool entry {path} is unreadable ({error}), moved to {path}.corrupt")
+        try:
+            os.rename(path, path + ".corrupt")
+        except OSError as e:
+            print(f"Relay could not move spool entry {path}: {e}")
+        finally:
+            if f is not None:
+                f.close()
+
+    def _deliver_loop(self, destination):
+        conn = None
+        try:
+            while True:
+                with self._cond:
+                    queue = self._queues[destination]
+                    while not queue and not self._stopping:
+                        if not self._cond.wait(CONNECTION_IDLE) and not queue:
+                            break
+                    if not queue or self._stopping:
+                        return
+                    item = queue.popleft()
+                conn = self._send(conn, destination, *item)
+        finally:
+            # Also when a delivery fails unexpectedly, or the destination would be left without threads
+            with self._cond:
+                self._active[destination] -= 1
+                self._threads.discard(threading.current_thread())
+            if conn is not None:
+                try:
+                    conn.quit()
+                except (OSError, smtplib.SMTPException):
+                    conn.close()
+
+    def _send(self, conn, destination, path, f, entry):
+        """Delivers one spool entry over conn (opened if needed), returns the connection to reuse."""
+        recipients = entry["recipients"]
+        if conn is not None:
+            try:
+                reusable = conn.rset()[0] == 250
+            except (OSError, smtplib.SMTPException):
+                reusable = False
+            if not reusable:
+                conn.close()
+                conn = None
+        try:
+            if conn is None:
+                conn = smtplib.SMTP(*destination, timeout=CONNECT_TIMEOUT)
+            refused = conn.sendmail(entry["sender"], recipients, to_outbound(entry["message"]))
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except smtplib.SMTPResponseException as e:
+            refused = {r: (e.smtp_code, e.smtp_error) for r in recipients}
+        except OSError as e:  # includes the other smtplib errors
+            if conn is not None:
+                conn.close()
+                conn = None
+            refused = {r: (None, str(e)) for r in recipients}
+        self._finish(path, f, entry, refused)
+        return conn
+
+    def _finish(self, path, f, entry, refused):
+        """Removes a delivered entry, reschedules temporary failures and bounces permanent ones."""
+        failed = {}
+        retry = []
+        for recipient, (code, reason) in refused.items():
+            if isinstance(reason, bytes):
+                reason = reason.decode("utf-8", "replace")
+            if code is not None and code >= 500:
+                failed[recipient] = f"{code} {reason}"
+            else:
+                retry.append(recipient)
+        if retry and time.time() - entry["created"] > self.max_age:
+            failed.update((r, f"still undeliverable after {entry['attempts'] + 1} attempts") for r in retry)
+            retry = []
+        try:
+            if failed and self.bounce is not None:
+                try:
+                    self.bounce(entry["sender"], failed, entry["message"])
+                except (OSError, sqlite3.Error) as e:
+                    # Kept for another attempt, which bounces them again; the recipients that
+                    # got the message are not sent it twice
+                    print(f"Relay could not bounce mail to {entry['sender']}: {e}")
+                    retry += failed
+            if retry:
+                entry["recipients"] = retry
+                entry["attempts"] += 1
+                delay = min(self.retry_delay * 2 ** (entry["attempts"] - 1), MAX_RETRY_DELAY)
+                self._write_entry(entry, time.time() + delay)
+            os.remove(path)
+        except OSError as e:
+            print(f"Relay could not update spool entry {path}: {e}")
+        finally:
+            f.close()
+            with self._cond:
+                self._claimed.discard(path)
+
+    def close(self):
+        """Stops the relay; deliveries in progress finish, the rest stays in the spool."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._wakeup.set()
+        self._scheduler.join()
+        with self._cond:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join()
+        with self._cond:
+            for queue in self._queues.values():
+                for _, f, _ in queue:
+                    f.close()
+                queue.clear()
+
+
+def add_relay_arguments(parser):
+    parser.add_argument("--relay-spool", metavar="DIR", help="relay mail for other domains, spooling it in DIR")
+    parser.add_argument("--smarthost", help="HOST[:PORT] mail for other domains is relayed through")
+    parser.add_argument("--relay-route", action="append", metavar="DOMAIN=HOST[:PORT]",
+                        help="relay mail for DOMAIN through HOST instead of the smarthost (repeatable)")
+    parser.add_argument("--relay-connections", type=int, default=DEFAULT_CONNECTIONS,
+                        help="concurrent connections per relay destination")
+    parser.add_argument("--relay-retry-delay", type=float, default=DEFAULT_RETRY_DELAY,
+                        help="seconds before the first retry, doubled on every further one")
+    parser.add_argument("--relay-max-age", type=float, default=DEFAULT_MAX_AGE,
+                        help="seconds after which undeliverable mail is bounced")
+    add_relay_network_arguments(parser)
+
+
+def add_relay_network_arguments(parser):
+    parser.add_argument("--relay-networks", action="append", type=parse_networks, metavar="CIDR[,CIDR...]",
+                        help="clients allowed to relay, by address (repeatable, default the loopback addresses)")
+
+
+def relay_networks(args):
+    """Returns the --relay-networks given, None for the default."""
+    if args.relay_networks is None:
+        return None
+    networks = []
+    # A list per option on the command line, a single one from the settings file
+    for value in args.relay_networks:
+        networks.extend(value if isinstance(value, list) else [value])
+    return networks
+
+
+def relay_options(args):
+    return {"spool_dir": args.relay_spool,
+            "smarthost": parse_host(args.smarthost) if args.smarthost else None,
+            "routes": parse_routes(args.relay_route),
+            "connections": args.relay_connections,
+            "retry_delay": args.relay_retry_delay,
+            "max_age": args.relay_max_age,
+            "networks": relay_networks(args)}
@@ -0,0 +1,468 @@
+"""
+replication.py
+--------------
+Mailbox replication to standby servers by shipping a log of the changes.
+With --replication-log DIR (best set in the shared [mail] section, so the SMTP, POP3 and IMAP
+servers all get it) every delivery and every removal of mail is also appended to an ordered
+change log in DIR, kept in segment files changes-<position>.log whose name is the log position
+(byte offset) of their first record. Processes append under a lock on DIR/changes.lock, so all
+servers and their workers share one log. Removals name the messages by the SHA-1 of their wire
+form, with their number on the primary as a hint, so a standby removes the same messages even
+where its mailbox order differs (deliveries logged by different processes can swap places).
+   ship      runs on the primary and streams the log to standbys, each from the position it asks
+             for, following the log as it grows; segments older than --retention-days go
+   standby   runs on a standby next to its POP3 server (pop_server.py --read-only): it follows
+             `ship`, applies the changes to its own mail root and records the position applied
+             in a checkpoint file, where it resumes after a restart or a lost connection
+   position  prints the current end of the log
+A new standby either replays the log from position 0 (when no segment has been removed yet) or
+starts from a copy of the mail root taken with the servers stopped, with --start at the position
+printed at that time. Replay is at-least-once: a crash between applying changes and writing the
+checkpoint delivers those messages twice. Deliveries are logged before they are stored, removals
+after they are done, so a standby errs on the side of keeping mail (see ReplicatedStore). User
+accounts are not replicated, and neither is retention expiry (run maintenance on the standby as
+well). The stream is neither authenticated nor encrypted, so keep the port on a private network.
+
+Log records:
+   R <length> <crc32>\\n<JSON payload>\\n
+   {"op": "deliver", "user": "bert", "compression": null, "messages": ["<wire form>", ...]}
+   {"op": "remove", "user": "bert", "messages": [[<number>, "<sha1>"], ...]}
+Usage: python replication.py ship [<port>] --replication-log DIR [--retention-days N]
+       python replication.py standby --primary HOST[:PORT] [--mail-root DIR] [--checkpoint FILE]
+       python replication.py position --replication-log DIR
+"""
+
+import argparse
+import collections
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import select
+import socket
+import threading
+import time
+import zlib
+
+import config
+import notify
+import storage
+from profiling import timed
+from relay import parse_host
+from workers import create_listener, handle_sigterm
+
+REPLICATION_PORT = 2700
+SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_RETENTION_DAYS = 7
+POLL_INTERVAL = 0.2  # how often `ship` looks for new records once a standby has caught up
+PRUNE_INTERVAL = 3600
+RECV_SIZE = 256 * 1024
+RECONNECT_DELAY = 5
+CHECKPOINT_NAME = "replication.checkpoint"
+LOCK_NAME = "changes.lock"
+RECORD_HEADER = re.compile(rb"R (\d+) ([0-9a-f]{8})\n")
+
+
+class ReplicationError(Exception):
+    """The primary refused the position a standby asked for."""
+
+
+def segment_path(directory, start):
+    return os.path.join(directory, f"changes-{start:016d}.log")
+
+
+def list_segments(directory):
+    """Returns [(start position, path)] of the log segments in order."""
+    segments = []
+    for path in glob.glob(os.path.join(directory, "changes-*.log")):
+        name = os.path.basename(path)[len("changes-"):-len(".log")]
+        if name.isdigit():
+            segments.append((int(name), path))
+    return sorted(segments)
+
+
+def log_end(directory):
+    segments = list_segments(directory)
+    if not segments:
+        return 0
+    start, path = segments[-1]
+    return start + os.path.getsize(path)
+
+
+def encode_change(change):
+    payload = json.dumps(change).encode("utf-8")
+    return b"R %d %08x\n" % (len(payload), zlib.crc32(payload)) + payload + b"\n"
+
+
+def decode_changes(data):
+    """Parses the complete records at the start of data, returns (changes, bytes used, bytes skipped).
+
+    A damaged record (a process that died while appending it) is skipped up to the next record.
+    """
+    changes = []
+    pos = 0
+    skipped = 0
+    while True:
+        match = RECORD_HEADER.match(data, pos)
+        if match is None:
+            if len(data) - pos < 32 and b"\n" not in data[pos:]:
+                break  # the rest of a header still to come
+            resync = data.find(b"\nR ", pos + 1)
+            if resync == -1:
+                break
+            skipped += resync + 1 - pos
+            pos = resync + 1
+            continue
+        start = match.end()
+        end = start + int(match.group(1))
+        if len(data) < end + 1:
+            break
+        payload = data[start:end]
+        if data[end:end + 1] != b"\n" or zlib.crc32(payload) != int(match.group(2), 16):
+            resync = data.find(b"\nR ", pos + 1)
+            if resync == -1:
+                break
+            skipped += resync + 1 - pos
+            pos = resync + 1
+            continue
+        changes.append(json.loads(payload))
+        pos = end + 1
+    return changes, pos, skipped
+
+
+def message_digest(mailbox, number):
+    digest = hashlib.sha1()
+    for chunk in mailbox.message_chunks(number):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ChangeLog:
+    """Appends change records to the log in a directory, shared with other processes."""
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._lock_fd = None
+        self._segment_fd = None
+
+    def _reopen(self):
+        # A forked worker must not share the lock file (and its flock) with the parent
+        for fd in (self._lock_fd, self._segment_fd):
+            if fd is not None:
+                os.close(fd)
+        self._segment_fd = None
+        self._lock_fd = os.open(os.path.join(self.directory, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        self._pid = os.getpid()
+
+    def _segment(self):
+        """Returns the descriptor of the segment to append to, starting a new one when it is full."""
+        if self._segment_fd is not None:
+            if os.fstat(self._segment_fd).st_size < self.segment_size:
+                return self._segment_fd
+            os.close(self._segment_fd)  # full, another process may have started the next one already
+        segments = list_segments(self.directory)
+        start, path = segments[-1] if segments else (0, segment_path(self.directory, 0))
+        if segments and os.path.getsize(path) >= self.segment_size:
+            path = segment_path(self.directory, start + os.path.getsize(path))
+        created = not os.path.exists(path)
+        self._segment_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if created:
+            # A segment that vanished with the directory entry would take its fsynced records along
+            directory_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+        return self._segment_fd
+
+    def append(self, change, fsync=False):
+        """Appends a change record, on disk before this returns if fsync is set."""
+        record = encode_change(change)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reopen()
+            timed("lock", fcntl.flock, self._lock_fd, fcntl.LOCK_EX)
+            try:
+                fd = self._segment()
+                view = memoryview(record)
+                while view:
+                    view = view[timed("io", os.write, fd, view):]
+                if fsync:
+                    timed("io", os.fsync, fd)
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+
+class ReplicatedStore:
+    """A store whose deliveries and removals are also written to a ChangeLog.
+
+    A delivery is logged before it is stored, with the same fsync, so mail in a mailbox (and
+    acknowledged) is always in the log as well; a crash in between, or a delivery that fails,
+    can leave a standby with mail the primary never acknowledged, which the client then sends
+    again. A removal is logged after it is done, so a crash in between leaves the mail on the
+    standby rather than removing it there only. Either way no mail is lost on a standby.
+    """
+
+    def __init__(self, store, log):
+        self.store = store
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def deliver(self, username, messages, compression=None, fsync=False):
+        messages = list(messages)
+        self.log.append({"op": "deliver", "user": username, "compression": compression, "messages": messages}, fsync)
+        self.store.deliver(username, messages, compression, fsync)
+
+    @staticmethod
+    def _digests(removed):
+        """Returns the store's on_remove callback, adding a [number, digest] pair to removed for each message.
+
+        The store calls it under the lock (or in the transaction) of the removal itself, so the
+        digests name exactly the messages removed, whatever other sessions did meanwhile.
+        """
+        return lambda mailbox, number: removed.append([number, message_digest(mailbox, number)])
+
+    def remove_messages(self, username, numbers):
+        removed = []
+        self.store.remove_messages(username, numbers, self._digests(removed))
+        if removed:
+            self.log.append({"op": "remove", "user": username, "messages": removed})
+
+    def remove_uids(self, username, uids):
+        removed = []
+        self.store.remove_uids(username, uids, self._digests(removed))
+        if removed:
+            self.log.append({"op": "remove", "user": username, "messages": removed})
+
+
+def remove_by_digest(username, removed):
+    """Removes the messages named by [number, digest] pairs from a standby mailbox."""
+    wanted = collections.Counter(digest for _, digest in removed)
+    numbers = set()
+    with storage.store.open_mailbox(username) as mailbox:
+        # The numbers on the primary are tried first, mailboxes mostly match
+        for number, digest in removed:
+            if 1 <= number <= len(mailbox) and number not in numbers and wanted[digest] > 0:
+                if message_digest(mailbox, number) == digest:
+                    numbers.add(number)
+                    wanted[digest] -= 1
+        for number in range(1, len(mailbox) + 1):
+            if not +wanted:
+                break
+            if number not in numbers:
+                digest = message_digest(mailbox, number)
+                if wanted[digest] > 0:
+                    numbers.add(number)
+                    wanted[digest] -= 1
+    if +wanted:
+        print(f"{sum(wanted.values())} removed messages of {username} were not on this standby")
+    storage.store.remove_messages(username, numbers)
+
+
+def apply_changes(changes):
+    """Applies change records to the local store; consecutive deliveries to a user are stored in one go."""
+    batch = []  # messages of the deliveries being gathered
+    key = None  # (user, compression) they are for
+
+    def flush():
+        if batch:
+            storage.store.deliver(key[0], batch, key[1], fsync=True)
+            notify.new_mail([key[0]])
+
+    for change in changes:
+        if change["op"] == "deliver" and (change["user"], change["compression"]) == key:
+            batch.extend(change["messages"])
+            continue
+        flush()
+        batch, key = [], None
+        if change["op"] == "deliver":
+            batch, key = list(change["messages"]), (change["user"], change["compression"])
+        elif change["op"] == "remove":
+            remove_by_digest(change["user"], change["messages"])
+    flush()
+
+
+def read_checkpoint(path, default=0):
+    try:
+        with open(path, "r") as f:
+            return int(f.read().strip() or default)
+    except FileNotFoundError:
+        return default
+
+
+def write_checkpoint(path, position):
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        f.write(f"{position}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def follow(primary, position, checkpoint):
+    """Applies the primary's changes from position on until the connection is lost, returns the position reached."""
+    with socket.create_connection(primary, timeout=RECONNECT_DELAY) as conn:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        conn.sendall(f"FROM {position}\r\n".encode("ascii"))
+        data = b""
+        while b"\n" not in data:
+            chunk = conn.recv(1024)
+            if not chunk:
+                raise ConnectionError("primary closed the connection")
+            data += chunk
+        reply, _, data = data.partition(b"\n")
+        if not reply.startswith(b"+OK"):
+            raise ReplicationError(reply.decode("utf-8", "replace").strip())
+        print(f"Following {primary[0]}:{primary[1]} from position {position}")
+        conn.settimeout(None)  # quiet for as long as nothing is delivered
+        while True:
+            changes, used, skipped = decode_changes(data)
+            if used:
+                apply_changes(changes)
+                position += used
+                write_checkpoint(checkpoint, position)
+                data = data[used:]
+                if skipped:
+                    print(f"Skipped {skipped} bytes of damaged log before position {position}")
+            chunk = conn.recv(RECV_SIZE)
+            if not chunk:
+                return position
+            data += chunk
+
+
+def run_standby(primary, checkpoint, start=0):
+    position = read_checkpoint(checkpoint, start)
+    while True:
+        try:
+            position = follow(primary, position, checkpoint)
+            print("Primary closed the connection")
+        except OSError as e:
+            print(f"Replication connection failed: {e}")
+        time.sleep(RECONNECT_DELAY)
+
+
+def ship_changes(conn, directory, position):
+    """Streams the log from position to a standby, following it as it grows, until the standby leaves."""
+    poller = select.poll()
+    poller.register(conn, select.POLLIN)
+    while True:
+        segments = list_segments(directory)
+        start, path = next(((s, p) for s, p in reversed(segments) if s <= position), (position, None))
+        if path is not None:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if position < start + size:
+                    position += timed("io", conn.sendfile, f, position - start, start + size - position)
+                    continue
+            if segments[-1][0] > start:
+                continue  # the next segment starts where this one ends
+        if poller.poll(POLL_INTERVAL * 1000) and not conn.recv(1024):
+            return  # the standby is gone
+
+
+def handle_standby(conn, addr, directory):
+    try:
+        conn.settimeout(RECONNECT_DELAY)
+        request = conn.recv(1024).decode("ascii", "replace").split()
+        if len(request) != 2 or request[0] != "FROM" or not request[1].isdigit():
+            conn.sendall(b"-ERR FROM <position> expected\r\n")
+            return
+        position = int(request[1])
+        segments = list_segments(directory)
+        first = segments[0][0] if segments else 0
+        end = log_end(directory)
+        if position < first:
+            conn.sendall(f"-ERR position {position} is no longer in the log (it starts at {first})\r\n".encode("ascii"))
+            return
+        if position > end:
+            conn.sendall(f"-ERR position {position} is past the end of the log ({end})\r\n".encode("ascii"))
+            return
+        conn.sendall(f"+OK {position}\r\n".encode("ascii"))
+        print(f"Standby {addr} following from position {position}")
+        conn.settimeout(None)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ship_changes(conn, directory, position)
+    except OSError as e:
+        print(f"Standby {addr} failed: {e}")
+    finally:
+        conn.close()
+
+
+def prune_segments(directory, retention_days):
+    """Removes the segments last written to more than retention_days ago, never the newest one."""
+    cutoff = time.time() - retention_days * 86400
+    for _, path in list_segments(directory)[:-1]:
+        if os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            print(f"Removed old log segment {path}")
+
+
+def ship(server_socket, directory, retention_days=DEFAULT_RETENTION_DAYS):
+    print(f"Shipping {directory} on port {server_socket.getsockname()[1]}...")
+    stopping = threading.Event()
+
+    def prune_loop():
+        while not stopping.is_set():
+            if retention_days:
+                prune_segments(directory, retention_days)
+            stopping.wait(PRUNE_INTERVAL)
+
+    threading.Thread(target=prune_loop, daemon=True).start()
+    try:
+        while True:
+            conn, addr = server_socket.accept()
+            threading.Thread(target=handle_standby, args=(conn, addr, directory), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\nShutting down the log shipping.")
+    finally:
+        stopping.set()
+        server_socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(usage="python replication.py ship|standby|position [<port>] [--config FILE]")
+    parser.add_argument("command", choices=("ship", "standby", "position"))
+    parser.add_argument("port", type=int, nargs="?", default=REPLICATION_PORT)
+    parser.add_argument("--retention-days", type=float, default=DEFAULT_RETENTION_DAYS,
+                        help="ship: days log segments are kept for standbys that fall behind (0 keeps them)")
+    parser.add_argument("--primary", help=f"standby: HOST[:PORT] of the primary's `ship` (default port {REPLICATION_PORT})")
+    parser.add_argument("--checkpoint", help=f"standby: file the position applied is kept in (default <mail root>/{CHECKPOINT_NAME})")
+    parser.add_argument("--start", type=int, default=0, help="standby: position to start at without a checkpoint")
+    config.add_mail_arguments(parser)
+    args = config.parse_args(parser, "replication")
+
+    if args.command in ("ship", "position"):
+        if not args.replication_log:
+            parser.error("--replication-log is needed")
+        if args.command == "position":
+            print(log_end(args.replication_log))
+            return
+        handle_sigterm()
+        ship(create_listener(args.port), args.replication_log, args.retention_days)
+        return
+
+    if not args.primary:
+        parser.error("--primary is needed")
+    # The standby applies the primary's log, it does not write one of its own
+    args.replication_log = None
+    config.apply_mail_options(args)
+    handle_sigterm()
+    try:
+        run_standby(parse_host(args.primary, REPLICATION_PORT),
+                    args.checkpoint or os.path.join(args.mail_root, CHECKPOINT_NAME), args.start)
+    except ReplicationError as e:
+        parser.exit(1, f"Replication refused: {e}\n")
+    except KeyboardInterrupt:
+        print("\nStopping the standby.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+sessions.py
+-----------
+Connection bookkeeping shared by the SMTP and POP3 servers.
+SessionRegistry caps the number of concurrent sessions and drives graceful shutdown:
+once draining starts, sessions finish the command they are in (a DATA transfer or a QUIT
+commit) and then close, and connections still open when the drain timeout expires are
+shut down so no thread outlives the server.
+ReplyBuffer collects a session's replies so the answers to a batch of pipelined commands
+leave in a single write instead of one per reply line, LineBuffer hands out the commands of such
+a batch a line at a time however the reads cut them up.
+"""
+
+import select
+import socket
+import ssl
+import threading
+import time
+
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_COMMAND_TIMEOUT = 60
+DEFAULT_MAX_SESSIONS = 1000
+DEFAULT_DRAIN_TIMEOUT = 30
+DEFAULT_RECV_SIZE = 1024
+REPLY_BUFFER_SIZE = 64 * 1024  # queued reply bytes that are sent without waiting for a flush point
+MAX_IOV = 1024  # buffers per sendmsg, the usual IOV_MAX
+
+# How often a session waiting for input checks whether the server is draining
+POLL_INTERVAL = 0.5
+# A command still without its line ending after this long is taken as complete (clients that leave out the CRLF)
+UNTERMINATED_LINE_DELAY = 0.5
+
+
+class SessionRegistry:
+    """Bounded set of live client connections."""
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.draining = threading.Event()
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._empty = threading.Condition(self._lock)
+
+    def add(self, conn) -> bool:
+        """Registers a connection, returns False when the server is full or draining."""
+        with self._lock:
+            if self.draining.is_set() or len(self._connections) >= self.max_sessions:
+                return False
+            self._connections.add(conn)
+            return True
+
+    def replace(self, conn, new_conn):
+        """Swaps a connection for the TLS socket it was upgraded to."""
+        with self._lock:
+            self._connections.discard(conn)
+            self._connections.add(new_conn)
+
+    def remove(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+            if not self._connections:
+                self._empty.notify_all()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._connections)
+
+    def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """Asks all sessions to finish up and waits for them for at most timeout seconds.
+
+        Connections still open afterwards are shut down, which ends their threads.
+        """
+        self.draining.set()
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._connections:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._empty.wait(remaining)
+            leftover = list(self._connections)
+        for conn in leftover:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return len(leftover)
+
+
+class ReplyBuffer:
+    """Replies queued for a connection until the session reaches a flush point.
+
+    Sessions flush once they have handled every complete command they received and before
+    anything that waits on the client (STARTTLS, IDLE, closing), so pipelined commands are
+    answered with one send. Plain sockets get the buffers in one sendmsg (writev), without
+    joining them; TLS sockets get small replies joined so they share a record.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._parts = []
+        self._size = 0
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= REPLY_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self, *parts):
+        """Sends the queued replies followed by parts (e.g. memoryviews of a stored message)."""
+        parts = self._parts + list(parts)
+        self._parts = []
+        self._size = 0
+        if not parts:
+            return
+        if isinstance(self.conn, ssl.SSLSocket):
+            # SSL sockets have no sendmsg, the records are encrypted one buffer at a time anyway
+            if len(parts) > 1 and sum(len(part) for part in parts) <= REPLY_BUFFER_SIZE:
+                parts = [b"".join(parts)]
+            for part in parts:
+                self.conn.sendall(part)
+            return
+        views = [memoryview(part) for part in parts]
+        first = 0
+        while first < len(views):
+            sent = self.conn.sendmsg(views[first:first + MAX_IOV])
+            while first < len(views) and sent >= len(views[first]):
+                sent -= len(views[first])
+                views[first].release()
+                first += 1
+            if sent:
+                views[first] = views[first][sent:]
+
+    def __len__(self):
+        return self._size
+
+
+class LineBuffer:
+    """Bytes received from a client, handed out a complete line at a time.
+
+    A line cut off by a read waits here for the rest of it, so commands are never split in two
+    and neither are the UTF-8 characters in them.
+    """
+
+    def __init__(self):
+        self._data = b""
+        self._start = 0  # where the lines not handed out yet begin
+
+    def __len__(self):
+        return len(self._data) - self._start
+
+    def feed(self, data):
+        self._data = self._data[self._start:] + data
+        self._start = 0
+
+    def next_line(self):
+        """Returns the next complete line without its line ending, None if there is none yet."""
+        end = self._data.find(b"\n", self._start)
+        if end == -1:
+            return None
+        line = self._data[self._start:end].rstrip(b"\r")
+        self._start = end + 1
+        return line.decode("utf-8", "replace")
+
+    def take(self):
+        """Returns and removes everything not handed out as a line yet."""
+        data = self._data[self._start:]
+        self._data = b""
+        self._start = 0
+        return data
+
+
+def wait_for_input(conn, idle_timeout, draining=None) -> bool:
+    """Waits until conn has data to read.
+
+    Returns False when idle_timeout passes first or, if a draining event is given,
+    when the server starts draining.
+    """
+    if isinstance(conn, ssl.SSLSocket) and conn.pending():
+        return True  # already decrypted, the socket itself may have nothing more
+    deadline = time.monotonic() + idle_timeout if idle_timeout else None
+    poller = select.poll()
+    poller.register(conn, select.POLLIN)
+    while True:
+        if draining is not None and draining.is_set():
+            return False
+        wait = POLL_INTERVAL
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            wait = min(wait, remaining)
+        if poller.poll(wait * 1000):
+            return True
+
+
+def reject(conn, message):
+    """Sends a one-line refusal to a connection that will not get a session, then closes it."""
+    try:
+        conn.settimeout(1)
+        conn.sendall((message + "\r\n").encode("utf-8"))
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+def add_session_arguments(parser, default_idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    parser.add_argument("--idle-timeout", type=float, default=default_idle_timeout,
+                        help="seconds a client may stay silent before it is disconnected")
+    parser.add_argument("--command-timeout", type=float, default=DEFAULT_COMMAND_TIMEOUT,
+                        help="seconds a single read or reply may block")
+    parser.add_argument("--max-sessions", type=int, default=DEFAULT_MAX_SESSIONS,
+                        help="concurrent sessions per process, further connections are refused")
+    parser.add_argument("--drain-timeout", type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help="seconds open sessions get to finish when the server shuts down")
+    parser.add_argument("--recv-size", type=int, default=DEFAULT_RECV_SIZE,
+                        help="bytes read from a client connection at a time")
+
+
+def session_options(args):
+    return {"idle_timeout": args.idle_timeout, "command_timeout": args.command_timeout,
+            "max_sessions": args.max_sessions, "drain_timeout": args.drain_timeout, "recv_size": args.recv_size}
@@ -0,0 +1,497 @@
+"""
+storage.py
+----------
+The user and mailbox store behind the servers and tools, selected with --store.
+   file    users in userinfo.txt, one mailbox file per user under the mail root (the default)
+   sqlite  users, messages and their headers in an SQLite database (--database) in WAL mode
+Both offer the same operations, keyed by username: user lookups, delivery, usage counters,
+numbered read access to a mailbox (the MailboxReader interface), deletion, maintenance and
+header search, plus the message UIDs and flags the IMAP server works with. The servers reach
+the selected store through storage.store.
+In the database, messages are kept in the same stored form as in a mailbox file (wire form,
+possibly compressed) and indexed by user, received time and sender, with their headers in a
+table of their own, so STAT, LIST, RETR, DELE, recipient checks and header searches are indexed
+queries. WAL mode lets any number of sessions read while mail is delivered; every thread uses
+its own connection. Message ids are never reused, so they double as IMAP UIDs.
+"""
+
+import contextlib
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+import mailstore
+from mailstore import (DECOMPRESSORS, RECEIVED_FORMAT, MailboxReader, append_messages, encode_record,
+                       get_mailbox_path, make_record, parse_frame, parse_received, read_uids, read_usage,
+                       remove_messages, rewrite_mailbox, write_uids)
+
+STORES = ("file", "sqlite")
+DATABASE_NAME = "swmgmail.db"
+BUSY_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    received TEXT,
+    sender TEXT,
+    octets INTEGER NOT NULL,
+    codec TEXT,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_user ON messages (user, id, octets, codec);
+CREATE INDEX IF NOT EXISTS messages_received ON messages (user, received);
+CREATE INDEX IF NOT EXISTS messages_sender ON messages (user, sender);
+CREATE TABLE IF NOT EXISTS headers (
+    message INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS headers_message ON headers (message, name);
+CREATE TABLE IF NOT EXISTS flags (
+    message INTEGER PRIMARY KEY REFERENCES messages (id) ON DELETE CASCADE,
+    flags TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+def parse_headers(message):
+    """Returns the (lowercased name, value) header lines a stamped message starts with.
+
+    Messages have no blank line after their headers; the Received: line stamped on delivery
+    is the last header, unless a line not looking like one comes first.
+    """
+    headers = []
+    for line in message.split("\r\n"):
+        name, sep, value = line.partition(": ")
+        if not sep or not name or " " in name:
+            break
+        headers.append((name.lower(), value))
+        if name.lower() == "received":
+            break
+    return headers
+
+
+def matches(headers, header, text):
+    return any(name == header and text.lower() in value.lower() for name, value in headers)
+
+
+class FileStore:
+    """Users from userinfo.txt, mail in the mailbox files."""
+
+    def __init__(self, userinfo_path):
+        self.userinfo_path = userinfo_path
+
+    def _users(self):
+        # no lock since this file is written manually
+        with open(self.userinfo_path, "r") as f:
+            for line in f:
+                parts = line.strip().split(maxsplit=1)  # Split into username and password
+                if parts:
+                    yield parts[0], parts[1] if len(parts) == 2 else None
+
+    def usernames(self):
+        return [name for name, _ in self._users()]
+
+    def has_user(self, username):
+        return any(name == username for name, _ in self._users())
+
+    def password(self, username):
+        return next((password for name, password in self._users() if name == username), None)
+
+    def deliver(self, username, messages, compression=None, fsync=False):
+        append_messages(get_mailbox_path(username), messages, compression, fsync)
+
+    def usage(self, username):
+        return read_usage(get_mailbox_path(username))
+
+    def size(self, username):
+        try:
+            return os.path.getsize(get_mailbox_path(username))
+        except FileNotFoundError:
+            return 0
+
+    def open_mailbox(self, username, exclusive=False):
+        return MailboxReader(get_mailbox_path(username), exclusive)
+
+    def remove_messages(self, username, numbers, on_remove=None):
+        """Removes messages by number; on_remove(mailbox, number) sees each one before it goes,
+        under the same lock as the removal."""
+        if on_remove is None:
+            remove_messages(get_mailbox_path(username), numbers)
+            return
+        if not numbers:
+            return
+
+        def keep(mailbox, number):
+            if number not in numbers:
+                return True
+            on_remove(mailbox, number)
+            return False
+
+        rewrite_mailbox(get_mailbox_path(username), keep)
+
+    def maintain(self, username, retention_days=None, compression=None, now=None):
+        """Expires and compacts one mailbox, returns (messages expired, bytes reclaimed)."""
+        keep = None
+        if retention_days:
+            cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=retention_days)
+
+            def keep(mailbox, number):
+                received = parse_received(mailbox.message_head(number))
+                return received is None or received >= cutoff
+
+        return rewrite_mailbox(get_mailbox_path(username), keep, compression)
+
+    def uids(self, username):
+        """Returns (uidvalidity, uidnext, [(uid, octets, flags)]) for the messages in mailbox order."""
+        path = get_mailbox_path(username)
+        with MailboxReader(path) as mailbox:
+            state = read_uids(path, len(mailbox))
+            sizes = mailbox.sizes()
+        if state is None:
+            # Numbering the messages needs the exclusive lock, and a mailbox file to hold it on
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "ab").close()
+            with MailboxReader(path, exclusive=True) as mailbox:
+                state = read_uids(path, len(mailbox))
+                sizes = mailbox.sizes()
+                if state is None:
+                    previous = read_uids(path, None)
+                    uidvalidity = max(int(time.time()), previous[0] + 1 if previous else 0)
+                    state = (uidvalidity, len(mailbox) + 1, [(uid, frozenset()) for uid in range(1, len(mailbox) + 1)])
+                    write_uids(path, *state)
+        uidvalidity, uidnext, messages = state
+        return uidvalidity, uidnext, [(uid, octets, flags) for (uid, flags), octets in zip(messages, sizes)]
+
+    def set_flags(self, username, flags):
+        """Replaces the flags of the messages given as {uid: flags}, UIDs no longer there are skipped."""
+        path = get_mailbox_path(username)
+        with MailboxReader(path, exclusive=True) as mailbox:
+            state = read_uids(path, len(mailbox))
+            if state is None:
+                return
+            uidvalidity, uidnext, messages = state
+            write_uids(path, uidvalidity, uidnext,
+                       [(uid, frozenset(flags.get(uid, old))) for uid, old in messages])
+
+    def remove_uids(self, username, uids, on_remove=None):
+        """Removes messages by UID, on_remove as with remove_messages."""
+        uids = set(uids)
+        if not uids:
+            return
+        path = get_mailbox_path(username)
+        numbered = None
+
+        def keep(mailbox, number):
+            nonlocal numbered
+            if numbered is None:
+                numbered = mailbox.uids() or []
+            if number > len(numbered) or numbered[number - 1] not in uids:
+                return True
+            if on_remove is not None:
+                on_remove(mailbox, number)
+            return False
+
+        rewrite_mailbox(path, keep)
+
+    def search(self, username, header=None, text="", since=None, before=None, by_uid=False):
+        """Returns the numbers (UIDs with by_uid) of the messages whose header contains text
+        (any case) and that were received in [since, before)."""
+        numbers = []
+        with self.open_mailbox(username) as mailbox:
+            uids = mailbox.uids() if by_uid else None
+            if by_uid and uids is None:
+                return []
+            for number in range(1, len(mailbox) + 1):
+                head = bytes(mailbox.message_head(number))
+                if since is not None or before is not None:
+                    received = parse_received(head)
+                    if received is None or (since and received < since) or (before and received >= before):
+                        continue
+                if header is None or matches(parse_headers(head.decode("utf-8", "replace")), header, text):
+                    numbers.append(uids[number - 1] if by_uid else number)
+        return numbers
+
+
+class SQLiteMailbox:
+    """A user's messages in the database, read in one transaction (MailboxReader's interface)."""
+
+    def __init__(self, db, username, exclusive=False):
+        self.db = db
+        self.username = username
+        self.exclusive = exclusive
+        self.entries = []
+
+    def __enter__(self):
+        self._own_transaction = not self.db.in_transaction
+        if self._own_transaction:
+            # A snapshot: numbers stay valid while mail is delivered meanwhile
+            self.db.execute("BEGIN IMMEDIATE" if self.exclusive else "BEGIN")
+        self.entries = self.db.execute("SELECT id, octets, codec FROM messages WHERE user = ? ORDER BY id",
+                                       (self.username,)).fetchall()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.entries = []
+        if self._own_transaction:
+            self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def octets(self, number):
+        return self.entries[number - 1][1]
+
+    def sizes(self):
+        return [octets for _, octets, _ in self.entries]
+
+    def message(self, number):
+        if not (1 <= number <= len(self.entries)):
+            return None
+        return b"".join(self.message_chunks(number))
+
+    def message_chunks(self, number):
+        """Yields the message in wire form, a plain one read from the database a chunk at a time."""
+        message_id, _, codec = self.entries[number - 1]
+        with self.db.blobopen("messages", "data", message_id, readonly=True) as blob:
+            if codec is not None:
+                yield from MailboxReader._inflate(blob.read(), codec)
+                return
+            while True:
+                chunk = blob.read(mailstore.CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def message_head(self, number, limit=1024):
+        message_id, _, codec = self.entries[number - 1]
+        with self.db.blobopen("messages", "data", message_id, readonly=True) as blob:
+            if codec is None:
+                return blob.read(limit)
+            frame = blob.read()
+        _, _, data_start, frame_end = parse_frame(frame, 0)
+        data = frame[data_start:min(frame_end, data_start + mailstore.CHUNK_SIZE)]
+        return DECOMPRESSORS[codec]().decompress(data, limit)
+
+    def ids(self, numbers):
+        return [self.entries[number - 1][0] for number in numbers if 1 <= number <= len(self.entries)]
+
+    def uids(self):
+        return [message_id for message_id, _, _ in self.entries]
+
+
+class SQLiteStore:
+    """Users and mail in an SQLite database, one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Set up with a connection of its own, so none is inherited by forked workers
+        db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        try:
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")  # only takes effect on a new database
+            db.execute("PRAGMA journal_mode = WAL")
+            db.executescript(SCHEMA)
+            db.execute("INSERT OR IGNORE INTO settings (name, value) VALUES ('uidvalidity', ?)", (int(time.time()),))
+        finally:
+            db.close()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            db.execute("PRAGMA foreign_keys = ON")
+            db.execute("PRAGMA synchronous = NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def usernames(self):
+        return [name for name, in self._db().execute("SELECT name FROM users ORDER BY name")]
+
+    def has_user(self, username):
+        return self._db().execute("SELECT 1 FROM users WHERE name = ?", (username,)).fetchone() is not None
+
+    def password(self, username):
+        row = self._db().execute("SELECT password FROM users WHERE name = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def set_password(self, username, password):
+        with self._transaction() as db:
+            db.execute("INSERT INTO users (name, password) VALUES (?, ?) "
+                       "ON CONFLICT (name) DO UPDATE SET password = excluded.password", (username, password))
+
+    def deliver(self, username, messages, compression=None, fsync=False):
+        """Stores stamped messages for a user in one transaction; with fsync it is on disk when this returns."""
+        encoded = [make_record(message, compression) for message in messages]
+        self._db().execute(f"PRAGMA synchronous = {'FULL' if fsync else 'NORMAL'}")
+        with self._transaction() as db:
+            for message, (record, octets, codec) in zip(messages, encoded):
+                self._insert(db, username, message, record, octets, codec)
+
+    @staticmethod
+    def _insert(db, username, message, record, octets, codec):
+        headers = parse_headers(message)
+        received = next((value for name, value in headers if name == "received"), None)
+        try:
+            received = datetime.datetime.strptime(received, RECEIVED_FORMAT).strftime("%Y-%m-%d %H:%M")
+        except (TypeError, ValueError):
+            received = None
+        sender = next((value.lower() for name, value in headers if name == "from"), None)
+        message_id = db.execute("INSERT INTO messages (user, received, sender, octets, codec, data) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                (username, received, sender, octets, codec, record)).lastrowid
+        db.executemany("INSERT INTO headers (message, name, value) VALUES (?, ?, ?)",
+                       [(message_id, name, value) for name, value in headers])
+
+    def import_mailbox(self, username, mailbox):
+        """Copies the messages of an open MailboxReader into the database as they are stored."""
+        with self._transaction() as db:
+            for number, (_, _, octets, codec) in enumerate(mailbox.entries, start=1):
+                head = bytes(mailbox.message_head(number)).decode("utf-8", "replace")
+                self._insert(db, username, head, mailbox.record(number), octets, codec)
+        return len(mailbox)
+
+    def usage(self, username):
+        return self._db().execute("SELECT count(*), coalesce(sum(octets), 0) FROM messages WHERE user = ?",
+                                  (username,)).fetchone()
+
+    def size(self, username):
+        return self._db().execute("SELECT coalesce(sum(length(data)), 0) FROM messages WHERE user = ?",
+                                  (username,)).fetchone()[0]
+
+    def open_mailbox(self, username, exclusive=False):
+        return SQLiteMailbox(self._db(), username, exclusive)
+
+    def remove_messages(self, username, numbers, on_remove=None):
+        """Removes messages by number; on_remove(mailbox, number) sees each one before it goes,
+        in the same transaction as the removal."""
+        if not numbers:
+            return
+        with self.open_mailbox(username, exclusive=True) as mailbox:
+            if on_remove is not None:
+                for number in sorted(numbers):
+                    if 1 <= number <= len(mailbox):
+                        on_remove(mailbox, number)
+            mailbox.db.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in mailbox.ids(numbers)])
+
+    def maintain(self, username, retention_days=None, compression=None, now=None):
+        """Expires and compresses one user's mail, returns (messages expired, bytes reclaimed)."""
+        dropped = reclaimed = 0
+        with self._transaction() as db:
+            if retention_days:
+                cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=retention_days)
+                reclaimed += db.execute("SELECT coalesce(sum(length(data)), 0) FROM messages "
+                                        "WHERE user = ? AND received < ?",
+                                        (username, cutoff.strftime("%Y-%m-%d %H:%M"))).fetchone()[0]
+                dropped = db.execute("DELETE FROM messages WHERE user = ? AND received < ?",
+                                     (username, cutoff.strftime("%Y-%m-%d %H:%M"))).rowcount
+            if compression is not None:
+                rows = db.execute("SELECT id, octets, data FROM messages WHERE user = ? AND codec IS NULL",
+                                  (username,)).fetchall()
+                for message_id, octets, data in rows:
+                    record, _, codec = encode_record(data, octets, compression)
+                    if codec is not None:
+                        db.execute("UPDATE messages SET data = ?, codec = ? WHERE id = ?", (record, codec, message_id))
+                        reclaimed += len(data) - len(record)
+        if dropped or reclaimed:
+            self._db().execute("PRAGMA incremental_vacuum")
+        return dropped, reclaimed
+
+    def uids(self, username):
+        """Returns (uidvalidity, uidnext, [(uid, octets, flags)]) for the messages in mailbox order."""
+        db = self._db()
+        rows = db.execute("SELECT id, octets, flags FROM messages LEFT JOIN flags ON message = id "
+                          "WHERE user = ? ORDER BY id", (username,)).fetchall()
+        # Read after the messages, so uidnext is above every UID returned
+        row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        uidvalidity, = db.execute("SELECT value FROM settings WHERE name = 'uidvalidity'").fetchone()
+        return uidvalidity, (row[0] if row else 0) + 1, [(uid, octets, frozenset((flags or "").split()))
+                                                         for uid, octets, flags in rows]
+
+    def set_flags(self, username, flags):
+        """Replaces the flags of the messages given as {uid: flags}, UIDs no longer there are skipped."""
+        with self._transaction() as db:
+            for uid, new_flags in flags.items():
+                db.execute("DELETE FROM flags WHERE message = (SELECT id FROM messages WHERE id = ? AND user = ?)",
+                           (uid, username))
+                if new_flags:
+                    db.execute("INSERT INTO flags (message, flags) SELECT id, ? FROM messages WHERE id = ? AND user = ?",
+                               (" ".join(sorted(new_flags)), uid, username))
+
+    def remove_uids(self, username, uids, on_remove=None):
+        """Removes messages by UID, on_remove as with remove_messages."""
+        if on_remove is None:
+            with self._transaction() as db:
+                db.executemany("DELETE FROM messages WHERE id = ? AND user = ?", [(uid, username) for uid in uids])
+            return
+        uids = set(uids)
+        with self.open_mailbox(username, exclusive=True) as mailbox:
+            numbers = [number for number, uid in enumerate(mailbox.uids(), start=1) if uid in uids]
+            for number in numbers:
+                on_remove(mailbox, number)
+            mailbox.db.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in mailbox.ids(numbers)])
+
+    def search(self, username, header=None, text="", since=None, before=None, by_uid=False):
+        """Returns the numbers (UIDs with by_uid) of the messages whose header contains text
+        (any case) and that were received in [since, before)."""
+        conditions = ["1"]
+        args = [username]
+        if since is not None:
+            conditions.append("received >= ?")
+            args.append(since.strftime("%Y-%m-%d %H:%M"))
+        if before is not None:
+            conditions.append("received < ?")
+            args.append(before.strftime("%Y-%m-%d %H:%M"))
+        pattern = "%" + text.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        if header == "from":
+            conditions.append("sender LIKE ? ESCAPE '\\'")
+            args.append(pattern)
+        elif header is not None:
+            conditions.append("EXISTS (SELECT 1 FROM headers WHERE message = id AND name = ? "
+                              "AND lower(value) LIKE ? ESCAPE '\\')")
+            args += [header, pattern]
+        rows = self._db().execute(f"SELECT {'id' if by_uid else 'number'} FROM (SELECT id, received, sender, "
+                                  f"row_number() OVER (ORDER BY id) AS number FROM messages WHERE user = ?) "
+                                  f"WHERE {' AND '.join(conditions)} ORDER BY number", args)
+        return [number for number, in rows]
+
+
+store = FileStore("userinfo.txt")
+
+
+def set_store(new_store):
+    """Selects the store the servers and tools use (set once at startup)."""
+    global store
+    store = new_store
+
+
+def open_store(kind, userinfo_path, database=None):
+    if kind == "sqlite":
+        return SQLiteStore(database)
+    return FileStore(userinfo_path)
@@ -0,0 +1,152 @@
+"""
+test_imap_server.py
+-------------------
+Runs IMAP sessions over real sockets against a temporary mailbox, next to POP3 sessions on it.
+Usage: python -m pytest tests
+"""
+
+import argparse
+import imaplib
+import os
+import poplib
+import socket
+import tempfile
+import threading
+import unittest
+
+import config
+import pop_server
+import storage
+from imap_server import IMAPSession
+from mailserver_smtp import stamp_message
+from sessions import SessionRegistry
+
+
+class IMAPSessionTest(unittest.TestCase):
+    store_arguments = []
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        userinfo = os.path.join(self.directory.name, "userinfo.txt")
+        with open(userinfo, "w") as f:
+            f.write("bert pw\n")
+        parser = argparse.ArgumentParser()
+        config.add_mail_arguments(parser)
+        config.apply_mail_options(parser.parse_args(
+            ["--mail-root", os.path.join(self.directory.name, "mail"), "--userinfo", userinfo]
+            + self.store_arguments))
+        if hasattr(storage.store, "set_password"):
+            storage.store.set_password("bert", "pw")
+        self.deliver(1, 2, 3, 4, 5)
+        self.sessions = SessionRegistry()
+        self.imap_listener = self.listen(self.serve_imap)
+        self.pop_listener = self.listen(self.serve_pop)
+
+    def tearDown(self):
+        self.imap_listener.close()
+        self.pop_listener.close()
+        self.directory.cleanup()
+
+    def listen(self, serve):
+        listener = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=serve, args=(listener,), daemon=True).start()
+        return listener
+
+    def serve_imap(self, listener):
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                return
+            self.sessions.add(conn)
+            session = IMAPSession(conn, addr, draining=self.sessions.draining, sessions=self.sessions)
+            threading.Thread(target=session.handle_client, daemon=True).start()
+
+    def serve_pop(self, listener):
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                return
+            self.sessions.add(conn)
+            threading.Thread(target=pop_server.handle_client, args=(conn, addr, self.sessions), daemon=True).start()
+
+    def deliver(self, *numbers):
+        storage.store.deliver("bert", [stamp_message(["From: alice@example.com", f"To: bert@{config.domain}",
+                                                      f"Subject: message {i}", "", f"body {i}"])
+                                       for i in numbers])
+
+    def imap_login(self):
+        client = imaplib.IMAP4("127.0.0.1", self.imap_listener.getsockname()[1], timeout=5)
+        client.login("bert", "pw")
+        client.select("INBOX")
+        return client
+
+    def pop_login(self):
+        client = poplib.POP3("127.0.0.1", self.pop_listener.getsockname()[1], timeout=5)
+        client.user("bert")
+        client.pass_("pw")
+        return client
+
+    def subjects(self):
+        with storage.store.open_mailbox("bert") as mailbox:
+            return [bytes(mailbox.message_head(number)).split(b"Subject: ")[1].split(b"\r\n")[0].decode()
+                    for number in range(1, len(mailbox) + 1)]
+
+    def test_expunge_while_a_pop3_session_has_marked_mail(self):
+        pop = self.pop_login()
+        pop.dele(4)
+        imap = self.imap_login()
+        imap.store("1", "+FLAGS", "(\\Deleted)")
+        imap.expunge()
+        imap.logout()
+        # Message 4 of the POP3 session is number 3 by now, it is still the one removed
+        pop.quit()
+        self.assertEqual(self.subjects(), ["message 2", "message 3", "message 5"])
+
+    def test_pop3_quit_while_selected(self):
+        imap = self.imap_login()
+        pop = self.pop_login()
+        pop.dele(2)
+        pop.quit()
+        imap.store("3", "+FLAGS", "(\\Deleted)")  # message 3 of the IMAP session, before the NOOP
+        imap.noop()
+        self.assertEqual(imap.response("EXPUNGE")[1], [b"2"])
+        imap.expunge()
+        imap.logout()
+        self.assertEqual(self.subjects(), ["message 1", "message 4", "message 5"])
+
+    def fetch_uids(self, imap):
+        typ, data = imap.fetch("1:*", "(UID)")
+        return [int(line.split(b"UID ")[1].rstrip(b")")) for line in data]
+
+    def test_uids_after_expunge(self):
+        imap = self.imap_login()
+        uidvalidity = imap.response("UIDVALIDITY")[1]
+        imap.response("EXISTS")  # from SELECT
+        before = self.fetch_uids(imap)
+        imap.store("2", "+FLAGS", "(\\Deleted)")
+        self.assertEqual(imap.expunge()[1], [b"2"])
+        self.deliver(6)
+        imap.noop()
+        self.assertEqual(imap.response("EXISTS")[1], [b"5"])
+        after = self.fetch_uids(imap)
+        imap.logout()
+        # The others keep their UIDs, the removed one is not reused
+        self.assertEqual(after[:4], before[:1] + before[2:])
+        self.assertGreater(after[4], before[-1])
+
+        imap = self.imap_login()
+        self.assertEqual(imap.response("UIDVALIDITY")[1], uidvalidity)
+        self.assertEqual(int(imap.response("UIDNEXT")[1][0]), after[-1] + 1)
+        self.assertEqual(self.fetch_uids(imap), after)
+        typ, data = imap.uid("FETCH", str(after[1]), "(BODY.PEEK[HEADER.FIELDS (SUBJECT)])")
+        self.assertIn(b"message 3", data[0][1])
+        imap.logout()
+
+class SQLiteIMAPSessionTest(IMAPSessionTest):
+    store_arguments = ["--store", "sqlite"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+test_journal.py
+---------------
+Journals deliveries into a temporary mail root, with crashes and failing stores along the way.
+Usage: python -m pytest tests
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import config
+import journal
+import storage
+from journal import DeliveryJournal, JournalError, encode_delivery, recover_journals
+from mailserver_smtp import stamp_message
+
+
+def message(subject):
+    return stamp_message(["From: alice@example.com", f"To: bert@{config.domain}", f"Subject: {subject}", "", "body"])
+
+
+class FailingStore:
+    """Passes everything on to a store, except deliveries while failing is set."""
+
+    def __init__(self, store):
+        self.store = store
+        self.failing = True
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def deliver(self, username, messages, compression=None, fsync=False):
+        if self.failing:
+            raise OSError("disk on fire")
+        self.store.deliver(username, messages, compression, fsync)
+
+
+class DeliveryJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        userinfo = os.path.join(self.directory.name, "userinfo.txt")
+        with open(userinfo, "w") as f:
+            f.write("bert pw\n")
+        parser = argparse.ArgumentParser()
+        config.add_mail_arguments(parser)
+        config.apply_mail_options(parser.parse_args(
+            ["--mail-root", os.path.join(self.directory.name, "mail"), "--userinfo", userinfo]))
+        self.journal_dir = os.path.join(self.directory.name, "journal")
+        os.makedirs(self.journal_dir)
+        patcher = mock.patch.object(journal, "APPLY_RETRY_DELAY", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def journals(self):
+        return glob.glob(os.path.join(self.journal_dir, "journal-*.log"))
+
+    def subjects(self):
+        with storage.store.open_mailbox("bert") as mailbox:
+            return [bytes(mailbox.message_head(number)).split(b"Subject: ")[1].split(b"\r\n")[0].decode()
+                    for number in range(1, len(mailbox) + 1)]
+
+    def test_submitted_mail_is_delivered_and_the_journal_removed(self):
+        delivery_journal = DeliveryJournal(self.journal_dir)
+        delivery_journal.submit(message("one"), ["bert"])
+        delivery_journal.submit(message("two"), ["bert"])
+        delivery_journal.close()
+        self.assertEqual(self.subjects(), ["one", "two"])
+        self.assertEqual(self.journals(), [])
+
+    def test_replay_after_a_crash(self):
+        # What a server killed between journaling three messages and applying the last two leaves
+        with open(os.path.join(self.journal_dir, "journal-99999-1.log"), "wb") as f:
+            for seq, subject in enumerate(["one", "two", "three"], start=1):
+                f.write(encode_delivery(seq, message(subject), ["bert"], None))
+            f.write(b"A 1\n")
+            f.write(encode_delivery(4, message("torn"), ["bert"], None)[:-10])
+        self.assertEqual(recover_journals(self.journal_dir), 2)
+        self.assertEqual(self.subjects(), ["two", "three"])
+        self.assertEqual(self.journals(), [])
+
+    def test_unapplied_mail_is_kept_for_the_next_start(self):
+        failing = FailingStore(storage.store)
+        storage.set_store(failing)
+        delivery_journal = DeliveryJournal(self.journal_dir)
+        delivery_journal.submit(message("one"), ["bert"])
+        # The store keeps failing, shutting down gives up after a few more attempts
+        delivery_journal.close()
+        self.assertEqual(len(self.journals()), 1)
+        failing.failing = False
+        self.assertEqual(recover_journals(self.journal_dir), 1)
+        self.assertEqual(self.subjects(), ["one"])
+        self.assertEqual(self.journals(), [])
+
+    def test_write_failure_refuses_further_deliveries(self):
+        delivery_journal = DeliveryJournal(self.journal_dir)
+        try:
+            with self.assertRaises(JournalError):
+                delivery_journal.submit(object(), ["bert"])  # cannot be encoded
+            with self.assertRaises(JournalError):
+                delivery_journal.submit(message("one"), ["bert"])
+        finally:
+            delivery_journal.close()
+        self.assertEqual(self.subjects(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
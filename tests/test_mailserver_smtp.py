@@ -0,0 +1,111 @@
+"""
+test_mailserver_smtp.py
+-----------------------
+Sends mail to an SMTP session over a real socket and reads it back from the store.
+Usage: python -m pytest tests
+"""
+
+import argparse
+import os
+import smtplib
+import socket
+import tempfile
+import threading
+import unittest
+
+import config
+import storage
+from mailserver_smtp import SMTPSession
+from relay import Relay, parse_networks
+
+RECV_SIZE = 512  # small, so lines and UTF-8 characters are cut by the reads
+
+
+class SMTPSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        userinfo = os.path.join(self.directory.name, "userinfo.txt")
+        with open(userinfo, "w") as f:
+            f.write("bert pw\n")
+        parser = argparse.ArgumentParser()
+        config.add_mail_arguments(parser)
+        config.apply_mail_options(parser.parse_args(
+            ["--mail-root", os.path.join(self.directory.name, "mail"), "--userinfo", userinfo]))
+        self.relay = None
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.server = threading.Thread(target=self.serve_one, daemon=True)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.join(5)
+        self.listener.close()
+        if self.relay is not None:
+            self.relay.close()
+        self.directory.cleanup()
+
+    def serve_one(self):
+        conn, addr = self.listener.accept()
+        SMTPSession(conn, addr, recv_size=RECV_SIZE, relay=self.relay).handle_client()
+
+    def send(self, body):
+        with smtplib.SMTP("127.0.0.1", self.listener.getsockname()[1]) as client:
+            client.sendmail("alice@example.com", ["bert@" + config.domain], body)
+
+    def stored_message(self, number=1):
+        with storage.store.open_mailbox("bert") as mailbox:
+            return bytes(mailbox.message(number))
+
+    def test_body_larger_than_recv_size_is_stored_unchanged(self):
+        lines = ["From: alice@example.com", f"To: bert@{config.domain}", "Subject: large", ""]
+        for i in range(200):
+            lines.append(f"  line {i} with blanks around it, ünïcödé and a long tail {'x' * (i * 7)}  ")
+            if i % 25 == 0:
+                lines.append(f".dot-stuffed line {i}")
+        body = "\r\n".join(lines).encode("utf-8") + b"\r\n"
+        self.assertGreater(len(body), 20 * RECV_SIZE)
+        self.send(body)
+
+        stored = self.stored_message().split(b"\r\n")
+        self.assertTrue(stored[3].startswith(b"Received: "))
+        del stored[3]
+        # Stored in wire form: dot-stuffed again and terminated
+        expected = b"".join((b"." + line if line.startswith(b".") else line) + b"\r\n"
+                            for line in body.split(b"\r\n")[:-1]) + b".\r\n"
+        self.assertEqual(b"\r\n".join(stored), expected)
+
+    def test_invalid_sender_is_refused(self):
+        with smtplib.SMTP("127.0.0.1", self.listener.getsockname()[1]) as client:
+            client.ehlo()
+            self.assertEqual(client.docmd("MAIL FROM:", "no-brackets")[0], 500)
+            # Refused with a single reply, the session still waits for MAIL FROM
+            self.assertEqual(client.noop()[0], 250)
+            self.assertEqual(client.docmd("RCPT TO:", f"<bert@{config.domain}>")[0], 500)
+
+    def start_relay(self, networks):
+        self.relay = Relay(os.path.join(self.directory.name, "spool"), smarthost=("127.0.0.1", 9),
+                           networks=parse_networks(networks))
+
+    def relay_reply(self, sender):
+        with smtplib.SMTP("127.0.0.1", self.listener.getsockname()[1]) as client:
+            client.ehlo()
+            self.assertEqual(client.mail(sender)[0], 250)
+            return client.rcpt("carol@example.net")[0]
+
+    def test_relaying_from_a_trusted_network(self):
+        self.start_relay("127.0.0.0/8")
+        self.assertEqual(self.relay_reply(f"bert@{config.domain}"), 250)
+
+    def test_spoofed_local_sender_is_not_relayed(self):
+        # MAIL FROM names a local user, but the client is not in the relay networks
+        self.start_relay("192.0.2.0/24,::1/128")
+        self.assertEqual(self.relay_reply(f"bert@{config.domain}"), 550)
+        self.assertEqual(os.listdir(self.relay.spool_dir), [])
+
+    def test_foreign_sender_is_not_relayed(self):
+        self.start_relay("127.0.0.0/8")
+        self.assertEqual(self.relay_reply("mallory@example.org"), 550)
+
+
+if __name__ == "__main__":
+    unittest.main()
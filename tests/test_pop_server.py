@@ -0,0 +1,113 @@
+"""
+test_pop_server.py
+------------------
+Runs POP3 sessions over real sockets against a temporary mailbox, two of them at once.
+Usage: python -m pytest tests
+"""
+
+import argparse
+import os
+import poplib
+import socket
+import tempfile
+import threading
+import unittest
+
+import config
+import pop_server
+import storage
+from mailserver_smtp import stamp_message
+from sessions import SessionRegistry
+
+
+class POP3SessionTest(unittest.TestCase):
+    store_arguments = []
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        userinfo = os.path.join(self.directory.name, "userinfo.txt")
+        with open(userinfo, "w") as f:
+            f.write("bert pw\n")
+        parser = argparse.ArgumentParser()
+        config.add_mail_arguments(parser)
+        config.apply_mail_options(parser.parse_args(
+            ["--mail-root", os.path.join(self.directory.name, "mail"), "--userinfo", userinfo]
+            + self.store_arguments))
+        if hasattr(storage.store, "set_password"):
+            storage.store.set_password("bert", "pw")
+        storage.store.deliver("bert", [stamp_message(["From: alice@example.com", f"To: bert@{config.domain}",
+                                                      f"Subject: message {i}", "", f"body {i}"])
+                                       for i in range(1, 6)])
+        self.sessions = SessionRegistry()
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.server = threading.Thread(target=self.serve, daemon=True)
+        self.server.start()
+
+    def tearDown(self):
+        self.listener.close()
+        self.directory.cleanup()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            self.sessions.add(conn)
+            threading.Thread(target=pop_server.handle_client, args=(conn, addr, self.sessions), daemon=True).start()
+
+    def login(self):
+        client = poplib.POP3("127.0.0.1", self.listener.getsockname()[1], timeout=5)
+        client.user("bert")
+        client.pass_("pw")
+        return client
+
+    def subjects(self):
+        with storage.store.open_mailbox("bert") as mailbox:
+            return [bytes(mailbox.message_head(number)).split(b"Subject: ")[1].split(b"\r\n")[0].decode()
+                    for number in range(1, len(mailbox) + 1)]
+
+    def test_dele_and_quit(self):
+        client = self.login()
+        self.assertEqual(client.stat(), tuple(storage.store.usage("bert")))
+        client.dele(2)
+        self.assertEqual(client.stat()[0], 4)
+        with self.assertRaises(poplib.error_proto):
+            client.retr(2)
+        client.quit()
+        self.assertEqual(self.subjects(), ["message 1", "message 3", "message 4", "message 5"])
+
+    def test_concurrent_sessions_remove_what_they_marked(self):
+        first = self.login()
+        second = self.login()
+        first.dele(3)
+        second.dele(1)
+        second.quit()
+        # The first session's message 3 is now number 2 in the mailbox, it is still the one removed
+        first.quit()
+        self.assertEqual(self.subjects(), ["message 2", "message 4", "message 5"])
+
+    def test_both_sessions_marking_the_same_message(self):
+        first = self.login()
+        second = self.login()
+        first.dele(2)
+        second.dele(2)
+        first.quit()
+        second.quit()
+        self.assertEqual(self.subjects(), ["message 1", "message 3", "message 4", "message 5"])
+
+    def test_rset_keeps_everything(self):
+        client = self.login()
+        client.dele(1)
+        client.rset()
+        self.assertEqual(client.stat()[0], 5)
+        client.quit()
+        self.assertEqual(len(self.subjects()), 5)
+
+
+class SQLitePOP3SessionTest(POP3SessionTest):
+    store_arguments = ["--store", "sqlite"]
+
+
+if __name__ == "__main__":
+    unittest.main()
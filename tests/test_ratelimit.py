@@ -0,0 +1,59 @@
+"""
+test_ratelimit.py
+-----------------
+Checks the token buckets against a fake clock.
+Usage: python -m pytest tests
+"""
+
+import argparse
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+import ratelimit
+from ratelimit import RateLimiter, add_rate_limit_arguments
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(ratelimit.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_rate(self):
+        limiter = RateLimiter(rate=2, burst=3)
+        self.assertEqual([limiter.allow("a") for _ in range(4)], [True, True, True, False])
+        self.assertTrue(limiter.allow("b"))  # every key has a bucket of its own
+        self.now += 0.5
+        self.assertEqual([limiter.allow("a") for _ in range(2)], [True, False])
+
+    def test_burst_below_one_is_refused(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(rate=5, burst=0.5)
+        parser = argparse.ArgumentParser()
+        add_rate_limit_arguments(parser, "user")
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            parser.parse_args(["--user-rate", "1", "--user-burst", "0"])
+
+    def test_refilled_keys_are_forgotten(self):
+        limiter = RateLimiter(rate=1, burst=2)
+        for key in range(100):
+            limiter.allow(key)
+        self.now += 2  # all of them have refilled
+        limiter.allow("new")
+        self.assertEqual(list(limiter._buckets), ["new"])
+
+    def test_table_is_bounded(self):
+        limiter = RateLimiter(rate=0.001, burst=1)
+        with mock.patch.object(ratelimit, "MAX_TRACKED_KEYS", 50):
+            for key in range(200):
+                self.assertTrue(limiter.allow(key))
+            self.assertEqual(len(limiter._buckets), 50)
+            self.assertFalse(limiter.allow(199))  # the most recent keys are still limited
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+test_relay.py
+-------------
+Runs the relay scheduler on a temporary spool with entries it cannot deliver.
+Usage: python -m pytest tests
+"""
+
+import glob
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from relay import Relay
+
+MESSAGE = "Subject: hello\r\n\r\nbody\r\n.\r\n"
+
+
+class RelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.spool = os.path.join(self.directory.name, "spool")
+        self.bounced = []
+        self.bounce_error = None
+        self.relay = None
+
+    def tearDown(self):
+        if self.relay is not None:
+            self.relay.close()
+        self.directory.cleanup()
+
+    def bounce(self, sender, failures, message):
+        self.bounced.append((sender, sorted(failures)))
+        if self.bounce_error is not None:
+            raise self.bounce_error
+
+    def start(self, **options):
+        self.relay = Relay(self.spool, bounce=self.bounce, **options)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.02)
+
+    def entries(self):
+        return sorted(os.path.basename(path) for path in glob.glob(os.path.join(self.spool, "*")))
+
+    def test_corrupt_entry_is_moved_aside(self):
+        os.makedirs(self.spool)
+        with open(os.path.join(self.spool, "000000000000-broken.json"), "w") as f:
+            f.write('{"id": "broken", "recip')
+        self.start()
+        # Submitted after the corrupt entry, the scheduler is still there to pick it up
+        self.relay.submit("bert@example.com", ["carol@nowhere.example"], MESSAGE)
+        self.wait_for(lambda: self.bounced)
+        self.assertEqual(self.bounced, [("bert@example.com", ["carol@nowhere.example"])])
+        self.wait_for(lambda: self.entries() == ["000000000000-broken.json.corrupt"])
+        self.assertTrue(self.relay._scheduler.is_alive())
+
+    def test_failed_bounce_is_retried(self):
+        self.bounce_error = sqlite3.OperationalError("database is locked")
+        # Nothing listens on the smarthost, and the mail is too old to be retried
+        self.start(smarthost=("127.0.0.1", 9), max_age=0)
+        self.relay.submit("bert@example.com", ["carol@example.net"], MESSAGE)
+        self.wait_for(lambda: self.bounced)
+        self.wait_for(lambda: self.relay._active[("127.0.0.1", 9)] == 1 and not self.relay._claimed)
+        [name] = self.entries()
+        with open(os.path.join(self.spool, name)) as f:
+            entry = json.load(f)
+        self.assertEqual((entry["recipients"], entry["attempts"]), (["carol@example.net"], 1))
+        self.assertTrue(all(thread.is_alive() for thread in self.relay._threads))
+
+
+if __name__ == "__main__":
+    unittest.main()
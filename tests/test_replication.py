@@ -0,0 +1,107 @@
+"""
+test_replication.py
+-------------------
+Logs deliveries and removals on a temporary primary and applies the log to a temporary standby.
+Usage: python -m pytest tests
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+import unittest
+
+import config
+import storage
+from mailserver_smtp import stamp_message
+from replication import ReplicatedStore, apply_changes, decode_changes, list_segments
+
+
+def message(subject):
+    return stamp_message(["From: alice@example.com", f"To: bert@{config.domain}", f"Subject: {subject}", "", "body"])
+
+
+class ReplicationTest(unittest.TestCase):
+    store_arguments = []
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_dir = os.path.join(self.directory.name, "log")
+        self.primary = self.use_store("primary", ["--replication-log", self.log_dir])
+        self.assertIsInstance(self.primary, ReplicatedStore)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def use_store(self, name, arguments=()):
+        """Points storage.store at the mail of name, with user bert."""
+        root = os.path.join(self.directory.name, name)
+        os.makedirs(root)
+        userinfo = os.path.join(root, "userinfo.txt")
+        with open(userinfo, "w") as f:
+            f.write("bert pw\n")
+        parser = argparse.ArgumentParser()
+        config.add_mail_arguments(parser)
+        config.apply_mail_options(parser.parse_args(
+            ["--mail-root", os.path.join(root, "mail"), "--userinfo", userinfo] + self.store_arguments + list(arguments)))
+        return storage.store
+
+    def changes(self):
+        data = b""
+        for _, path in list_segments(self.log_dir):
+            with open(path, "rb") as f:
+                data += f.read()
+        changes, used, skipped = decode_changes(data)
+        self.assertEqual((used, skipped), (len(data), 0))
+        return changes
+
+    def subjects(self):
+        with storage.store.open_mailbox("bert") as mailbox:
+            return [bytes(mailbox.message_head(number)).split(b"Subject: ")[1].split(b"\r\n")[0].decode()
+                    for number in range(1, len(mailbox) + 1)]
+
+    def test_removals_are_logged_with_the_digests_of_the_removed_mail(self):
+        messages = [message(subject) for subject in "abcd"]
+        self.primary.deliver("bert", messages[:2])
+        self.primary.deliver("bert", messages[2:])
+        _, _, numbered = self.primary.uids("bert")
+        self.primary.remove_uids("bert", [numbered[1][0]])  # b
+        self.primary.remove_messages("bert", {2})  # c, now the second message
+        self.primary.remove_uids("bert", [numbered[1][0]])  # gone already, nothing logged
+
+        changes = self.changes()
+        self.assertEqual([change["op"] for change in changes], ["deliver", "deliver", "remove", "remove"])
+        digest = {subject: hashlib.sha1(text.encode("utf-8")).hexdigest() for subject, text in zip("abcd", messages)}
+        self.assertEqual(changes[2]["messages"], [[2, digest["b"]]])
+        self.assertEqual(changes[3]["messages"], [[2, digest["c"]]])
+        self.assertEqual(self.subjects(), ["a", "d"])
+
+    def test_standby_applies_deliveries_and_removals(self):
+        self.primary.deliver("bert", [message(subject) for subject in "abcd"])
+        self.primary.remove_messages("bert", {1, 3})
+        self.primary.deliver("bert", [message("e")])
+        primary_subjects = self.subjects()
+
+        self.use_store("standby")
+        apply_changes(self.changes())
+        self.assertEqual(self.subjects(), primary_subjects)
+        self.assertEqual(primary_subjects, ["b", "d", "e"])
+
+    def test_standby_in_a_different_order_removes_the_same_mail(self):
+        self.primary.deliver("bert", [message("a")])
+        self.primary.deliver("bert", [message("b")])
+        self.primary.remove_messages("bert", {1})
+
+        self.use_store("standby")
+        changes = self.changes()
+        # Deliveries logged by different processes may land in the other order on the standby
+        apply_changes([changes[1], changes[0], changes[2]])
+        self.assertEqual(self.subjects(), ["b"])
+
+
+class SQLiteReplicationTest(ReplicationTest):
+    store_arguments = ["--store", "sqlite"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+tls.py
+------
+TLS for the SMTP and POP3 servers and the client.
+Connections start in clear and are upgraded on request (STARTTLS in SMTP, STLS in POP3) once the
+server has a certificate (--tls-cert, --tls-key). The handshake runs in the session's own thread,
+bounded by --command-timeout, so a slow or stalled client only holds up itself, never the accept
+loop or the other sessions.
+Short connections such as the client's password check are dominated by the handshake, so both
+sides resume sessions: the server hands out session tickets (--tls-tickets per handshake), and
+the client keeps the last session with each server and offers it on its next connection, which
+skips sending and verifying the certificate chain. The ticket keys are made when the server
+context is created, before --workers forks, so a ticket is good with every worker process.
+"""
+
+import ssl
+
+DEFAULT_TICKETS = 2
+
+
+def server_context(certfile, keyfile=None, tickets=DEFAULT_TICKETS):
+    """Returns the SSLContext the servers upgrade connections with."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = tickets
+    return context
+
+
+def is_tls(conn) -> bool:
+    return isinstance(conn, ssl.SSLSocket)
+
+
+class ClientTLS:
+    """Upgrades client connections, resuming the previous session with the same server."""
+
+    def __init__(self, cafile=None):
+        self.context = ssl.create_default_context(cafile=cafile)
+        self._sessions = {}  # (host, port) -> SSLSession
+
+    def wrap(self, sock, host, port):
+        return self.context.wrap_socket(sock, server_hostname=host, session=self._sessions.get((host, port)))
+
+    def remember(self, sock):
+        """Keeps the session of a connection about to be closed for the next one to the same server."""
+        if not is_tls(sock):
+            return
+        session = sock.session
+        try:
+            key = (sock.server_hostname, sock.getpeername()[1])
+        except OSError:
+            return
+        # TLS 1.3 sessions can only be resumed once their ticket has arrived
+        if session is not None and session.has_ticket:
+            self._sessions[key] = session
+
+
+def add_tls_arguments(parser):
+    parser.add_argument("--tls-cert", help="certificate chain (PEM) offered to clients that upgrade to TLS")
+    parser.add_argument("--tls-key", help="private key of --tls-cert, if not in the same file")
+    parser.add_argument("--tls-tickets", type=int, default=DEFAULT_TICKETS,
+                        help="session tickets issued per handshake, 0 turns resumption off")
+
+
+def tls_options(args):
+    """Returns the server SSLContext for the given options, or None without a certificate."""
+    if not args.tls_cert:
+        return None
+    return server_context(args.tls_cert, args.tls_key, args.tls_tickets)
@@ -0,0 +1,125 @@
+"""
+workers.py
+----------
+Pre-fork support shared by the SMTP and POP3 servers.
+The parent process forks N workers that each run the normal threaded accept loop. Where the
+platform has SO_REUSEPORT every worker binds its own listening socket and the kernel spreads
+incoming connections over them; otherwise the parent binds one socket that all workers inherit.
+SIGTERM or SIGINT on the parent is forwarded to every worker, which stops accepting and exits
+once its open sessions are drained. Mailbox safety across processes relies on the fcntl locks.
+"""
+
+import os
+import signal
+import socket
+import threading
+
+HAS_REUSEPORT = hasattr(socket, "SO_REUSEPORT")
+DEFAULT_BACKLOG = 128
+
+
+def create_listener(port, backlog=DEFAULT_BACKLOG, reuse_port=False):
+    """Creates a bound and listening IPv6 TCP socket."""
+    server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind(("", port))
+    server_socket.listen(backlog)
+    return server_socket
+
+
+def add_worker_arguments(parser):
+    parser.add_argument("--workers", type=int, default=1, help="number of server processes sharing the port")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG, help="connections queued before accept")
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def handle_sigterm():
+    """Makes SIGTERM stop a server's accept loop the same way Ctrl-C does."""
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+
+
+def _spawn_worker(serve, port, backlog, shared_socket):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    # Worker process: a SIGTERM from the parent behaves like Ctrl-C in the accept loop
+    handle_sigterm()
+    signal.signal(signal.SIGINT, _raise_interrupt)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)  # until serve() installs the profiler toggle
+    status = 0
+    try:
+        if shared_socket is None:
+            server_socket = create_listener(port, backlog, reuse_port=True)
+        else:
+            server_socket = shared_socket
+        serve(server_socket)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"Worker {os.getpid()} failed: {e}")
+        status = 1
+    finally:
+        # Let the open sessions finish before leaving the worker
+        for thread in threading.enumerate():
+            if thread is not threading.main_thread() and not thread.daemon:
+                thread.join()
+        os._exit(status)
+
+
+def run_workers(serve, port, workers, backlog=DEFAULT_BACKLOG):
+    """Forks `workers` processes calling serve(server_socket) and supervises them.
+
+    Workers killed by a signal are restarted; the call returns once all of them have
+    exited after a shutdown signal or a worker failed to start serving.
+    """
+    shared_socket = None
+    if not HAS_REUSEPORT:
+        shared_socket = create_listener(port, backlog)
+
+    stopping = False
+    children = set()
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        forward(signal.SIGTERM, frame)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGUSR1, forward)  # profiler toggle, see profiling.py
+
+    for _ in range(workers):
+        children.add(_spawn_worker(serve, port, backlog, shared_socket))
+    print(f"Started {workers} workers ({'SO_REUSEPORT' if shared_socket is None else 'shared socket'})")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if stopping:
+            continue
+        if os.WIFSIGNALED(status):
+            print(f"Worker {pid} killed by signal {os.WTERMSIG(status)}, restarting")
+            children.add(_spawn_worker(serve, port, backlog, shared_socket))
+        else:
+            print(f"Worker {pid} exited with status {os.WEXITSTATUS(status)}, stopping all workers")
+            shutdown(signal.SIGTERM, None)
+
+    if shared_socket is not None:
+        shared_socket.close()